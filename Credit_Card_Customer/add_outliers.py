@@ -8,35 +8,60 @@ This class add outliers to the PCA reduced data. More specifically:
 
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
+
+import binary_store
+import instrumentation
+
+
+def draw_outliers(rng: np.random.Generator, means, stds, multiplier: float, num_outliers: int):
+    """
+    Draws outliers uniformly in the box of mean +- multiplier * std of every feature, one feature after the other
+    :param rng: the random generator
+    :param means: the mean of every feature
+    :param stds: the standard deviation of every feature
+    :param multiplier: multiplier to determine the range of the outliers
+    :param num_outliers: number of outliers
+    :return: (num_outliers, d) array
+    """
+
+    return np.column_stack([rng.uniform(mean - multiplier * std, mean + multiplier * std, num_outliers)
+                            for mean, std in zip(means, stds)]).reshape(num_outliers, len(means))
 
 
 class OutlierHandler:
-    def __init__(self, file_path, x_column, y_column):
+    def __init__(self, file_path, x_column, y_column, seed=None):
         """
         Constructor
         :param file_path: Path to the CSV file.
         :param x_column: Name of the column to use as X-axis.
         :param y_column: Name of the column to use as Y-axis.
+        :param seed: Seed of the random generator of the outliers, so that a run can be reproduced.
         """
         self.file_path = file_path
         self.x_column = x_column
         self.y_column = y_column
+        self.rng = np.random.default_rng(seed)
         self.data = None
+        self.outlier_indices = np.empty(0, dtype=np.intp)
 
-    def load_data(self):
+    @instrumentation.traced('add_outliers.load_data')
+    def load_data(self, data: pd.DataFrame = None):
         """
         Load the data from the CSV file.
+        :param data: a DataFrame that is already in memory. It is used instead of the file
         :return: None
         """
         try:
-            self.data = pd.read_csv(self.file_path)
+            self.data = binary_store.read_table(self.file_path) if data is None else data
+            self.outlier_indices = np.empty(0, dtype=np.intp)
+            instrumentation.add_rows(len(self.data))
             if self.x_column not in self.data.columns or self.y_column not in self.data.columns:
                 raise ValueError("Specified columns not found in the CSV file.")
         except Exception as e:
             print(f"Error loading file: {e}")
             self.data = None
 
+    @instrumentation.traced('add_outliers.add_outliers')
     def add_outliers(self, num_outliers: int, multiplier: int):
         """
         Add synthetic outliers to the dataset.
@@ -59,22 +84,40 @@ class OutlierHandler:
         y_mean, y_std = self.data[self.y_column].mean(), self.data[self.y_column].std()
 
         # Generate outliers far from the data range
-        outliers_x = np.random.uniform(x_mean + multiplier * x_std, x_mean - multiplier * x_std, num_outliers)
-        outliers_y = np.random.uniform(y_mean + multiplier * y_std, y_mean - multiplier * y_std, num_outliers)
+        drawn = draw_outliers(self.rng, [x_mean, y_mean], [x_std, y_std], multiplier, num_outliers)
 
-        # Append outliers to the DataFrame
-        outliers = pd.DataFrame({self.x_column: outliers_x, self.y_column: outliers_y})
+        # Append outliers to the DataFrame, and keep their row numbers (the ground truth of the outlier detectors)
+        outliers = pd.DataFrame({self.x_column: drawn[:, 0], self.y_column: drawn[:, 1]})
+        self.outlier_indices = np.concatenate([self.outlier_indices,
+                                               np.arange(len(self.data), len(self.data) + num_outliers)])
         self.data = pd.concat([self.data, outliers], ignore_index=True)
+        instrumentation.add_rows(num_outliers)
 
-    def plot_data(self):
+    def plot_data(self, output_path: str = None):
         """
         Plot the data including outliers.
+        :param output_path: if given, the plot is saved to this image file without a window ('headless_plot.py'),
+                            and large data are drawn as a density raster with the added outliers as markers
         :return: nothing
         """
         if self.data is None:
             print("Data not loaded. Please run `load_data()` first.")
             return
 
+        if output_path is not None:
+            import headless_plot
+
+            inliers = np.ones(len(self.data), dtype=bool)
+            inliers[self.outlier_indices] = False
+            points = self.data[[self.x_column, self.y_column]].to_numpy(dtype=np.float64)
+            headless_plot.save_scatter(output_path, points[inliers, 0], points[inliers, 1],
+                                       markers=[{'points': points[~inliers], 'label': 'Added outliers'}],
+                                       title='2D Scatter Plot with Outliers', x_label=self.x_column,
+                                       y_label=self.y_column)
+            return
+
+        import matplotlib.pyplot as plt
+
         plt.figure(figsize=(8, 6))
         plt.scatter(self.data[self.x_column], self.data[self.y_column], color='blue', alpha=0.7)
         plt.title('2D Scatter Plot with Outliers')
@@ -83,14 +126,15 @@ class OutlierHandler:
         plt.grid(True)
         plt.show()
 
+    @instrumentation.traced('add_outliers.save_data')
     def save_data(self, output_path: str):
         """
-        Save the dataset (with outliers) to a new CSV file.
+        Save the dataset (with outliers) to a new CSV file (or binary table, if the path ends with '.cbin').
         :param output_path: the file that the new data should be saved to.
         :return: nothing
         """
         if self.data is not None:
-            self.data.to_csv(output_path, index=False)
+            binary_store.save_table(self.data, output_path)
             #print(f"Data saved to {output_path}")
         else:
             print("Data not available. Please load the data and add outliers first.")
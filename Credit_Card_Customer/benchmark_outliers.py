@@ -0,0 +1,89 @@
+"""
+This file compares the outlier detectors on the synthetic outliers that `OutlierHandler.add_outliers` injects into the
+PCA reduced data ('pca_reduced_data.csv'):
+    'centroid': OutlierDetector, with the centroids of a k-means run ('find_outliers.py')
+    'knn', 'lof', 'isolation_forest': DensityOutlierDetector ('density_outliers.py')
+
+Every repeat injects new outliers (with another seed) and runs every detector on the same data. The recall is the
+share of the injected outliers that a detector flags, and the precision the share of the flagged points that were
+injected. The outliers are drawn uniformly around the mean, so some of them land inside the clusters and no detector
+can find them: the recall is compared between the detectors, not with 1.
+The runtime of the centroid detector includes the k-means, which it needs.
+
+Run it with 'python benchmark_outliers.py'.
+"""
+
+import time
+
+import numpy as np
+
+import add_outliers
+import binary_store
+import density_outliers
+import find_outliers
+import kMeans
+
+METHODS = ['centroid', 'knn', 'lof', 'isolation_forest']
+
+
+def detect(method: str, points: np.ndarray, outlier_percentile: float, k: int, seed: int):
+    """
+    Runs one detector
+    :return: array with the indices of the outliers
+    """
+
+    if method == 'centroid':
+        model = kMeans.VectorizedKMeans(k, None, seed=seed)
+        model.fit(points, 100)
+        detector = find_outliers.OutlierDetector(k, outlier_percentile, data=points)
+        _, outliers, _ = detector.split_the_data(model.centroid_array, labels=model.labels)
+        return outliers
+
+    detector = density_outliers.DensityOutlierDetector(method, outlier_percentile, data=points, seed=seed)
+    _, outliers, _ = detector.split_the_data()
+    return outliers
+
+
+def benchmark(file_path: str = 'pca_reduced_data.csv', repeats: int = 10, num_outliers: int = 5,
+              multiplier: int = 4, outlier_percentile: float = 99, k: int = 3):
+    """
+    Runs every detector on data with injected outliers
+    :param file_path: the file with the PCA reduced data
+    :param repeats: how many times the outliers are injected
+    :param num_outliers: number of outliers injected every time
+    :param multiplier: multiplier of the range of the outliers (see OutlierHandler.add_outliers)
+    :param outlier_percentile: percentile threshold of every detector
+    :param k: number of clusters of the k-means
+    :return: dictionary from every method to its mean recall, precision and runtime
+    """
+
+    data = binary_store.read_table(file_path)
+    results = {method: {'recall': [], 'precision': [], 'seconds': []} for method in METHODS}
+
+    # The first run of a detector also imports its libraries, so every detector runs once before it is timed
+    for method in METHODS:
+        detect(method, data.to_numpy(dtype=np.float64), outlier_percentile, k, 0)
+
+    for seed in range(repeats):
+        handler = add_outliers.OutlierHandler(None, 'PCA1', 'PCA2', seed=seed)
+        handler.load_data(data=data)
+        handler.add_outliers(num_outliers=num_outliers, multiplier=multiplier)
+        points = handler.data.to_numpy(dtype=np.float64)
+        truth = set(handler.outlier_indices.tolist())
+
+        for method in METHODS:
+            start = time.perf_counter()
+            flagged = set(detect(method, points, outlier_percentile, k, seed).tolist())
+            results[method]['seconds'].append(time.perf_counter() - start)
+            results[method]['recall'].append(len(flagged & truth) / len(truth))
+            results[method]['precision'].append(len(flagged & truth) / len(flagged) if flagged else 0.0)
+
+    return {method: {name: float(np.mean(values)) for name, values in result.items()}
+            for method, result in results.items()}
+
+
+if __name__ == '__main__':
+    summary = benchmark()
+    print(f"{'method':<18}{'recall':>8}{'precision':>11}{'runtime (ms)':>14}")
+    for method, result in summary.items():
+        print(f"{method:<18}{result['recall']:>8.2f}{result['precision']:>11.2f}{result['seconds'] * 1000:>14.1f}")
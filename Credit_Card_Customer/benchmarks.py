@@ -0,0 +1,277 @@
+"""
+This file measures how the stages of the pipeline scale with the number of customers:
+    read_data (txt -> csv), preprocess, pca, hierarchical, kmeans, find_outliers, and the whole flow of 'main.py'
+    (CreditCardPipeline, without plots)
+over a ladder of dataset sizes, and of k values for the k-means and the outlier detection.
+
+The datasets are synthetic customers ('synthetic_data.py'), generated once per size in a work directory, and the inputs
+of every stage (the csv, the preprocessed and the PCA reduced data) are prepared before anything is timed. Every
+measurement runs in its own process, so its peak memory (peak RSS) is not mixed with the others, and records:
+    the wall time of the stage only (not the imports or the data generation)
+    the peak RSS of the process, and the RSS before the stage started (the interpreter and the libraries)
+    the throughput in rows per second
+    the build and query times of the nearest neighbor backends ('neighbors.py') that the stage used
+
+Every run is appended to a JSON history with the scaling exponent of every stage: the slope of log(time) over
+log(rows), so 1 means linear and 2 quadratic. With a baseline (a previous run saved with --update-baseline), a stage
+that is slower than the baseline by more than the threshold fails the run, and the exit code is 1, so it can gate a
+CI job. Measurements shorter than --min-seconds are too noisy to gate and are only reported.
+
+Run it from this directory, e.g.:
+    python benchmarks.py --sizes 1000 10000 100000 --k 3 10
+    python benchmarks.py --baseline benchmark_baseline.json --threshold 0.25
+"""
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import neighbors
+from instrumentation import peak_rss_mb
+
+STAGES = ['read_data', 'preprocess', 'pca', 'hierarchical', 'kmeans', 'find_outliers', 'end_to_end']
+K_STAGES = ('kmeans', 'find_outliers')        # The stages that run for every k
+STAGE_MODULES = {'read_data': 'read_data', 'preprocess': 'preprocess', 'pca': 'pca_method',
+                 'hierarchical': 'hierarchical_clustering', 'kmeans': 'kMeans', 'find_outliers': 'find_outliers',
+                 'end_to_end': 'pipeline'}
+# The libraries that the stages import only when they run, so they are imported before the clock starts too
+LAZY_IMPORTS = {'pca': ['sklearn.decomposition'], 'end_to_end': ['sklearn.decomposition']}
+
+# Settings that keep the quadratic parts of the hierarchical clustering bounded for the large sizes
+MAX_MEMORY_MB = 256
+SILHOUETTE_SAMPLE_SIZE = 2000
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def input_paths(work_dir: str, rows: int):
+    """
+    :return: dictionary with the paths of the inputs of every stage for a size
+    """
+
+    return {name: os.path.join(work_dir, f"{name}_{rows}.{extension}")
+            for name, extension in [('txt', 'txt'), ('data', 'csv'), ('preprocessed', 'csv'), ('pca', 'csv')]}
+
+
+def prepare(work_dir: str, rows: int, seed: int = 0):
+    """
+    Generates the synthetic customers of a size and the inputs of every stage, if they do not exist yet
+    :param work_dir: the directory of the files
+    :param rows: the number of customers
+    :param seed: seed of the generator
+    :return: nothing
+    """
+
+    import shutil
+    import pca_method
+    import preprocess
+    import synthetic_data
+
+    paths = input_paths(work_dir, rows)
+    if all(os.path.exists(path) for path in paths.values()):
+        return
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        synthetic_data.SyntheticCustomerGenerator(os.path.join(DIRECTORY, 'data.csv'), seed=seed,
+                                                  outlier_rate=0.001).generate(rows, paths['data'])
+        shutil.copyfile(paths['data'], paths['txt'])
+
+        preprocessor = preprocess.CreditCardDataPreProcessor(paths['data'])
+        preprocessor.load_data(drop_ids=True)
+        preprocessor.preprocess(preprocess.NORMALIZE_COLUMNS)
+        preprocessor.save_data(paths['preprocessed'])
+
+        pca_method.PCAProcessor(n_components=2).fit_transform(paths['preprocessed'], paths['pca'])
+
+
+def run_stage(stage: str, rows: int, k: int, work_dir: str):
+    """
+    Runs one stage on its prepared input. This is what is timed
+    :return: nothing
+    """
+
+    if stage not in STAGE_MODULES:
+        raise ValueError(f"Unknown stage '{stage}'")
+
+    paths = input_paths(work_dir, rows)
+    output = os.path.join(work_dir, f"output_{stage}_{rows}.csv")
+    module = importlib.import_module(STAGE_MODULES[stage])
+
+    if stage == 'read_data':
+        module.DataProcessor(paths['txt'], output).process()
+    elif stage == 'preprocess':
+        preprocessor = module.CreditCardDataPreProcessor(paths['data'])
+        preprocessor.load_data(drop_ids=True)
+        preprocessor.preprocess(module.NORMALIZE_COLUMNS)
+        preprocessor.save_data(output)
+    elif stage == 'pca':
+        module.PCAProcessor(n_components=2).fit_transform(paths['preprocessed'], output)
+    elif stage == 'hierarchical':
+        clustering = module.HierarchicalClustering('ward', max_memory_mb=MAX_MEMORY_MB, seed=0)
+        clustering.load_data(paths['pca'])
+        clustering.run_hierarchical_clustering()
+        clustering.find_optimal_clusters(max_clusters=10, sample_size=SILHOUETTE_SAMPLE_SIZE)
+    elif stage == 'kmeans':
+        module.VectorizedKMeans(k, paths['pca'], seed=0).run(100)
+    elif stage == 'find_outliers':
+        detector = module.OutlierDetector(k, 99, file_path=paths['pca'])
+        detector.load_data()
+        centroids = detector.data[np.random.default_rng(0).choice(len(detector.data), k, replace=False)]
+        detector.split_the_data(centroids)
+    else:
+        module.CreditCardPipeline(input_file=paths['txt'], seed=0, max_memory_mb=MAX_MEMORY_MB,
+                                  silhouette_sample_size=SILHOUETTE_SAMPLE_SIZE).run()
+
+
+def measure_in_this_process(stage: str, rows: int, k: int, work_dir: str):
+    """
+    Times one stage in the current process. It is called in a new process by `measure`
+    :return: dictionary with the measurement
+    """
+
+    # The modules of the stage (and their libraries) are imported before the clock starts
+    for name in [STAGE_MODULES[stage]] + LAZY_IMPORTS.get(stage, []):
+        importlib.import_module(name)
+
+    start_rss = peak_rss_mb()
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        run_stage(stage, rows, k, work_dir)
+        seconds = time.perf_counter() - start
+
+    # The process is new, so the timings of the nearest neighbor backends are the ones of the stage only
+    return {'stage': stage, 'rows': rows, 'k': k if stage in K_STAGES else None, 'seconds': seconds,
+            'rows_per_second': rows / seconds if seconds > 0 else float('inf'),
+            'peak_rss_mb': peak_rss_mb(), 'start_rss_mb': start_rss, 'neighbor_timings': dict(neighbors.TIMINGS)}
+
+
+def measure(stage: str, rows: int, k: int, work_dir: str):
+    """
+    Times one stage in a new process
+    :return: dictionary with the measurement
+    """
+
+    arguments = json.dumps({'stage': stage, 'rows': rows, 'k': k, 'work_dir': os.path.abspath(work_dir)})
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', arguments],
+                               capture_output=True, text=True, cwd=DIRECTORY)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Stage {stage} with {rows} rows failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def scaling_exponents(results):
+    """
+    Fits log(time) = a + b * log(rows) for every stage (and k)
+    :param results: the measurements
+    :return: dictionary from 'stage' (or 'stage k=..') to the exponent b
+    """
+
+    groups = {}
+    for result in results:
+        name = result['stage'] if result['k'] is None else f"{result['stage']} k={result['k']}"
+        groups.setdefault(name, []).append((result['rows'], result['seconds']))
+
+    exponents = {}
+    for name, points in groups.items():
+        rows, seconds = np.array(points, dtype=np.float64).T
+        if len(np.unique(rows)) >= 2 and np.all(seconds > 0):
+            exponents[name] = float(np.polyfit(np.log(rows), np.log(seconds), 1)[0])
+    return exponents
+
+
+def regressions(results, baseline, threshold: float, min_seconds: float):
+    """
+    Compares the measurements with a baseline
+    :param results: the measurements
+    :param baseline: the measurements of the baseline run
+    :param threshold: the allowed slowdown, e.g. 0.25 for 25%
+    :param min_seconds: measurements shorter than this (in both runs) are not compared
+    :return: list with a description of every regression
+    """
+
+    reference = {(result['stage'], result['rows'], result['k']): result for result in baseline}
+    failures = []
+    for result in results:
+        previous = reference.get((result['stage'], result['rows'], result['k']))
+        if previous is None or max(result['seconds'], previous['seconds']) < min_seconds:
+            continue
+        ratio = result['seconds'] / previous['seconds']
+        if ratio > 1 + threshold:
+            failures.append(f"{result['stage']} rows={result['rows']} k={result['k']}: {previous['seconds']:.3f} s "
+                            f"-> {result['seconds']:.3f} s ({(ratio - 1) * 100:+.0f}%)")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the stages of the pipeline over dataset sizes")
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000])
+    parser.add_argument('--k', nargs='+', type=int, default=[3, 10, 50])
+    parser.add_argument('--work-dir', default='benchmark_data')
+    parser.add_argument('--history', default='benchmark_history.json')
+    parser.add_argument('--baseline', default=None, help="JSON file of a previous run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.25, help="allowed slowdown against the baseline")
+    parser.add_argument('--min-seconds', type=float, default=0.05)
+    parser.add_argument('--update-baseline', action='store_true', help="save this run as the baseline")
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        parameters = json.loads(args.measure)
+        print(json.dumps(measure_in_this_process(**parameters)))
+        return 0
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    results = []
+    for rows in args.sizes:
+        prepare(args.work_dir, rows)
+        for stage in args.stages:
+            for k in (args.k if stage in K_STAGES else [None]):
+                result = measure(stage, rows, k, args.work_dir)
+                results.append(result)
+                peak = f"{result['peak_rss_mb']:.1f}" if result['peak_rss_mb'] is not None else '-'
+                print(f"{stage:<14} rows={rows:<10} k={str(result['k']):<5} {result['seconds']:>9.3f} s "
+                      f"{result['rows_per_second']:>14,.0f} rows/s  peak {peak:>8} MB")
+                neighbors.report_timings(result.get('neighbor_timings', {}), indent='    ')
+
+    exponents = scaling_exponents(results)
+    print("Scaling exponents (time ~ rows^b):")
+    for name, exponent in exponents.items():
+        print(f"    {name}: {exponent:.2f}")
+
+    run = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results, 'exponents': exponents}
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history, 'r') as file:
+            history = json.load(file)
+    history.append(run)
+    with open(args.history, 'w') as file:
+        json.dump(history, file, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline or 'benchmark_baseline.json', 'w') as file:
+            json.dump(run, file, indent=2)
+        return 0
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            failures = regressions(results, json.load(file)['results'], args.threshold, args.min_seconds)
+        if failures:
+            print(f"{len(failures)} regressions over {args.threshold:.0%}:")
+            for failure in failures:
+                print(f"    {failure}")
+            return 1
+        print("No regressions against the baseline.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
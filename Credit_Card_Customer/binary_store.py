@@ -0,0 +1,302 @@
+"""
+This file implements a columnar binary format for the intermediate files of the pipeline, as an alternative to CSV.
+
+A file starts with a small header (magic bytes, the header length and a JSON schema with the number of rows and the
+name, dtype and offset of every column) and then every column is stored as a contiguous block of raw values, aligned
+to 64 bytes. Loading a file does not parse anything: the columns are memory-mapped NumPy arrays, and a group of
+columns with the same dtype is returned as a zero-copy (n, d) strided view, so a file with millions of rows opens in
+milliseconds and only the parts that are used are read from the disk.
+
+The loaders of the pipeline use `read_table` / `load_array` and the savers `save_table`, which pick the format from
+the file itself (or from the '.cbin' extension when writing), so CSV and binary files can be used interchangeably.
+"""
+
+import csv
+import json
+import os
+import shutil
+import struct
+from typing import List
+
+import numpy as np
+
+MAGIC = b'CCBTABL1'
+BINARY_EXTENSION = '.cbin'
+ALIGNMENT = 64
+
+
+def is_binary_path(file_path: str):
+    """
+    Checks if a file should be written in the binary format, from its extension
+    :param file_path: path of the file
+    :return: True for '.cbin' files
+    """
+
+    return str(file_path).endswith(BINARY_EXTENSION)
+
+
+def is_binary_table(file_path: str):
+    """
+    Checks if an existing file is in the binary format, from its magic bytes
+    :param file_path: path of the file
+    :return: True if the file is a binary table
+    """
+
+    with open(file_path, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def _aligned(offset: int):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _build_header(n_rows: int, names: List[str], dtypes: List[np.dtype]):
+    """
+    Builds the header and computes where every column starts
+    :return: tuple of (header bytes, schema)
+    """
+
+    columns = [{'name': str(name), 'dtype': np.dtype(dtype).str} for name, dtype in zip(names, dtypes)]
+
+    # The offsets depend on the header length, which depends on the offsets, so the space is reserved generously
+    reserved = _aligned(len(MAGIC) + 8 + len(json.dumps({'n_rows': n_rows, 'columns': columns})) + 32 * len(columns)
+                        + 64)
+    offset = reserved
+    for column in columns:
+        column['offset'] = offset
+        offset = _aligned(offset + n_rows * np.dtype(column['dtype']).itemsize)
+
+    schema = {'n_rows': n_rows, 'columns': columns}
+    encoded = json.dumps(schema).encode('utf-8')
+    header = MAGIC + struct.pack('<Q', len(encoded)) + encoded
+    if len(header) > reserved:
+        raise ValueError("Binary table header does not fit in the reserved space")
+    return header.ljust(reserved, b'\0'), schema
+
+
+def read_schema(file_path: str):
+    """
+    Reads the schema of a binary table
+    :param file_path: path of the file
+    :return: dictionary with 'n_rows' and 'columns' (name, dtype and offset of every column)
+    """
+
+    with open(file_path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{file_path} is not a binary table")
+        (length,) = struct.unpack('<Q', file.read(8))
+        return json.loads(file.read(length).decode('utf-8'))
+
+
+def column_names(file_path: str):
+    """
+    Gives the names of the columns of a binary table
+    :param file_path: path of the file
+    :return: list with the names
+    """
+
+    return [column['name'] for column in read_schema(file_path)['columns']]
+
+
+def table_columns(file_path: str):
+    """
+    Gives the names of the columns of a CSV file or a binary table, without loading the data
+    :param file_path: path of the file
+    :return: list with the names
+    """
+
+    if is_binary_table(file_path):
+        return column_names(file_path)
+
+    with open(file_path, 'r', newline='') as file:
+        return next(csv.reader(file))
+
+
+def write_table(file_path: str, columns: dict):
+    """
+    Writes a binary table
+    :param file_path: path of the file
+    :param columns: dictionary from the name of every column to a 1-D array with its values
+    :return: nothing
+    """
+
+    arrays = [np.ascontiguousarray(values) for values in columns.values()]
+    n_rows = len(arrays[0]) if arrays else 0
+    if any(len(values) != n_rows for values in arrays):
+        raise ValueError("All the columns must have the same length")
+
+    header, schema = _build_header(n_rows, list(columns), [values.dtype for values in arrays])
+    with open(file_path, 'wb') as file:
+        file.write(header)
+        for column, values in zip(schema['columns'], arrays):
+            file.seek(column['offset'])
+            file.write(values.tobytes())
+        file.truncate(_aligned(file.tell()))
+
+
+class TableWriter:
+    """
+    Writes a binary table whose rows arrive in chunks, without keeping them in memory. Every column is appended to
+    its own temporary file and the table is assembled when the writer is closed.
+    """
+
+    def __init__(self, file_path: str, names: List[str], dtype=np.float64):
+        """
+        Constructor
+        :param file_path: path of the file
+        :param names: names of the columns
+        :param dtype: dtype of every column
+        """
+
+        self.file_path = file_path
+        self.names = list(names)
+        self.dtype = np.dtype(dtype)
+        self.n_rows = 0
+        self.parts = [open(f"{file_path}.{i}.part", 'wb') for i in range(len(self.names))]
+
+    def append(self, chunk):
+        """
+        Appends rows to the table
+        :param chunk: (m, d) array with the rows
+        :return: nothing
+        """
+
+        chunk = np.asarray(chunk, dtype=self.dtype).reshape(-1, len(self.names))
+        for j, part in enumerate(self.parts):
+            part.write(np.ascontiguousarray(chunk[:, j]).tobytes())
+        self.n_rows += len(chunk)
+
+    def close(self):
+        """
+        Writes the header and copies the columns into the table
+        :return: nothing
+        """
+
+        header, schema = _build_header(self.n_rows, self.names, [self.dtype] * len(self.names))
+        with open(self.file_path, 'wb') as file:
+            file.write(header)
+            for column, part in zip(schema['columns'], self.parts):
+                part.close()
+                file.seek(column['offset'])
+                with open(part.name, 'rb') as source:
+                    shutil.copyfileobj(source, file, 1024 * 1024)
+                os.remove(part.name)
+            file.truncate(_aligned(file.tell()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for part in self.parts:
+                part.close()
+                os.remove(part.name)
+
+
+def load_columns(file_path: str, columns: List[str] = None):
+    """
+    Memory-maps the columns of a binary table
+    :param file_path: path of the file
+    :param columns: names of the columns. None loads every column
+    :return: dictionary from the name of every column to a read-only 1-D memory-mapped array
+    """
+
+    schema = read_schema(file_path)
+    by_name = {column['name']: column for column in schema['columns']}
+    names = list(by_name) if columns is None else list(columns)
+    missing = [name for name in names if name not in by_name]
+    if missing:
+        raise ValueError(f"Columns {missing} not found in {file_path}")
+
+    return {name: np.memmap(file_path, dtype=np.dtype(by_name[name]['dtype']), mode='r',
+                            offset=by_name[name]['offset'], shape=(schema['n_rows'],))
+            for name in names}
+
+
+def load_array(file_path: str, columns: List[str] = None, dtype=None):
+    """
+    Loads some columns of a binary table as an (n, d) array. When the columns are stored one after the other and
+    have the same dtype (which is the case for the outputs of the pipeline), the array is a zero-copy strided view
+    of the memory-mapped file. Otherwise the columns are copied into a new array
+    :param file_path: path of the file
+    :param columns: names of the columns. None loads every column
+    :param dtype: dtype of the result. A different dtype than the stored one makes a copy
+    :return: (n, d) array
+    """
+
+    schema = read_schema(file_path)
+    by_name = {column['name']: column for column in schema['columns']}
+    names = [column['name'] for column in schema['columns']] if columns is None else list(columns)
+    selected = [by_name[name] for name in names]
+    n_rows = schema['n_rows']
+
+    dtypes = {column['dtype'] for column in selected}
+    offsets = [column['offset'] for column in selected]
+    gaps = {b - a for a, b in zip(offsets, offsets[1:])}
+
+    if len(dtypes) == 1 and len(gaps) <= 1 and all(gap > 0 for gap in gaps):
+        stored = np.dtype(dtypes.pop())
+        stride = offsets[1] - offsets[0] if len(offsets) > 1 else n_rows * stored.itemsize
+        buffer = np.memmap(file_path, dtype=np.uint8, mode='r')
+        array = np.ndarray((n_rows, len(selected)), dtype=stored, buffer=buffer, offset=offsets[0],
+                           strides=(stored.itemsize, stride))
+        return array if dtype is None or np.dtype(dtype) == stored else array.astype(dtype)
+
+    loaded = load_columns(file_path, names)
+    return np.column_stack([loaded[name] for name in names]).astype(dtype or np.float64, copy=False)
+
+
+def iter_chunks(file_path: str, columns: List[str] = None, chunk_size: int = 100000):
+    """
+    Reads a CSV file or a binary table in chunks of rows, so a file larger than the memory can be processed.
+    A binary table is memory-mapped and only the current chunk is read from the disk
+    :param file_path: path of the file
+    :param columns: names of the columns. None loads every column
+    :param chunk_size: number of rows of every chunk
+    :return: generator of (m, d) float64 arrays
+    """
+
+    import pandas as pd
+
+    if is_binary_table(file_path):
+        data = load_array(file_path, columns)
+        for start in range(0, len(data), chunk_size):
+            yield np.array(data[start:start + chunk_size], dtype=np.float64)
+        return
+
+    for chunk in pd.read_csv(file_path, usecols=columns, chunksize=chunk_size):
+        yield (chunk if columns is None else chunk[list(columns)]).to_numpy(dtype=np.float64)
+
+
+def read_table(file_path: str, columns: List[str] = None, **csv_options):
+    """
+    Loads a CSV file or a binary table into a pandas DataFrame. For a binary table there is no parsing, the columns
+    are copied straight from the memory-mapped file
+    :param file_path: path of the file
+    :param columns: names of the columns. None loads every column
+    :param csv_options: extra options for `pd.read_csv`
+    :return: the DataFrame
+    """
+
+    import pandas as pd
+
+    if is_binary_table(file_path):
+        # The stages modify their DataFrame in place, so the columns are copied out of the read-only memory map
+        return pd.DataFrame({name: np.array(values) for name, values in load_columns(file_path, columns).items()})
+    return pd.read_csv(file_path, usecols=columns, **csv_options)
+
+
+def save_table(data, file_path: str):
+    """
+    Saves a pandas DataFrame as a binary table if the path ends with '.cbin', or as a CSV file otherwise
+    :param data: the DataFrame
+    :param file_path: path of the file
+    :return: nothing
+    """
+
+    if is_binary_path(file_path):
+        write_table(file_path, {name: data[name].to_numpy() for name in data.columns})
+    else:
+        data.to_csv(file_path, index=False)
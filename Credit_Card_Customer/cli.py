@@ -0,0 +1,325 @@
+"""
+This file is the command line entry point of the pipeline. Every stage of 'main.py' is a subcommand that reads its
+input file and writes its output file (with the same default names as 'main.py'), and 'full' runs every stage in
+memory with CreditCardPipeline ('pipeline.py'):
+
+    python cli.py convert --input DataInTxt --output data.csv
+    python cli.py preprocess
+    python cli.py pca --n-components 2
+    python cli.py inject-outliers
+    python cli.py hierarchical --max-clusters 10
+    python cli.py kmeans --k 3
+    python cli.py detect-outliers --outlier-percentile 99
+    python cli.py full --config config.json
+
+Only the modules (and so the libraries) of the chosen stage are imported, when the command runs: 'convert' does not
+import pandas, 'kmeans' and 'detect-outliers' do not import pandas, scipy or scikit-learn, and nothing imports
+matplotlib unless a plot is asked for. The plots are saved as images (`--plot`), without a window.
+
+Every parameter can also come from a JSON config file (`--config`), with the names of the options with underscores.
+The values at the top of the file apply to every command and the values under the name of a command only to it. The
+options given on the command line win over the file, e.g.:
+    {"normalize_columns": ["Avg_Credit_Limit", "Total_Credit_Cards"], "seed": 0, "kmeans": {"k": 4}}
+
+`--trace trace.json` records the stages with 'instrumentation.py' and writes a Chrome trace, and `--profile` samples
+the stacks of the named spans (e.g. `--profile kmeans,hierarchical`). The summary that is printed at the end also has
+the build and query times of the nearest neighbor backends ('neighbors.py').
+"""
+
+import argparse
+import json
+import sys
+
+
+
+def convert(args):
+    import read_data
+
+    read_data.DataProcessor(args.input, args.output).process()
+
+
+def preprocess(args):
+    import preprocess
+
+    preprocessor = preprocess.CreditCardDataPreProcessor(args.input, float32=args.float32)
+    preprocessor.load_data(drop_ids=True)
+    preprocessor.preprocess(args.normalize_columns or preprocess.NORMALIZE_COLUMNS)
+    preprocessor.save_data(args.output)
+    if args.scaler is not None:
+        preprocessor.save_scaler(args.scaler)
+    print(f"Preprocessed data saved to {args.output}")
+
+
+def pca(args):
+    import pca_method
+
+    processor = pca_method.PCAProcessor(n_components=args.n_components, mode=args.mode, random_state=args.seed)
+    if args.mode == 'incremental':
+        processor.fit_transform_file(args.input, args.output)
+    else:
+        processor.fit_transform(file_path=args.input, output_path=args.output)
+    print("Information conserved by PCA: {:.2f}%".format(processor.get_information_conserved() * 100))
+    if args.model is not None:
+        processor.save_model(args.model)
+    if args.plot is not None:
+        import plot
+
+        csv_plot = plot.CSV2DPlot(args.output, 'PCA1', 'PCA2')
+        csv_plot.load_data()
+        csv_plot.plot_data(args.plot)
+
+
+def inject_outliers(args):
+    import add_outliers
+
+    handler = add_outliers.OutlierHandler(args.input, args.x_column, args.y_column, seed=args.seed)
+    handler.load_data()
+    handler.add_outliers(num_outliers=args.num_outliers, multiplier=args.multiplier)
+    handler.save_data(args.output)
+    print(f"{args.num_outliers} outliers added, data saved to {args.output}")
+    if args.plot is not None:
+        handler.plot_data(args.plot)
+
+
+def hierarchical(args):
+    import hierarchical_clustering
+
+    clustering = hierarchical_clustering.HierarchicalClustering(linkage_criterion=args.linkage,
+                                                                max_memory_mb=args.max_memory_mb, seed=args.seed)
+    clustering.load_data(args.input)
+    clustering.run_hierarchical_clustering()
+    optimal_clusters = clustering.find_optimal_clusters(max_clusters=args.max_clusters, criterion=args.criterion,
+                                                        sample_size=args.sample_size)
+    print(f"Optimal number of clusters: {optimal_clusters}")
+    clustering.save_data(args.output)
+    if args.plot is not None:
+        clustering.plot_data(args.x_column, args.y_column, args.plot)
+
+
+def kmeans(args):
+    import numpy as np
+    import kMeans
+
+    model = kMeans.VectorizedKMeans(args.k, args.input, seed=args.seed, n_init=args.n_init, algorithm=args.algorithm)
+    result = model.run(args.max_iterations)
+    print(f"k-means with k={args.k}: inertia {result['inertia']:.4f} after {result['n_iterations']} iterations")
+    np.savetxt(args.centroids, model.centroid_array, delimiter=',', comments='',
+               header=','.join(f'Centroid{j + 1}' for j in range(model.centroid_array.shape[1])))
+    print(f"Centroids saved to {args.centroids}")
+    if args.plot is not None:
+        model.plot_results(args.plot)
+
+
+def detect_outliers(args):
+    import numpy as np
+
+    if args.method == 'centroid':
+        import find_outliers
+
+        centroids = np.loadtxt(args.centroids, delimiter=',', skiprows=1, ndmin=2)
+        detector = find_outliers.OutlierDetector(len(centroids), args.outlier_percentile, file_path=args.input)
+    else:
+        import density_outliers
+
+        centroids = None
+        detector = density_outliers.DensityOutlierDetector(args.method, args.outlier_percentile, file_path=args.input,
+                                                           seed=args.seed)
+    detector.load_data()
+    inliers, outliers, centroids = detector.split_the_data(centroids)
+    print(f"{len(outliers)} outliers over the threshold {detector.threshold:.4f}")
+
+    if args.output is not None:
+        top = detector.top_outliers()
+        np.savetxt(args.output, np.column_stack([top, detector.distances[top]]), delimiter=',',
+                   header='row,score', comments='', fmt=['%d', '%.17g'])
+        print(f"Outliers saved to {args.output}")
+    if args.plot is not None:
+        detector.plot(inliers, outliers, centroids, args.plot)
+
+
+def full(args):
+    import pipeline
+    import stage_cache
+
+    cache = stage_cache.StageCache(args.cache_dir) if args.cache_dir is not None else None
+    runner = pipeline.CreditCardPipeline(
+        input_file=args.input, normalize_columns=args.normalize_columns, n_components=args.n_components,
+        num_outliers=args.num_outliers, multiplier=args.multiplier, linkage_criterion=args.linkage,
+        max_clusters=args.max_clusters, max_iterations=args.max_iterations,
+        outlier_percentile=args.outlier_percentile, seed=args.seed, save_intermediate=args.save_intermediate,
+        output_dir=args.output_dir, intermediate_format=args.intermediate_format, cache=cache,
+        max_memory_mb=args.max_memory_mb, silhouette_sample_size=args.sample_size, plot_dir=args.plot_dir)
+    results = runner.run()
+    print(f"{len(results['outliers'])} outliers found")
+    if args.model is not None:
+        results['model_bundle'].save(args.model)
+        print(f"Model saved to {args.model}")
+
+
+def build_parser():
+    """
+    :return: tuple of (the ArgumentParser, dictionary from every command to its subparser)
+    """
+
+    parser = argparse.ArgumentParser(description="Clustering and outlier detection of the credit card customers")
+    parser.add_argument('--config', help="JSON file with the parameters")
+    parser.add_argument('--trace', help="write a Chrome trace of the stages to this file")
+    parser.add_argument('--profile', type=lambda names: names.split(','),
+                        help="sample the stacks of these spans, separated by commas (needs --trace)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def command(name, function, help_text, input_file, output_file=None):
+        subparser = commands.add_parser(name, help=help_text)
+        subparser.set_defaults(function=function)
+        subparser.add_argument('--input', default=input_file, help="input file (default: %(default)s)")
+        if output_file is not None:
+            subparser.add_argument('--output', default=output_file, help="output file (default: %(default)s)")
+        return subparser
+
+    def add_seed(subparser):
+        subparser.add_argument('--seed', type=int, default=None, help="seed, so that a run can be reproduced")
+
+    def add_plot(subparser):
+        subparser.add_argument('--plot', help="save the plot of the stage to this image file")
+
+    def add_normalize_columns(subparser):
+        # The default (preprocess.NORMALIZE_COLUMNS) is applied by the command, so pandas is not imported here
+        subparser.add_argument('--normalize-columns', nargs='+',
+                               help="the columns that are normalised with z-score (default: the five features)")
+
+    def add_clustering(subparser):
+        subparser.add_argument('--linkage', default='ward', help="linkage criterion (default: %(default)s)")
+        subparser.add_argument('--max-clusters', type=int, default=10)
+        subparser.add_argument('--max-memory-mb', type=float, default=None,
+                               help="memory ceiling of the linkage, over it the linkage runs on micro-clusters")
+        subparser.add_argument('--sample-size', type=int, default=None,
+                               help="compute the silhouette on a stratified sample of this size")
+
+    subparser = command('convert', convert, "convert the txt data to a CSV file (or binary table)", 'DataInTxt',
+                        'data.csv')
+
+    subparser = command('preprocess', preprocess, "normalise the data, fill the missing values and drop the IDs",
+                        'data.csv', 'preprocessed_data.csv')
+    add_normalize_columns(subparser)
+    subparser.add_argument('--float32', action='store_true', help="keep the features as float32")
+    subparser.add_argument('--scaler', help="save the fitted statistics to this JSON file")
+
+    subparser = command('pca', pca, "reduce the dimensions with PCA", 'preprocessed_data.csv', 'pca_reduced_data.csv')
+    subparser.add_argument('--n-components', type=int, default=2)
+    subparser.add_argument('--mode', default='full', choices=['full', 'randomized', 'incremental'])
+    subparser.add_argument('--model', help="save the fitted PCA to this .npz file")
+    add_seed(subparser)
+    add_plot(subparser)
+
+    subparser = command('inject-outliers', inject_outliers, "add synthetic outliers", 'pca_reduced_data.csv',
+                        'output_with_outliers.csv')
+    subparser.add_argument('--num-outliers', type=int, default=5)
+    subparser.add_argument('--multiplier', type=float, default=4)
+    subparser.add_argument('--x-column', default='PCA1')
+    subparser.add_argument('--y-column', default='PCA2')
+    add_seed(subparser)
+    add_plot(subparser)
+
+    subparser = command('hierarchical', hierarchical, "find the optimal number of clusters",
+                        'output_with_outliers.csv', 'output_with_clusters.csv')
+    add_clustering(subparser)
+    subparser.add_argument('--criterion', default='silhouette',
+                           choices=['silhouette', 'calinski_harabasz', 'davies_bouldin'])
+    subparser.add_argument('--x-column', default='PCA1')
+    subparser.add_argument('--y-column', default='PCA2')
+    add_seed(subparser)
+    add_plot(subparser)
+
+    subparser = command('kmeans', kmeans, "run the k-means", 'output_with_outliers.csv')
+    subparser.add_argument('--k', type=int, default=None, help="number of clusters (required)")
+    subparser.add_argument('--max-iterations', type=int, default=100)
+    subparser.add_argument('--n-init', type=int, default=1, help="number of restarts")
+    subparser.add_argument('--algorithm', default='lloyd', choices=['lloyd', 'hamerly'])
+    subparser.add_argument('--centroids', default='kmeans_centroids.csv', help="output file of the centroids")
+    add_seed(subparser)
+    add_plot(subparser)
+
+    subparser = command('detect-outliers', detect_outliers, "find the outliers", 'output_with_outliers.csv', None)
+    subparser.add_argument('--output', help="save the outliers (row and score, the farthest first) to this CSV file")
+    subparser.add_argument('--outlier-percentile', type=float, default=99)
+    subparser.add_argument('--method', default='centroid', choices=['centroid', 'knn', 'lof', 'isolation_forest'],
+                           help="'centroid' uses the centroids of the kmeans command")
+    subparser.add_argument('--centroids', default='kmeans_centroids.csv', help="the centroids of the kmeans command")
+    add_seed(subparser)
+    add_plot(subparser)
+
+    subparser = command('full', full, "run every stage in memory", 'DataInTxt')
+    add_normalize_columns(subparser)
+    subparser.add_argument('--n-components', type=int, default=2)
+    subparser.add_argument('--num-outliers', type=int, default=5)
+    subparser.add_argument('--multiplier', type=float, default=4)
+    add_clustering(subparser)
+    subparser.add_argument('--max-iterations', type=int, default=100)
+    subparser.add_argument('--outlier-percentile', type=float, default=99)
+    subparser.add_argument('--save-intermediate', action='store_true', help="also write the file of every stage")
+    subparser.add_argument('--output-dir', default='.', help="directory of the intermediate files")
+    subparser.add_argument('--intermediate-format', default='csv', choices=['csv', 'binary'])
+    subparser.add_argument('--plot-dir', help="save the plots of every stage as images in this directory")
+    subparser.add_argument('--cache-dir', help="cache the outputs of the stages in this directory")
+    subparser.add_argument('--model', help="save the model bundle (see 'scoring.py') to this .npz file")
+    add_seed(subparser)
+
+    return parser, commands.choices
+
+
+def parse_args(argv=None):
+    """
+    Parses the arguments. The values of the config file become the defaults of the command, so the options of the
+    command line win over them
+    :param argv: the arguments, None uses sys.argv
+    :return: the parsed arguments
+    """
+
+    parser, commands = build_parser()
+    args = parser.parse_args(argv)
+    if args.config is None:
+        return args
+
+    with open(args.config, 'r') as file:
+        config = json.load(file)
+
+    # The values at the top apply to the commands that have them, the values of the command must all be known
+    known = set(vars(args))
+    section = config.get(args.command, {})
+    unknown = [name for name in section if name not in known]
+    if unknown:
+        parser.error(f"Unknown parameters for '{args.command}' in {args.config}: {unknown}")
+
+    values = {name: value for name, value in config.items() if not isinstance(value, dict) and name in known}
+    values.update(section)
+    commands[args.command].set_defaults(**values)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'kmeans' and args.k is None:
+        print("The number of clusters is missing. Use --k or a config file (e.g. the result of 'hierarchical')")
+        return 2
+
+    if args.trace is None:
+        args.function(args)
+        return 0
+
+    import instrumentation
+
+    instrumentation.enable(profile=args.profile)
+    with instrumentation.span(f'cli.{args.command}'):
+        args.function(args)
+    instrumentation.write_chrome_trace(args.trace)
+    if args.profile:
+        instrumentation.write_folded(args.trace + '.folded')
+    instrumentation.report()
+    if 'neighbors' in sys.modules:      # Only the stages that search for neighbors import it
+        print("Nearest neighbor searches:")
+        sys.modules['neighbors'].report_timings(indent='    ')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
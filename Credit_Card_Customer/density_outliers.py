@@ -0,0 +1,184 @@
+"""
+This class finds outliers from the density of the data around every point, without the centroids of the k-means.
+It has the same `run` / `split_the_data` interface as OutlierDetector ('find_outliers.py'), and the centroids and
+the labels are optional (and ignored), so the two can be swapped. The methods are:
+    'knn': the score of a point is the distance to its n_neighbors-th nearest neighbor
+    'lof': the Local Outlier Factor (Breunig et al., 2000). The density of a point (the inverse of the mean
+           reachability distance to its neighbors) is compared with the density of its neighbors, so a point between
+           two clusters, or at the edge of a sparse cluster, gets a high score even when a centroid is close to it
+    'isolation_forest': the isolation forest of scikit-learn. The score is how few random splits isolate a point
+As in OutlierDetector, the points whose score is over the `outlier_percentile` percentile of the scores are outliers.
+
+The neighbors are found with a NeighborIndex ('neighbors.py') of the points, which picks a KD-tree for large data in
+few dimensions. The points are queried in chunks by a pool of threads (the trees and NumPy release the GIL, and the
+threads share the index without copying it). The neighbors of every point are kept, so the memory is
+n * (n_neighbors + 1) * 16 bytes.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
+
+import instrumentation
+import neighbors
+import outlier_threshold
+from find_outliers import OutlierDetector
+
+METHODS = ('knn', 'lof', 'isolation_forest')
+
+
+def parallel_kneighbors(index: neighbors.NeighborIndex, points: np.ndarray, n_neighbors: int, chunk_size: int,
+                        n_jobs: int = None):
+    """
+    Finds the nearest neighbors of the points in chunks, with a pool of threads
+    :param index: the NeighborIndex
+    :param points: (n, d) array with the points
+    :param n_neighbors: the number of neighbors
+    :param chunk_size: number of points of every chunk
+    :param n_jobs: number of threads. None uses every core
+    :return: tuple of ((n, n_neighbors) distances, (n, n_neighbors) indices)
+    """
+
+    distances = np.empty((len(points), n_neighbors))
+    indices = np.empty((len(points), n_neighbors), dtype=np.intp)
+
+    def query(start: int):
+        chunk_distances, chunk_indices = index.kneighbors(points[start:start + chunk_size], n_neighbors)
+        distances[start:start + chunk_size] = chunk_distances
+        indices[start:start + chunk_size] = chunk_indices
+
+    starts = range(0, len(points), chunk_size)
+    workers = min(n_jobs or os.cpu_count() or 1, len(starts))
+    if workers <= 1:
+        for start in starts:
+            query(start)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(query, starts))
+    return distances, indices
+
+
+class DensityOutlierDetector(OutlierDetector):
+    def __init__(self, method: str = 'lof', outlier_percentile: float = 99, n_neighbors: int = 20,
+                 file_path: str = None, columns: List[str] = None, data: np.ndarray = None, chunk_size: int = 16384,
+                 n_jobs: int = None, neighbor_backend: str = 'auto', n_estimators: int = 100, seed: int = None):
+        """
+        Constructor
+        :param method: 'knn', 'lof' or 'isolation_forest'
+        :param outlier_percentile: percentile threshold of the scores to identify outliers
+        :param n_neighbors: number of neighbors of the 'knn' and 'lof' methods
+        :param file_path: the file that the data are stored
+        :param columns: names of the columns (features) to use. None uses every column
+        :param data: (n, d) array with the data, if they are already loaded. Then the file is not read at all
+        :param chunk_size: number of points that are queried at once
+        :param n_jobs: number of threads (and of jobs of the isolation forest). None uses every core
+        :param neighbor_backend: 'auto', 'brute', 'kd_tree' or 'ball_tree' (see 'neighbors.py')
+        :param n_estimators: number of trees of the isolation forest
+        :param seed: seed of the isolation forest, so that a run can be reproduced
+        """
+
+        if method not in METHODS:
+            raise ValueError(f"Unknown method '{method}'. Use 'knn', 'lof' or 'isolation_forest'")
+
+        super().__init__(None, outlier_percentile, file_path=file_path, columns=columns, data=data,
+                         chunk_size=chunk_size, neighbor_backend=neighbor_backend)
+        self.method = method
+        self.n_neighbors = n_neighbors
+        self.n_jobs = n_jobs
+        self.n_estimators = n_estimators
+        self.seed = seed
+        self.scores = None
+
+    @instrumentation.traced('density_outliers.neighbors')
+    def neighbors_of_points(self):
+        """
+        Finds the n_neighbors nearest neighbors of every point, without the point itself
+        :return: tuple of ((n, n_neighbors) distances, (n, n_neighbors) indices)
+        """
+
+        n_neighbors = min(self.n_neighbors, len(self.data) - 1)
+        instrumentation.add_rows(len(self.data))
+        index = neighbors.NeighborIndex(self.data, self.neighbor_backend, chunk_size=self.chunk_size)
+        distances, indices = parallel_kneighbors(index, self.data, n_neighbors + 1, self.chunk_size, self.n_jobs)
+
+        # The nearest neighbor of a point is itself, at distance 0 (or a duplicate of it, which is the same)
+        return distances[:, 1:], indices[:, 1:]
+
+    def knn_scores(self):
+        """
+        :return: the distance of every point to its n_neighbors-th nearest neighbor
+        """
+
+        distances, _ = self.neighbors_of_points()
+        return distances[:, -1]
+
+    def lof_scores(self):
+        """
+        :return: the Local Outlier Factor of every point. Around 1 inside a cluster, much larger for an outlier
+        """
+
+        distances, indices = self.neighbors_of_points()
+        k_distances = distances[:, -1]
+
+        # The reachability distance from a point to a neighbor is at least the k-distance of the neighbor
+        reachability = np.maximum(distances, k_distances[indices])
+        density = 1.0 / (reachability.mean(axis=1) + 1e-10)       # Duplicated points would have infinite density
+        return density[indices].mean(axis=1) / density
+
+    def isolation_forest_scores(self):
+        """
+        :return: the anomaly score of every point by the isolation forest. Higher for the outliers
+        """
+
+        from sklearn.ensemble import IsolationForest
+
+        forest = IsolationForest(n_estimators=self.n_estimators, random_state=self.seed, n_jobs=self.n_jobs)
+        forest.fit(self.data)
+        return -forest.score_samples(self.data)
+
+    @instrumentation.traced('density_outliers.outliers_detection')
+    def outliers_detection(self, centroids=None, labels: np.ndarray = None):
+        """
+        Detect outliers based on the scores of the method.
+        :param centroids: ignored, the method does not need centroids
+        :param labels: ignored
+        :return: array of outlier indices.
+        """
+
+        if len(self.data) == 0:
+            raise ValueError("Data is empty. Load data before trying to detect outliers")
+
+        if self.method == 'knn':
+            self.scores = self.knn_scores()
+        elif self.method == 'lof':
+            self.scores = self.lof_scores()
+        else:
+            self.scores = self.isolation_forest_scores()
+
+        self.distances = self.scores      # So top_outliers sorts them by score
+        self.threshold = outlier_threshold.exact_threshold(self.scores, self.outlier_percentile)
+        self.outlier_mask = self.scores > self.threshold
+        return np.flatnonzero(self.outlier_mask)
+
+    def split_the_data(self, centroids=None, labels: np.ndarray = None):
+        """
+        Splits the data to inliers and outliers
+        :param centroids: optional centroids, they are only returned (e.g. for the plot)
+        :param labels: ignored
+        :return: Tuple of (inliers, outliers, centroids) where inliers and outliers are arrays of indices
+        """
+
+        return super().split_the_data(centroids, labels)
+
+    def run(self, centroids=None, labels: np.ndarray = None, output_path: str = None):
+        """
+        Runs the class methods. The file is read only if no data were given to the constructor
+        :param centroids: optional centroids, they are only plotted
+        :param labels: ignored
+        :param output_path: if given, the plot is saved to this image file instead of being shown
+        :return: nothing
+        """
+
+        super().run(centroids, labels, output_path)
@@ -2,94 +2,194 @@
 This class finds the outliers that were added at the 'add_outliers.py' file.
 It uses the centroids of the clusters found by the k-means algorithm.
 
+The data are kept in a NumPy array and the distances of all the points to their nearest centroid are computed at once,
+so the inliers and the outliers are boolean masks over the array and not lists that have to be searched.
+The threshold is found by partial selection ('outlier_threshold.py'), and `streaming_detection` runs over a file
+larger than the memory in one pass, with an approximate threshold from a quantile sketch.
+
 At the end, plot data with the possible outliers having a red colour
 """
 
-import csv
+from typing import List
+
 import numpy as np
-import matplotlib.pyplot as plt
+
+import binary_store
+import instrumentation
+import neighbors
+import outlier_threshold
+from kMeans import column_indices
 
 class OutlierDetector:
-    def __init__(self, clusters: int, outlier_percentile: float, file_path: str):
+    def __init__(self, clusters: int, outlier_percentile: float, file_path: str = None, columns: List[str] = None,
+                 data: np.ndarray = None, chunk_size: int = 65536, neighbor_backend: str = 'auto'):
         """
         Constructor
         :param clusters: int that contains the number of clusters for K-Means.
         :param outlier_percentile: float that contains percentile threshold to identify outliers.
         :param file_path: string that contains the file that the data are stored
+        :param columns: names of the columns (features) to use, any number of them. They must be the ones that the
+                        k-means ran on. None uses every column
+        :param data: (n, d) array with the data, if they are already loaded (e.g. `VectorizedKMeans.data`).
+                     Then the file is not read at all
+        :param chunk_size: number of points whose distances to the centroids are computed at once
+        :param neighbor_backend: how the nearest centroids are found, 'brute', 'kd_tree', 'ball_tree' or 'auto' (see
+                                 'neighbors.py')
         """
 
         self.clusters = clusters
         self.outlier_percentile = outlier_percentile
-        self.data = []
+        self.data = np.empty((0, 0)) if data is None else np.ascontiguousarray(data, dtype=np.float64)
         self.file_path = file_path
-
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.neighbor_backend = neighbor_backend
+        self.distances = None
+        self.threshold = None
+        self.outlier_mask = None
+
+    @instrumentation.traced('find_outliers.load_data')
     def load_data(self):
         """
-        Loads data from the scv file 'output_with_outliers'
+        Loads data from the scv file 'output_with_outliers'. A binary table is memory-mapped, without copying it
         :return: nothing
         """
 
-        with open(self.file_path, 'r') as file:
-            reader = csv.reader(file)
-            next(reader)
-            for row in reader:
-                self.data.append([float(row[0]), float(row[1])])
+        if binary_store.is_binary_table(self.file_path):
+            self.data = binary_store.load_array(self.file_path, self.columns, dtype=np.float64)
+            return
 
-    def outliers_detection(self, centroids):
+        indices = column_indices(self.file_path, self.columns)
+        data = np.loadtxt(self.file_path, delimiter=',', skiprows=1, usecols=indices, dtype=np.float64, ndmin=2)
+        self.data = np.ascontiguousarray(data)
+
+    def nearest_centroid_distances(self, centroids, labels: np.ndarray = None):
+        """
+        Calculates the distance of every point to its nearest centroid
+        :param centroids: List or array of cluster centroids
+        :param labels: the cluster of every point (e.g. `VectorizedKMeans.labels`). When it is given, only the distance
+                       to that centroid is computed
+        :return: array with the distances
+        """
+
+        centroids = np.asarray(centroids, dtype=np.float64)
+        if labels is not None:
+            differences = self.data - centroids[labels]
+            return np.sqrt(np.einsum('ij,ij->i', differences, differences))
+
+        index = neighbors.NeighborIndex(centroids, self.neighbor_backend, chunk_size=self.chunk_size)
+        _, distances = index.nearest(self.data)
+        return distances
+
+    @instrumentation.traced('find_outliers.outliers_detection')
+    def outliers_detection(self, centroids, labels: np.ndarray = None):
         """
         Detect outliers based on the distances to the centroids.
         :param centroids: List of cluster centroids
-        :return: List of outlier indices.
+        :param labels: optional cluster of every point, so only the distance to that centroid is computed
+        :return: array of outlier indices.
         """
 
-        if not self.data:
+        if len(self.data) == 0:
             raise ValueError("Data is empty. Load data before trying to detect outliers")
 
-        if not centroids:
+        if centroids is None or len(centroids) == 0:
             raise ValueError("Centroids are empty. Trying running k-means to detect the centroids before")
 
-
         # Compute distances to nearest centroid
-        distances = []
-        for point in self.data:
-            distance_to_centroids = [np.linalg.norm(np.array(point) - np.array(centroid)) for centroid in centroids]    # Calculates the Euclidean distance of every point with every centroid
-            distances.append(min(distance_to_centroids))    # It keeps only the distance to the closed centroid
+        instrumentation.add_rows(len(self.data))
+        self.distances = self.nearest_centroid_distances(centroids, labels)
 
-        # Determine the threshold for outliers
-        threshold = np.percentile(distances, self.outlier_percentile)
+        # Determine the threshold for outliers, by partial selection instead of a full sort
+        self.threshold = outlier_threshold.exact_threshold(self.distances, self.outlier_percentile)
 
         # Identify outliers
         # The points with distance to the closest centroids greater than the threshold are considered outliers
-        outliers = [i for i, distance in enumerate(distances) if distance > threshold]
+        self.outlier_mask = self.distances > self.threshold
+
+        return np.flatnonzero(self.outlier_mask)
+
+    def top_outliers(self, count: int = None):
+        """
+        Gives the outliers of the last detection sorted by their distance, the farthest first
+        :param count: how many of them. None gives every outlier
+        :return: array of outlier indices
+        """
+
+        if self.outlier_mask is None:
+            raise ValueError("No detection yet. Run outliers_detection() first")
+
+        n_outliers = int(np.count_nonzero(self.outlier_mask))
+        return outlier_threshold.top_outliers(self.distances, n_outliers if count is None else min(count, n_outliers))
+
+    @instrumentation.traced('find_outliers.streaming_detection')
+    def streaming_detection(self, centroids, file_path: str = None, chunk_size: int = 100000):
+        """
+        Detects the outliers of a file in one pass, chunk by chunk, without loading it: the distances of every chunk
+        to the nearest centroid update a StreamingThreshold ('outlier_threshold.py'), which keeps the threshold
+        estimate and the candidate outliers. The threshold is approximate (within the error of a quantile sketch)
+        :param centroids: List or array of cluster centroids
+        :param file_path: the CSV file (or binary table). None uses the file of the constructor
+        :param chunk_size: number of rows that are read at once
+        :return: array of outlier indices, the farthest first
+        """
 
+        if centroids is None or len(centroids) == 0:
+            raise ValueError("Centroids are empty. Trying running k-means to detect the centroids before")
+
+        index = neighbors.NeighborIndex(centroids, self.neighbor_backend, chunk_size=self.chunk_size)
+        streaming = outlier_threshold.StreamingThreshold(self.outlier_percentile)
+        for chunk in binary_store.iter_chunks(file_path or self.file_path, self.columns, chunk_size):
+            _, distances = index.nearest(chunk)
+            streaming.update(distances)
+            instrumentation.add_rows(len(chunk))
+
+        self.threshold = streaming.threshold()
+        outliers, _ = streaming.outliers()
         return outliers
 
-    def split_the_data(self, centroids):
+    def split_the_data(self, centroids, labels: np.ndarray = None):
         """
         Use precomputed centroids from the k-means algorithm to detect outliers. It splits the data to inliers, outliers and centroids
         :param centroids: List that contains precomputed centroids
-        :return: Tuple of (inliers, outliers, centroids)
+        :param labels: optional cluster of every point found by the k-means algorithm
+        :return: Tuple of (inliers, outliers, centroids) where inliers and outliers are arrays of indices
         """
 
-        if not self.data:
+        if len(self.data) == 0:
             raise ValueError("Data is empty. Load data before processing.")
 
         # Detect outliers and separates them from the inliers
-        outliers = self.outliers_detection(centroids)
-        inliers = [i for i in range(len(self.data)) if i not in outliers]
+        outliers = self.outliers_detection(centroids, labels)
+        inliers = np.flatnonzero(~self.outlier_mask)
 
         return inliers, outliers, centroids
 
-    def plot(self, inliers, outliers, centroids):
+    def plot(self, inliers, outliers, centroids, output_path: str = None):
         """
-        Plot the data, highlighting inliers and outliers.
+        Plot the data, highlighting inliers and outliers. With more than two dimensions only the first two are plotted.
         :param inliers: List of inlier indices.
         :param outliers: List of outlier indices.
         :param centroids: List of cluster centroids.
+        :param output_path: if given, the plot is saved to this image file without a window ('headless_plot.py'), and
+                            large data are drawn as a density raster with the outliers and the centroids as markers
         :return: nothing
         """
 
-        X = np.array(self.data)
+        X = self.data
+        if output_path is not None:
+            import headless_plot
+
+            markers = [{'points': X[outliers, :2], 'label': 'Outliers'}]
+            if centroids is not None and len(centroids):
+                markers.append({'points': np.asarray(centroids)[:, :2], 'label': 'Centroids', 'color': 'yellow',
+                                'marker': 'X', 'size': 200})
+            headless_plot.save_scatter(output_path, X[inliers, 0], X[inliers, 1], markers=markers,
+                                       title='K-Means Clustering with Outliers', x_label='PCA1', y_label='PCA2')
+            return
+
+        import matplotlib.pyplot as plt
+
         plt.figure(figsize=(8, 6))
 
         # Plot inliers
@@ -98,9 +198,10 @@ class OutlierDetector:
         # Plot outliers
         plt.scatter(X[outliers, 0], X[outliers, 1], c='red', label='Outliers', edgecolor='black', s=100)
 
-        # Plot centroids
-        plt.scatter(np.array(centroids)[:, 0], np.array(centroids)[:, 1], c='yellow', label='Centroids', marker='X',
-                    s=200)
+        # Plot centroids (the density-based detectors have none)
+        if centroids is not None and len(centroids):
+            plt.scatter(np.array(centroids)[:, 0], np.array(centroids)[:, 1], c='yellow', label='Centroids',
+                        marker='X', s=200)
 
         # Add labels and legend
         plt.title('K-Means Clustering with Outliers')
@@ -110,13 +211,16 @@ class OutlierDetector:
         plt.grid(True)
         plt.show()
 
-    def run(self, centroids):
+    def run(self, centroids, labels: np.ndarray = None, output_path: str = None):
         """
-        Runs the class methods
+        Runs the class methods. The file is read only if no data were given to the constructor
         :param centroids: List that contains the centroid points that the k-means algorithm found
+        :param labels: optional cluster of every point that the k-means algorithm found
+        :param output_path: if given, the plot is saved to this image file instead of being shown
         :return: nothing
         """
 
-        self.load_data()
-        inliers, outliers, centroids = self.split_the_data(centroids)
-        self.plot(inliers, outliers, centroids)
\ No newline at end of file
+        if len(self.data) == 0:
+            self.load_data()
+        inliers, outliers, centroids = self.split_the_data(centroids, labels)
+        self.plot(inliers, outliers, centroids, output_path)
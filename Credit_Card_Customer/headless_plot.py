@@ -0,0 +1,155 @@
+"""
+This file draws the scatter plots of the pipeline into image files, without a window, for unattended runs and for
+data with millions of points. The plot methods of the classes use it when they are given an `output_path`.
+
+The figure is drawn by the Agg renderer of matplotlib directly (a Figure with a FigureCanvasAgg, not pyplot), so it
+needs no display and leaves no open figures behind. Drawing a marker per point takes minutes for millions of points,
+so above `max_scatter_points` the points are aggregated into a density raster instead:
+    every point gets the pixel that it falls in, and one `np.bincount` over (cluster, pixel) counts the points of
+    every cluster in every pixel, so all the cluster layers are built in one pass over the data
+    the color of a pixel is the mix of the colors of the clusters by their counts, and its opacity grows with the
+    logarithm of the number of points, so both the dense cores and the sparse edges stay visible
+The outliers and the centroids are few, so they are always drawn as individual markers on top of the raster.
+"""
+
+import numpy as np
+import matplotlib
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import to_rgba
+from matplotlib.figure import Figure
+from matplotlib.patches import Patch
+
+
+def cluster_colors(n_clusters: int):
+    """
+    :return: (n_clusters, 4) array with the RGBA color of every cluster, from the 'tab10' colormap
+    """
+
+    colormap = matplotlib.colormaps['tab10']
+    return np.array([colormap(i % colormap.N) for i in range(n_clusters)])
+
+
+def data_extent(x: np.ndarray, y: np.ndarray, markers=None):
+    """
+    :return: (x_min, x_max, y_min, y_max) of the points and the markers, with a small margin
+    """
+
+    marked = [np.asarray(marker['points'], dtype=np.float64).reshape(-1, 2) for marker in markers or []]
+    xs = np.concatenate([x] + [points[:, 0] for points in marked])
+    ys = np.concatenate([y] + [points[:, 1] for points in marked])
+    x_min, x_max, y_min, y_max = xs.min(), xs.max(), ys.min(), ys.max()
+    x_margin = 0.02 * (x_max - x_min) or 1.0
+    y_margin = 0.02 * (y_max - y_min) or 1.0
+    return x_min - x_margin, x_max + x_margin, y_min - y_margin, y_max + y_margin
+
+
+def density_raster(x: np.ndarray, y: np.ndarray, codes: np.ndarray, n_clusters: int, extent, shape=(600, 800)):
+    """
+    Counts the points of every cluster in every pixel, with one pass over the points
+    :param x: the x of every point
+    :param y: the y of every point
+    :param codes: the cluster of every point, 0 .. n_clusters - 1
+    :param n_clusters: the number of clusters
+    :param extent: (x_min, x_max, y_min, y_max) of the raster
+    :param shape: (height, width) of the raster in pixels
+    :return: (n_clusters, height, width) array with the counts
+    """
+
+    height, width = shape
+    x_min, x_max, y_min, y_max = extent
+    columns = np.clip(((x - x_min) / (x_max - x_min) * width).astype(np.intp), 0, width - 1)
+    rows = np.clip(((y - y_min) / (y_max - y_min) * height).astype(np.intp), 0, height - 1)
+    keys = (codes * height + rows) * width + columns
+    return np.bincount(keys, minlength=n_clusters * height * width).reshape(n_clusters, height, width)
+
+
+def shade(counts: np.ndarray, colors: np.ndarray, min_alpha: float = 0.25):
+    """
+    Turns the counts of the clusters into an RGBA image
+    :param counts: (n_clusters, height, width) array with the counts
+    :param colors: (n_clusters, 4) array with the color of every cluster
+    :param min_alpha: the opacity of a pixel with one point
+    :return: (height, width, 4) array
+    """
+
+    total = counts.sum(axis=0)
+    occupied = total > 0
+    image = np.zeros(total.shape + (4,))
+    mixed = np.tensordot(colors[:, :3], counts, axes=([0], [0]))        # (3, height, width)
+    image[..., :3] = np.moveaxis(mixed, 0, -1) / np.maximum(total, 1)[..., np.newaxis]
+
+    density = np.log1p(total) / np.log1p(max(int(total.max()), 1))
+    image[..., 3] = np.where(occupied, min_alpha + (1 - min_alpha) * density, 0.0)
+    return image
+
+
+def save_scatter(output_path: str, x, y, labels=None, label_names=None, markers=None, title: str = '',
+                 x_label: str = '', y_label: str = '', max_scatter_points: int = 20000, shape=(600, 800),
+                 figsize=(8, 6), dpi: int = 100):
+    """
+    Draws the points, colored by their cluster, and saves the figure to a file
+    :param output_path: the image file, its extension gives the format (e.g. '.png', '.svg')
+    :param x: the x of every point
+    :param y: the y of every point
+    :param labels: the cluster of every point (any values). None draws every point in one color
+    :param label_names: function from a cluster value to its name in the legend. None uses 'Cluster <value>'
+    :param markers: list of dictionaries with 'points' ((m, 2) array) and optionally 'label', 'color', 'marker',
+                    'size', drawn as individual markers on top (e.g. the outliers and the centroids)
+    :param title: the title of the figure
+    :param x_label: the label of the x axis
+    :param y_label: the label of the y axis
+    :param max_scatter_points: with more points than this, they are drawn as a density raster
+    :param shape: (height, width) of the raster in pixels
+    :param figsize: size of the figure in inches
+    :param dpi: dots per inch of the image
+    :return: nothing
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if labels is None:
+        values, codes = np.array([None]), np.zeros(len(x), dtype=np.intp)
+    else:
+        values, codes = np.unique(np.asarray(labels), return_inverse=True)
+        codes = codes.reshape(-1)
+    colors = cluster_colors(len(values))
+    if labels is None:
+        colors[0] = to_rgba('blue')
+
+    figure = Figure(figsize=figsize)
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+
+    def name(i):
+        return f"Cluster {values[i]}" if label_names is None else label_names(values[i])
+
+    handles = []
+    if len(x) > max_scatter_points:
+        extent = data_extent(x, y, markers)
+        counts = density_raster(x, y, codes, len(values), extent, shape)
+        axes.imshow(shade(counts, colors), extent=extent, origin='lower', aspect='auto', interpolation='nearest')
+        if labels is not None:
+            handles = [Patch(color=colors[i], label=name(i)) for i in range(len(values))]
+    else:
+        # The points of every cluster are grouped with one sort of the codes
+        order = np.argsort(codes, kind='stable')
+        bounds = np.cumsum(np.bincount(codes, minlength=len(values)))[:-1]
+        for i, group in enumerate(np.split(order, bounds)):
+            axes.scatter(x[group], y[group], color=colors[i], alpha=0.7, label=None if labels is None else name(i))
+
+    for marker in markers or []:
+        points = np.asarray(marker['points'], dtype=np.float64).reshape(-1, 2)
+        if len(points):
+            axes.scatter(points[:, 0], points[:, 1], c=marker.get('color', 'red'), marker=marker.get('marker', 'o'),
+                         s=marker.get('size', 100), edgecolor='black', label=marker.get('label'))
+
+    handles += axes.get_legend_handles_labels()[0]
+    if handles:
+        axes.legend(handles=handles)
+
+    axes.set_title(title)
+    axes.set_xlabel(x_label)
+    axes.set_ylabel(y_label)
+    axes.grid(True)
+    figure.savefig(output_path, dpi=dpi)
+    print(f"Plot saved to {output_path}")
@@ -4,37 +4,143 @@ This class implements the Hierarchical Clustering algorithm.
 It takes a linkage criterion and a distance function as input and performs clustering on the dataset.
 It also provides a method to find the optimal number of clusters using the silhouette score.
 In the end, it plots the data with each cluster having a different colour.
+
+The linkage of scipy needs a condensed distance matrix of n * (n - 1) / 2 floats, which does not fit in the memory for
+large datasets. When a memory ceiling is given and the matrix would exceed it, the data are first summarised into
+micro-clusters with k-means, as many as the ceiling allows, and the hierarchy is built on the micro-clusters. For the
+'ward' criterion the micro-clusters are merged with a nearest-neighbor-chain Ward implementation that takes their sizes
+into account and never stores a distance matrix. Every point then gets the cluster of its micro-cluster.
+
+To choose the number of clusters, the silhouette of every candidate k is computed from one blocked pass over the
+pairwise distances, which is shared by all the candidates, optionally on a stratified sample with a confidence
+interval. The cheaper Calinski-Harabasz and Davies-Bouldin criteria can be used instead.
 """
 
-import pandas as pd
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-import matplotlib.pyplot as plt
 
 from scipy.cluster.hierarchy import linkage, fcluster
-from sklearn.metrics import silhouette_score
+from scipy.special import ndtri
+
+import binary_store
+import instrumentation
+from kMeans import VectorizedKMeans
+from neighbors import squared_euclidean_distances
+
+
+def ward_linkage(centroids: np.ndarray, sizes: np.ndarray):
+    """
+    Builds a Ward hierarchy of weighted points with the nearest-neighbor chain algorithm. Only O(m) memory is used,
+    the distances from the end of the chain to the other clusters are computed when they are needed.
+
+    Parameters:
+    centroids (np.ndarray): (m, d) array with the centres of the micro-clusters.
+    sizes (np.ndarray): number of points of every micro-cluster.
+
+    Returns:
+    np.ndarray: linkage matrix in the format of scipy, with the micro-clusters as leaves.
+    """
+    m = len(centroids)
+    centres = np.array(centroids, dtype=np.float64)
+    weights = np.array(sizes, dtype=np.float64)
+    active = np.ones(m, dtype=bool)
+    chain = []
+    merges = []
+
+    for _ in range(m - 1):
+        while True:
+            if not chain:
+                chain.append(int(np.flatnonzero(active)[0]))
+            a = chain[-1]
+
+            # Ward distance as scipy defines it: sqrt(2 |A| |B| / (|A| + |B|)) * ||centre(A) - centre(B)||
+            differences = centres - centres[a]
+            distances = np.sqrt(2 * weights * weights[a] / (weights + weights[a])
+                                * np.einsum('ij,ij->i', differences, differences))
+            distances[~active] = np.inf
+            distances[a] = np.inf
+
+            b = int(np.argmin(distances))
+            if len(chain) > 1 and distances[chain[-2]] <= distances[b]:
+                b = chain[-2]   # Prefer the previous cluster on ties, so the chain always ends
+
+            if len(chain) > 1 and b == chain[-2]:
+                break
+            chain.append(b)
+
+        chain.pop()
+        chain.pop()
+        merges.append((a, b, distances[b]))
+
+        # The merged cluster takes the place of a
+        total = weights[a] + weights[b]
+        centres[a] = (weights[a] * centres[a] + weights[b] * centres[b]) / total
+        weights[a] = total
+        active[b] = False
+
+    # Sort the merges by distance and give them the cluster numbers that scipy uses
+    merges.sort(key=lambda merge: merge[2])
+    parent = np.arange(m)
+    cluster_id = np.arange(m)
+    leaves = np.ones(m, dtype=np.int64)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    linkage_matrix = np.empty((m - 1, 4))
+    for i, (a, b, distance) in enumerate(merges):
+        root_a, root_b = find(a), find(b)
+        first, second = sorted((cluster_id[root_a], cluster_id[root_b]))
+        parent[root_b] = root_a
+        leaves[root_a] += leaves[root_b]
+        cluster_id[root_a] = m + i
+        linkage_matrix[i] = [first, second, distance, leaves[root_a]]
+
+    return linkage_matrix
+
 
 class HierarchicalClustering:
-    def __init__(self,linkage_criterion='average'):
+    def __init__(self,linkage_criterion='average', max_memory_mb=None, max_micro_iterations=10, seed=None):
         """
         Initialize the ClusteringProcessor class.
 
         Parameters:
         linkage_criterion (str): The linkage criterion to use.
         distance_function (str): The distance function to use.
+        max_memory_mb (float): Memory ceiling for the distance matrix of the linkage, in MB. When the exact linkage
+                               needs more, it runs on micro-clusters. None always runs the exact linkage.
+        max_micro_iterations (int): Maximum iterations of the k-means that builds the micro-clusters.
+        seed (int): Seed of the k-means that builds the micro-clusters.
         """
         self.linkage_criterion = linkage_criterion
+        self.max_memory_mb = max_memory_mb
+        self.max_micro_iterations = max_micro_iterations
+        self.seed = seed
+        self.data = None
+        self.linkage_matrix = None
+        self.leaf_labels = None
+        self.memory_report = None
+        self.scores = None
 
-    def load_data(self, file_path:str):
+    @instrumentation.traced('hierarchical.load_data')
+    def load_data(self, file_path:str = None, data=None):
         """
         Load the dataset from a CSV file.
 
         Parameters:
-        file_path (str): Path to the input CSV file.
+        file_path (str): Path to the input CSV file (or binary table).
+        data (pd.DataFrame): A DataFrame that is already in memory. It is used instead of the file.
         """
-        self.data = pd.read_csv(file_path)
+        self.data = binary_store.read_table(file_path) if data is None else data.copy(deep=False)
         #print(f"Data loaded successfully from {file_path}")
 
 
+    @instrumentation.traced('hierarchical.linkage')
     def run_hierarchical_clustering(self):
         """
         Perform clustering on the dataset and get the labeled data.
@@ -42,55 +148,270 @@ class HierarchicalClustering:
         if self.data is None:
             print("Data not loaded. Please run `load_data()` first.")
             return
-        
-        linkage_matrix = linkage(self.data, method=self.linkage_criterion, metric='euclidean')
-        self.linkage_matrix = linkage_matrix
 
-    
-    def find_optimal_clusters(self, max_clusters=10):
+        points = self.data.to_numpy(dtype=np.float64)
+        n = len(points)
+        instrumentation.add_rows(n)
+        exact_bytes = n * (n - 1) // 2 * 8
+        limit_bytes = None if self.max_memory_mb is None else int(self.max_memory_mb * 1024 ** 2)
+
+        if limit_bytes is None or exact_bytes <= limit_bytes:
+            self.linkage_matrix = linkage(points, method=self.linkage_criterion, metric='euclidean')
+            self.leaf_labels = None
+            self.memory_report = {'mode': 'exact', 'points': n, 'leaves': n, 'estimated_bytes': exact_bytes,
+                                  'limit_bytes': limit_bytes}
+        else:
+            self.run_micro_cluster_linkage(points, limit_bytes)
+
+        report = self.memory_report
+        print(f"Hierarchical clustering ({report['mode']}): {report['leaves']} leaves for {report['points']} points, "
+              f"about {report['estimated_bytes'] / 1024 ** 2:.1f} MB for the distances")
+
+    @instrumentation.traced('hierarchical.micro_clusters')
+    def run_micro_cluster_linkage(self, points, limit_bytes):
+        """
+        Summarise the data into as many k-means micro-clusters as the memory ceiling allows and build the hierarchy
+        on them.
+
+        Parameters:
+        points (np.ndarray): (n, d) array with the data.
+        limit_bytes (int): Memory ceiling for the distances.
+        """
+        n = len(points)
+
+        # Largest m with m * (m - 1) / 2 distances of 8 bytes under the ceiling
+        m = int((1 + np.sqrt(1 + limit_bytes)) / 2)
+        m = max(2, min(m, n))
+
+        # The k-means keeps a (chunk_size, m) distance matrix, so it has to respect the ceiling too
+        chunk_size = max(1, limit_bytes // (8 * m))
+        micro = VectorizedKMeans(m, None, chunk_size=chunk_size, init='random', seed=self.seed, tolerance=1e-3)
+        micro.fit(points, self.max_micro_iterations)
+
+        # Empty micro-clusters are dropped and the labels are renumbered
+        sizes = np.bincount(micro.labels, minlength=m)
+        non_empty = np.flatnonzero(sizes)
+        renumber = np.full(m, -1)
+        renumber[non_empty] = np.arange(len(non_empty))
+        centroids = micro.centroid_array[non_empty]
+        self.leaf_labels = renumber[micro.labels]
+
+        if self.linkage_criterion == 'ward':
+            self.linkage_matrix = ward_linkage(centroids, sizes[non_empty])
+        else:
+            self.linkage_matrix = linkage(centroids, method=self.linkage_criterion, metric='euclidean')
+
+        leaves = len(non_empty)
+        self.memory_report = {'mode': 'micro-clusters', 'points': n, 'leaves': leaves,
+                              'estimated_bytes': max(leaves * (leaves - 1) // 2, chunk_size * m) * 8,
+                              'limit_bytes': limit_bytes}
+
+    def cluster_labels(self, n_clusters):
+        """
+        Cut the hierarchy into a number of clusters and get the cluster of every point.
+
+        Parameters:
+        n_clusters (int): The number of clusters.
+
+        Returns:
+        np.ndarray: The cluster of every point.
+        """
+        labels = fcluster(self.linkage_matrix, n_clusters, criterion='maxclust')
+        if self.leaf_labels is not None:
+            labels = labels[self.leaf_labels]
+        return labels
+
+    def stratified_sample(self, strata, sample_size):
         """
-        Find the optimal number of clusters using the silhouette score.
+        Draw a sample that keeps the proportion of every stratum (cluster) of the data.
+
+        Parameters:
+        strata (np.ndarray): The stratum of every point.
+        sample_size (int): The approximate size of the sample.
+
+        Returns:
+        np.ndarray: The sorted indices of the sampled points.
+        """
+        rng = np.random.default_rng(self.seed)
+        groups, inverse, counts = np.unique(strata, return_inverse=True, return_counts=True)
+        allocation = np.minimum(counts, np.maximum(1, np.round(sample_size * counts / len(strata)).astype(int)))
+
+        sample = [rng.choice(np.flatnonzero(inverse == g), allocation[g], replace=False) for g in range(len(groups))]
+        return np.sort(np.concatenate(sample))
+
+    @instrumentation.traced('hierarchical.silhouette')
+    def silhouette_scores(self, points, labels_by_k, sample_size=None, confidence=0.95, n_jobs=None):
+        """
+        Compute the silhouette score of every candidate number of clusters with one blocked pass over the pairwise
+        distances. Every block of distances is multiplied with the cluster indicators of all the candidates at once,
+        which gives the sum of distances of every point to every cluster of every candidate. The blocks are processed
+        in parallel threads (the matrix products release the GIL), so the memory stays at one block of 2 ** 23
+        distances (64 MB) per thread, with at most one thread per CPU.
+
+        With a sample, the interval is the normal approximation of the mean of the per-point silhouettes,
+        with the finite population correction.
+
+        Parameters:
+        points (np.ndarray): (n, d) array with the data.
+        labels_by_k (dict): The cluster of every point for every candidate number of clusters.
+        sample_size (int): Size of the stratified sample. None uses every point.
+        confidence (float): Confidence level of the interval of the score.
+        n_jobs (int): Number of worker threads. None uses one per CPU.
+
+        Returns:
+        dict: For every candidate, the score and its confidence interval.
+        """
+        n = len(points)
+        if sample_size is None or sample_size >= n:
+            sample = np.arange(n)
+        else:
+            sample = self.stratified_sample(labels_by_k[max(labels_by_k)], sample_size)
+        sample_points = np.ascontiguousarray(points[sample])
+        m = len(sample)
+        instrumentation.add_rows(m)
+
+        # Indicator columns of the clusters of all the candidates side by side
+        encoded = {}
+        offset = 0
+        for k, labels in labels_by_k.items():
+            _, inverse = np.unique(labels[sample], return_inverse=True)
+            n_found = int(inverse.max()) + 1
+            encoded[k] = (inverse, offset, n_found)
+            offset += n_found
+        indicator = np.zeros((m, offset))
+        for inverse, start, _ in encoded.values():
+            indicator[np.arange(m), start + inverse] = 1
+
+        sums = np.empty((m, offset))
+        block = max(1, 2 ** 23 // m)
+
+        def process(start):
+            distances = np.sqrt(squared_euclidean_distances(sample_points[start:start + block], sample_points))
+            sums[start:start + block] = distances @ indicator
+
+        # Every thread holds a block of distances, so there are not more threads than CPUs (or blocks)
+        workers = min(n_jobs or os.cpu_count() or 1, -(-m // block))
+        with instrumentation.span('hierarchical.silhouette.distances'):
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(process, range(0, m, block)))
+
+        z = ndtri((1 + confidence) / 2)     # Quantile of the standard normal distribution
+        correction = np.sqrt(1 - m / n)
+        rows = np.arange(m)
+        scores = {}
+        # The distances are shared by every candidate, so the span of a candidate only times its own part
+        for k, (inverse, start, n_found) in encoded.items():
+            with instrumentation.span('hierarchical.silhouette.score', k=k):
+                if n_found < 2:
+                    scores[k] = {'score': np.nan, 'interval': (np.nan, np.nan)}
+                    continue
+
+                cluster_sums = sums[:, start:start + n_found]
+                counts = indicator[:, start:start + n_found].sum(axis=0)
+                own_counts = counts[inverse]
+
+                a = cluster_sums[rows, inverse] / np.maximum(own_counts - 1, 1)
+                other = cluster_sums / counts
+                other[rows, inverse] = np.inf
+                b = other.min(axis=1)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    silhouettes = np.nan_to_num((b - a) / np.maximum(a, b))
+                silhouettes[own_counts == 1] = 0
+
+                score = float(silhouettes.mean())
+                half_width = float(z * silhouettes.std(ddof=1) / np.sqrt(m) * correction) if m > 1 else 0.0
+                scores[k] = {'score': score, 'interval': (score - half_width, score + half_width)}
+
+        return scores
+
+    @instrumentation.traced('hierarchical.find_optimal_clusters')
+    def find_optimal_clusters(self, max_clusters=10, criterion='silhouette', sample_size=None, confidence=0.95,
+                              n_jobs=None):
+        """
+        Find the optimal number of clusters using the silhouette score, or a cheaper criterion.
 
         Parameters:
         max_clusters (int): The maximum number of clusters to consider.
+        criterion (str): 'silhouette', 'calinski_harabasz' (O(n), higher is better) or 'davies_bouldin'
+                         (O(n), lower is better).
+        sample_size (int): Size of the stratified sample for the silhouette. None uses every point.
+        confidence (float): Confidence level of the interval of the silhouette score.
+        n_jobs (int): Number of worker threads.
 
         Returns:
-        int: The optimal number of clusters.
+        int: The optimal number of clusters. When no candidate can be scored (max_clusters < 2, or every score is
+        NaN), 2 is returned like the original implementation did.
         """
         if self.data is None:
             print("Data not loaded. Please run `load_data()` first.")
             return
 
-        best_score = -1
-        best_clusters = 2
-        best_labels = None
+        points = self.data.drop(columns='Cluster', errors='ignore').to_numpy(dtype=np.float64)
+        labels_by_k = {n_clusters: self.cluster_labels(n_clusters) for n_clusters in range(2, max_clusters + 1)}
+
+        if not labels_by_k:
+            self.scores = {}
+        elif criterion == 'silhouette':
+            self.scores = self.silhouette_scores(points, labels_by_k, sample_size, confidence, n_jobs)
+        elif criterion in ('calinski_harabasz', 'davies_bouldin'):
+            from sklearn.metrics import calinski_harabasz_score, davies_bouldin_score
+
+            score_function = calinski_harabasz_score if criterion == 'calinski_harabasz' else davies_bouldin_score
+
+            def evaluate(n_clusters):
+                with instrumentation.span(f'hierarchical.{criterion}', k=n_clusters):
+                    labels = labels_by_k[n_clusters]
+                    return score_function(points, labels) if len(np.unique(labels)) > 1 else np.nan
+
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                values = list(executor.map(evaluate, labels_by_k))
+            self.scores = {n_clusters: {'score': value} for n_clusters, value in zip(labels_by_k, values)}
+        else:
+            raise ValueError(f"Unknown criterion '{criterion}'. "
+                             f"Use 'silhouette', 'calinski_harabasz' or 'davies_bouldin'")
 
-        for n_clusters in range(2, max_clusters+1):
-            labels = fcluster(self.linkage_matrix, n_clusters, criterion='maxclust')
-            score = silhouette_score(self.data, labels)
-            
+        sign = -1 if criterion == 'davies_bouldin' else 1
+        valid = [n_clusters for n_clusters in labels_by_k if not np.isnan(self.scores[n_clusters]['score'])]
+        name = {'silhouette': 'Silhouette', 'calinski_harabasz': 'Calinski-Harabasz',
+                'davies_bouldin': 'Davies-Bouldin'}[criterion]
+        if not valid:
+            print(f"No number of clusters from 2 to {max_clusters} has a {name} score, 2 clusters are used")
+            self.data['Cluster'] = labels_by_k[2] if 2 in labels_by_k else self.cluster_labels(2)
+            return 2
 
-            if score > best_score:
-                best_score = score
-                best_clusters = n_clusters
-                best_labels = labels
+        best_clusters = max(valid, key=lambda n_clusters: sign * self.scores[n_clusters]['score'])
+        best_score = self.scores[best_clusters]['score']
+        best_labels = labels_by_k[best_clusters]
 
-        print("Silhouette Score:", best_score)
+        if criterion == 'silhouette' and sample_size is not None and sample_size < len(points):
+            low, high = self.scores[best_clusters]['interval']
+            print(f"{name} Score: {best_score} ({confidence:.0%} confidence interval {low:.4f} - {high:.4f})")
+        else:
+            print(f"{name} Score:", best_score)
         self.data['Cluster'] = best_labels
         return best_clusters
     
+    @instrumentation.traced('hierarchical.save_data')
     def save_data(self, output_path):
-        """Save the dataset with labesl to a CSV file."""
+        """Save the dataset with labesl to a CSV file (or binary table, if the path ends with '.cbin')."""
         if self.data is not None:
-            self.data.to_csv(output_path, index=False)
+            binary_store.save_table(self.data, output_path)
             print(f"Data saved to {output_path}")
         else:
             print("Data not available. Please load the data first")
 
-    def plot_data(self, x_column:str, y_column:str):
+    def plot_data(self, x_column:str, y_column:str, output_path=None):
+        """
+        Plot the data including cluster labels.
+
+        Parameters:
+        x_column (str): The column of the x axis.
+        y_column (str): The column of the y axis.
+        output_path (str): If given, the plot is saved to this image file without a window ('headless_plot.py'), and
+                           large data are drawn as a density raster with a color per cluster.
+        """
         self.x_column = x_column
         self.y_column = y_column
-        """Plot the data including cluster labels."""
         if self.data is None:
             print("Data not loaded. Please run `load_data()` first.")
             return
@@ -99,15 +420,29 @@ class HierarchicalClustering:
             print("Cluster labels not found in the data. Ensure clustering is complete.")
             return
 
+        x = self.data[self.x_column].to_numpy()
+        y = self.data[self.y_column].to_numpy()
+        labels = self.data['Cluster'].to_numpy()
+        title = '2D Scatter Plot with the clusters suggested by the hierarchical algorithm'
+        if output_path is not None:
+            import headless_plot
+
+            headless_plot.save_scatter(output_path, x, y, labels, title=title, x_label=self.x_column,
+                                       y_label=self.y_column)
+            return
+
+        import matplotlib.pyplot as plt
+
         plt.figure(figsize=(8, 6))
 
-        # Use cluster labels to group points and assign colors
-        unique_clusters = self.data['Cluster'].unique()
-        for cluster in unique_clusters:
-            cluster_data = self.data[self.data['Cluster'] == cluster]
-            plt.scatter(cluster_data[self.x_column], cluster_data[self.y_column], label=f"Cluster {cluster}", alpha=0.7)
+        # The points of every cluster are grouped with one sort of the labels, instead of a mask per cluster
+        clusters, codes = np.unique(labels, return_inverse=True)
+        order = np.argsort(codes, kind='stable')
+        bounds = np.cumsum(np.bincount(codes, minlength=len(clusters)))[:-1]
+        for cluster, group in zip(clusters, np.split(order, bounds)):
+            plt.scatter(x[group], y[group], label=f"Cluster {cluster}", alpha=0.7)
 
-        plt.title('2D Scatter Plot with the clusters suggested by the hierarchical algorithm')
+        plt.title(title)
         plt.xlabel(self.x_column)
         plt.ylabel(self.y_column)
         plt.legend()
@@ -0,0 +1,421 @@
+"""
+This file records where the time of a run goes. The classes of the pipeline report into it:
+    spans: the time of a method or of a stage (`traced`, `span`), with the rows that it processed (`add_rows`) and the
+           memory of the process (the resident memory at the start and at the end, and the peak so far)
+    events: values inside a span, e.g. the inertia of every k-means iteration (`event`)
+    profiles: optionally, the stacks of the threads that are inside chosen spans, sampled every few milliseconds
+              (`sys._current_frames`), so the slow functions of a stage are found without a full profiler
+
+It is disabled by default, and then every hook returns at once (the methods only pay a check of a global), so the
+classes keep their hooks. `enable()` starts recording and the results are written as JSON (`write_json`), as a Chrome
+trace that chrome://tracing or https://ui.perfetto.dev open (`write_chrome_trace`), or as folded stacks for a flame
+graph (`write_folded`). `report()` prints the time of every span name.
+
+E.g.:
+    instrumentation.enable(profile=['kmeans'])
+    ... run the pipeline ...
+    instrumentation.write_chrome_trace('trace.json')
+
+Spans nest per thread. The peak memory is the peak of the process up to the end of the span (`ru_maxrss`), so a span
+whose peak is the one of an earlier span did not raise it itself: compare it with the peak at its start.
+"""
+
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+_recorder = None
+
+
+def peak_rss_mb():
+    """
+    :return: the peak resident memory of the process, in MB, or None where it cannot be read (e.g. on Windows)
+    """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024      # Bytes on macOS, KB on Linux
+
+
+def current_rss_mb():
+    """
+    :return: the resident memory of the process, in MB, or None where /proc is not available
+    """
+
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            pages = int(file.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+
+
+class Recorder:
+    def __init__(self, profile=None, sample_interval: float = 0.005, max_stack_depth: int = 64):
+        """
+        Constructor
+        :param profile: names (or prefixes of names, e.g. 'kmeans' for 'kmeans.fit') of the spans that are profiled.
+                        None profiles nothing
+        :param sample_interval: seconds between two samples of the profiler
+        :param max_stack_depth: deepest frames that are kept of every stack
+        """
+
+        self.profile = tuple(profile or ())
+        self.sample_interval = sample_interval
+        self.max_stack_depth = max_stack_depth
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.events = []
+        self.profiles = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiled_threads = {}      # Thread id -> names of the profiled spans it is in
+        self.sampler = None
+        self.stopped = threading.Event()
+
+    def stack(self):
+        """
+        :return: the list of the open spans of the current thread
+        """
+
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def is_profiled(self, name: str):
+        return any(name == prefix or name.startswith(prefix + '.') for prefix in self.profile)
+
+    def open_span(self, name: str, arguments: dict):
+        """
+        Starts a span in the current thread
+        :return: the span (a dictionary)
+        """
+
+        stack = self.stack()
+        span = {'name': name, 'parent': stack[-1]['name'] if stack else None, 'thread': threading.get_ident(),
+                'start': time.perf_counter() - self.origin, 'rows': None, 'rss_start_mb': current_rss_mb(),
+                'peak_rss_start_mb': peak_rss_mb(), 'args': arguments}
+        stack.append(span)
+
+        if self.is_profiled(name):
+            with self.lock:
+                self.profiled_threads.setdefault(span['thread'], []).append(name)
+            self.start_sampler()
+        return span
+
+    def close_span(self, span: dict):
+        """
+        Ends the span and keeps it
+        :return: nothing
+        """
+
+        span['seconds'] = time.perf_counter() - self.origin - span['start']
+        span['rss_end_mb'] = current_rss_mb()
+        span['peak_rss_mb'] = peak_rss_mb()
+        if span['rows'] is not None:
+            span['rows_per_second'] = span['rows'] / span['seconds'] if span['seconds'] > 0 else None
+        self.stack().pop()
+
+        with self.lock:
+            self.spans.append(span)
+            names = self.profiled_threads.get(span['thread'])
+            if names and names[-1] == span['name']:
+                names.pop()
+                if not names:
+                    del self.profiled_threads[span['thread']]
+
+    def start_sampler(self):
+        if self.sampler is None:
+            self.sampler = threading.Thread(target=self.sample, name='instrumentation-sampler', daemon=True)
+            self.sampler.start()
+
+    def sample(self):
+        """
+        The loop of the profiler thread: every sample_interval it takes the stack of every thread that is inside a
+        profiled span and counts it for the innermost profiled span
+        :return: nothing
+        """
+
+        while not self.stopped.wait(self.sample_interval):
+            with self.lock:
+                threads = {thread: names[-1] for thread, names in self.profiled_threads.items()}
+            if not threads:
+                continue
+
+            frames = sys._current_frames()
+            for thread, name in threads.items():
+                frame = frames.get(thread)
+                functions = []
+                while frame is not None and len(functions) < self.max_stack_depth:
+                    code = frame.f_code
+                    functions.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                with self.lock:
+                    self.profiles.setdefault(name, Counter())[';'.join(reversed(functions))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+
+    def summary(self):
+        """
+        :return: dictionary from every span name to its number of calls, total seconds, rows and peak memory
+        """
+
+        summary = {}
+        for span in self.spans:
+            entry = summary.setdefault(span['name'], {'calls': 0, 'seconds': 0.0, 'rows': 0, 'peak_rss_mb': None})
+            entry['calls'] += 1
+            entry['seconds'] += span['seconds']
+            entry['rows'] += span['rows'] or 0
+            if span['peak_rss_mb'] is not None:
+                entry['peak_rss_mb'] = max(entry['peak_rss_mb'] or 0.0, span['peak_rss_mb'])
+        return summary
+
+    def results(self, top_stacks: int = 20):
+        """
+        :param top_stacks: number of the most sampled stacks that are kept for every profiled span
+        :return: dictionary with the spans, the events, the summary and the profiles
+        """
+
+        with self.lock:
+            profiles = {name: [{'stack': stack, 'samples': samples}
+                               for stack, samples in counter.most_common(top_stacks)]
+                        for name, counter in self.profiles.items()}
+            return {'spans': sorted(self.spans, key=lambda span: span['start']), 'events': list(self.events),
+                    'summary': self.summary(), 'profiles': profiles,
+                    'sample_interval': self.sample_interval if self.profile else None}
+
+
+class _Span:
+    """
+    Context manager of an enabled span
+    """
+
+    def __init__(self, recorder: Recorder, name: str, arguments: dict):
+        self.recorder = recorder
+        self.name = name
+        self.arguments = arguments
+        self.span = None
+
+    def __enter__(self):
+        self.span = self.recorder.open_span(self.name, self.arguments)
+        return self.span
+
+    def __exit__(self, *exception):
+        self.recorder.close_span(self.span)
+        return False
+
+
+class _NoSpan:
+    """
+    Context manager that does nothing, for when the instrumentation is disabled
+    """
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exception):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def enable(profile=None, sample_interval: float = 0.005):
+    """
+    Starts recording. The records of an earlier recording are dropped
+    :param profile: names (or prefixes of names) of the spans that are profiled, e.g. ['kmeans', 'hierarchical'].
+                    None profiles nothing
+    :param sample_interval: seconds between two samples of the profiler
+    :return: the Recorder
+    """
+
+    global _recorder
+    disable()
+    _recorder = Recorder(profile, sample_interval)
+    return _recorder
+
+
+def disable():
+    """
+    Stops recording
+    :return: the Recorder of the recording, or None if it was not enabled
+    """
+
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.stop()
+    return recorder
+
+
+def enabled():
+    return _recorder is not None
+
+
+def span(name: str, **arguments):
+    """
+    Times a block of code, e.g. `with instrumentation.span('pca.fit'):`
+    :param name: the name of the span. Dots group the names, e.g. 'kmeans.fit'
+    :param arguments: values that are kept with the span (e.g. k)
+    :return: a context manager
+    """
+
+    if _recorder is None:
+        return _NO_SPAN
+    return _Span(_recorder, name, arguments)
+
+
+def traced(name: str):
+    """
+    Decorator that times every call of a function (or method) as a span
+    :param name: the name of the span
+    :return: the decorator
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return function(*args, **kwargs)
+            with _Span(_recorder, name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_rows(rows: int):
+    """
+    Adds to the rows that the innermost span of the current thread processed
+    :param rows: the number of rows
+    :return: nothing
+    """
+
+    recorder = _recorder
+    if recorder is None:
+        return
+    stack = recorder.stack()
+    if stack:
+        stack[-1]['rows'] = (stack[-1]['rows'] or 0) + int(rows)
+
+
+def event(name: str, **values):
+    """
+    Records values at this moment, in the innermost span of the current thread,
+    e.g. `event('kmeans.iteration', iteration=3, inertia=12.5)`
+    :param name: the name of the event
+    :param values: the values (numbers are also drawn as counters in the Chrome trace)
+    :return: nothing
+    """
+
+    recorder = _recorder
+    if recorder is None:
+        return
+    stack = recorder.stack()
+    with recorder.lock:
+        recorder.events.append({'name': name, 'time': time.perf_counter() - recorder.origin,
+                                'thread': threading.get_ident(), 'span': stack[-1]['name'] if stack else None,
+                                'values': values})
+
+
+def results():
+    """
+    :return: the results of the recording (see Recorder.results), or None if it is not enabled
+    """
+
+    return None if _recorder is None else _recorder.results()
+
+
+def write_json(output_path: str):
+    """
+    Writes the spans, the events, the summary and the profiles to a JSON file
+    :param output_path: the path of the file
+    :return: nothing
+    """
+
+    if _recorder is None:
+        print("Instrumentation is not enabled. Use enable() first.")
+        return
+
+    with open(output_path, 'w') as file:
+        json.dump(_recorder.results(), file, indent=2, default=float)
+
+
+def write_chrome_trace(output_path: str):
+    """
+    Writes the spans and the events in the Chrome trace event format: a span is a complete event ('X'), an event is
+    an instant event ('i') and every number of it is also a counter ('C'), so e.g. the inertia is drawn per iteration
+    :param output_path: the path of the file
+    :return: nothing
+    """
+
+    if _recorder is None:
+        print("Instrumentation is not enabled. Use enable() first.")
+        return
+
+    recorded = _recorder.results()
+    pid = os.getpid()
+    trace = []
+    for item in recorded['spans']:
+        arguments = {key: item[key] for key in ('rows', 'rows_per_second', 'rss_start_mb', 'rss_end_mb',
+                                                'peak_rss_mb') if item.get(key) is not None}
+        arguments.update(item['args'])
+        trace.append({'name': item['name'], 'cat': item['name'].split('.')[0], 'ph': 'X', 'pid': pid,
+                      'tid': item['thread'], 'ts': item['start'] * 1e6, 'dur': item['seconds'] * 1e6,
+                      'args': arguments})
+    for item in recorded['events']:
+        timestamp = item['time'] * 1e6
+        trace.append({'name': item['name'], 'ph': 'i', 's': 't', 'pid': pid, 'tid': item['thread'],
+                      'ts': timestamp, 'args': item['values']})
+        for key, value in item['values'].items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                trace.append({'name': f"{item['name']}.{key}", 'ph': 'C', 'pid': pid, 'ts': timestamp,
+                              'args': {key: value}})
+
+    with open(output_path, 'w') as file:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, file, default=float)
+
+
+def write_folded(output_path: str):
+    """
+    Writes the sampled stacks in the folded format of flamegraph.pl and speedscope ('span;frame;frame count')
+    :param output_path: the path of the file
+    :return: nothing
+    """
+
+    if _recorder is None:
+        print("Instrumentation is not enabled. Use enable() first.")
+        return
+
+    with _recorder.lock:
+        lines = [f"{name};{stack} {samples}" for name, counter in _recorder.profiles.items()
+                 for stack, samples in counter.items()]
+    with open(output_path, 'w') as file:
+        file.write('\n'.join(lines) + ('\n' if lines else ''))
+
+
+def report():
+    """
+    Prints the total time, the rows and the peak memory of every span name, the slowest first
+    :return: nothing
+    """
+
+    if _recorder is None:
+        print("Instrumentation is not enabled. Use enable() first.")
+        return
+
+    summary = _recorder.summary()
+    print(f"{'span':<40}{'calls':>7}{'seconds':>11}{'rows':>12}{'rows/s':>14}{'peak MB':>10}")
+    for name, entry in sorted(summary.items(), key=lambda item: -item[1]['seconds']):
+        rate = f"{entry['rows'] / entry['seconds']:,.0f}" if entry['rows'] and entry['seconds'] > 0 else '-'
+        peak = f"{entry['peak_rss_mb']:.1f}" if entry['peak_rss_mb'] is not None else '-'
+        print(f"{name:<40}{entry['calls']:>7}{entry['seconds']:>11.3f}{entry['rows'] or '-':>12}{rate:>14}{peak:>10}")
@@ -6,57 +6,167 @@ In the end, it plots the data with each cluster having a different colour.
 """
 
 import csv
-import random
 import math
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
 from typing import List
 
-from matplotlib import pyplot as plt
+import numpy as np
+
+import binary_store
+import instrumentation
+import neighbors
+from neighbors import squared_euclidean_distances
 
 
 def euclidean_distance(point1, point2):
     """
     Calculates the Euclidean distance between two points
-    :param point1: a 2-D point
-    :param point2: a 2-D point
+    :param point1: a point with any number of dimensions
+    :param point2: a point with the same number of dimensions
     :return: the Euclidean distance between point1 and point2
     """
 
-    return math.sqrt((point1[0] - point2[0]) ** 2 + (point1[1] - point2[1]) ** 2)
+    return math.dist(point1, point2)
+
+
+def column_indices(file_path: str, columns: List[str] = None):
+    """
+    Finds the positions of some columns in the header of a CSV file or in the schema of a binary table
+    :param file_path: the CSV file or binary table
+    :param columns: names of the columns. None selects every column
+    :return: list with the indices of the columns
+    """
+
+    if binary_store.is_binary_table(file_path):
+        header = binary_store.column_names(file_path)
+    else:
+        with open(file_path, 'r') as file:
+            header = next(csv.reader(file))
+
+    if columns is None:
+        return list(range(len(header)))
+
+    missing = [column for column in columns if column not in header]
+    if missing:
+        raise ValueError(f"Columns {missing} not found in {file_path}")
+    return [header.index(column) for column in columns]
+
+
+def kmeans_plusplus(data: np.ndarray, k: int, rng: np.random.Generator):
+    """
+    Chooses k initial centroids with the k-means++ seeding. The first centroid is a random point and every next one is
+    chosen with probability proportional to its squared distance from the closest centroid chosen so far
+    :param data: (n, d) float64 array with the points
+    :param k: number of centroids
+    :param rng: NumPy random generator
+    :return: (k, d) array with the initial centroids
+    """
+
+    centroids = np.empty((k, data.shape[1]), dtype=np.float64)
+    centroids[0] = data[rng.integers(len(data))]
+    closest = squared_euclidean_distances(data, centroids[:1])[:, 0]
+
+    for i in range(1, k):
+        cumulative = np.cumsum(closest)
+        if cumulative[-1] > 0:
+            index = min(int(np.searchsorted(cumulative, rng.random() * cumulative[-1], side='right')), len(data) - 1)
+        else:
+            index = rng.integers(len(data))     # Every point lies on a centroid
+        centroids[i] = data[index]
+        np.minimum(closest, squared_euclidean_distances(data, centroids[i:i + 1])[:, 0], out=closest)
+
+    return centroids
+
+
+_restart_data = None
+
+
+def _initialise_restart_worker(data: np.ndarray):
+    """
+    Stores the data in a worker process once, so they are not sent again for every restart
+    :param data: (n, d) array with the points
+    :return: nothing
+    """
+
+    global _restart_data
+    _restart_data = data
+
+
+def _run_restart(parameters: dict, seed: np.random.SeedSequence, max_iterations: int):
+    """
+    Runs one independent k-means restart in a worker process
+    :param parameters: keyword arguments of the VectorizedKMeans constructor
+    :param seed: seed of this restart
+    :param max_iterations: maximum number of iterations
+    :return: tuple of (centroids, inertia, number of iterations, distance counters)
+    """
+
+    model = VectorizedKMeans(file_path=None, seed=seed, **parameters)
+    model.fit(_restart_data, max_iterations)
+    return model.centroid_array, model.inertia, model.n_iterations, model.distance_counts
 
 
 class KMeans:
-    def __init__(self, k: int, file_path: str):
+    def __init__(self, k: int, file_path: str, init: str = 'random', seed: int = None, tolerance: float = 0.0,
+                 columns: List[str] = None):
         """
         Constructor
         :param k: the variable k that contains the number of clusters
         :param file_path: the file path that contains the data where we will run the k-means algorithm
+        :param init: how the centroids are initialised, 'random' (the default, as in the original implementation) or
+                     'k-means++'
+        :param seed: seed of the random generator, so that a run can be reproduced. Without a seed, the random
+                     initialisation uses the `random` module like the original implementation
+        :param tolerance: relative centroid shift under which the algorithm is considered converged. The shift of
+                          every centroid is divided by the spread of the data (square root of the mean variance of
+                          the features). With 0 the centroids must stop changing completely
+        :param columns: names of the columns (features) to cluster on, any number of them. None uses every column
         """
 
         self.k = k
         self.file_path = file_path
+        self.columns = columns
+        self.init = init
+        self.seed = seed
+        self.tolerance = tolerance
+        self.scale = 1.0
+        self.rng = np.random.default_rng(seed)
         self.data = []
         self.centroids = []
         self.clusters = []
 
+    @instrumentation.traced('kmeans.load_data')
     def load_data(self):
         """
         Loads data from csv file
         :return: nothing
         """
 
+        if binary_store.is_binary_table(self.file_path):
+            self.data = binary_store.load_array(self.file_path, self.columns, dtype=np.float64).tolist()
+            return
+
+        indices = column_indices(self.file_path, self.columns)
         with open(self.file_path, 'r') as file:
             reader = csv.reader(file)
             next(reader)
             for row in reader:
-                self.data.append([float(row[0]), float(row[1])])
+                self.data.append([float(row[i]) for i in indices])
 
     def initialise_centroids(self):
         """
-        Randomly initialises centroids
+        Initialises centroids with k-means++ or by choosing random points
         :return: nothing
         """
 
-        self.centroids = random.sample(self.data, self.k)
+        if self.init == 'k-means++':
+            self.centroids = kmeans_plusplus(np.array(self.data, dtype=np.float64), self.k, self.rng).tolist()
+        elif self.seed is None:
+            self.centroids = random.sample(self.data, self.k)
+        else:
+            self.centroids = [self.data[i] for i in self.rng.choice(len(self.data), self.k, replace=False)]
 
     def assign_clusters(self):
         """
@@ -78,18 +188,22 @@ class KMeans:
 
         for i, cluster in enumerate(self.clusters):
             if cluster:
-                x_coords = [point[0] for point in cluster]
-                y_coords = [point[1] for point in cluster]
-                self.centroids[i] = [sum(x_coords) / len(x_coords), sum(y_coords) / len(y_coords)]
+                self.centroids[i] = [sum(coords) / len(cluster) for coords in zip(*cluster)]
 
     def has_converged(self, old_centroids: List[float]):
         """
-        Checks if the algorithm has converged. This means that the old centroids are not updated.
+        Checks if the algorithm has converged. This means that the old centroids are not updated, or that none of
+        them moved more than `tolerance` relative to the spread of the data.
         :return: boolean value indicating if the algorithm has converged or not
         """
 
-        return old_centroids == self.centroids
+        if self.tolerance == 0:
+            return old_centroids == self.centroids
 
+        shift = max(euclidean_distance(old, new) for old, new in zip(old_centroids, self.centroids))
+        return shift <= self.tolerance * self.scale
+
+    @instrumentation.traced('kmeans.run')
     def run(self, max_iterations: int):
         """
         Runs the k-means algorithm
@@ -97,6 +211,7 @@ class KMeans:
         """
 
         self.load_data()
+        self.scale = float(np.sqrt(np.var(np.array(self.data), axis=0).mean()))
         self.initialise_centroids()
 
         for i in range(max_iterations):
@@ -107,12 +222,37 @@ class KMeans:
             if self.has_converged(old_centroids):
                 break
 
-    def plot_results(self):
+    def points_and_labels(self):
+        """
+        :return: tuple of ((n, d) array with the points, the cluster of every point)
+        """
+
+        sizes = [len(cluster) for cluster in self.clusters]
+        points = np.array([point for cluster in self.clusters for point in cluster], dtype=np.float64)
+        return points.reshape(sum(sizes), -1), np.repeat(np.arange(self.k), sizes)
+
+    def plot_results(self, output_path: str = None):
         """
         Plots the data points and centroids, coloring each cluster differently.
+        With more than two dimensions only the first two are plotted.
+        :param output_path: if given, the plot is saved to this image file without a window ('headless_plot.py'), and
+                            large data are drawn as a density raster with a color per cluster
         :return: nothing
         """
 
+        if output_path is not None:
+            import headless_plot
+
+            points, labels = self.points_and_labels()
+            centroids = {'points': np.asarray(self.centroids, dtype=np.float64)[:, :2], 'label': 'Centroids',
+                         'color': 'black', 'marker': 'X', 'size': 200}
+            headless_plot.save_scatter(output_path, points[:, 0], points[:, 1], labels,
+                                       label_names=lambda cluster: f"Cluster {cluster + 1}", markers=[centroids],
+                                       title="K-Means Clustering", x_label="X-axis", y_label="Y-axis")
+            return
+
+        from matplotlib import pyplot as plt
+
         colors = plt.colormaps["tab10"]  # Updated to use the newer colormaps API
         for i, cluster in enumerate(self.clusters):
             x_coords = [point[0] for point in cluster]
@@ -128,4 +268,361 @@ class KMeans:
         plt.xlabel("X-axis")
         plt.ylabel("Y-axis")
         plt.legend()
-        plt.show()
\ No newline at end of file
+        plt.show()
+
+
+class VectorizedKMeans(KMeans):
+    """
+    Same algorithm as KMeans, but the data are kept in a contiguous float64 (n, d) NumPy array and the assignments
+    in an integer label array, so every iteration is a few array operations instead of O(n*k) Python calls.
+
+    The `centroids` and `clusters` attributes are derived from the arrays, so `plot_results` and the code that
+    uses the centroids afterwards (e.g. 'find_outliers.py') keep working.
+
+    With algorithm='hamerly' the assignment step keeps, for every point, an upper bound of the distance to its centroid
+    and a lower bound of the distance to the second closest one (Hamerly, 2010). When the upper bound is smaller than
+    both the lower bound and half the distance of the centroid to its closest other centroid, the triangle inequality
+    guarantees that the point keeps its centroid, so its distances are not computed at all. The result is the same as
+    the one of Lloyd's algorithm. The numbers of computed and skipped distances of every iteration are kept in
+    `distance_counts`. They are exact with the brute force index; a KD-tree or a ball tree computes fewer distances
+    than the n * k that are counted for its searches, so then the count is an upper bound ('exact' is False).
+
+    The nearest centroids are found with a NeighborIndex ('neighbors.py'): by brute force for the usual few centroids,
+    and with a KD-tree for hundreds of centroids (micro-segments) in few dimensions.
+
+    With n_init > 1 the algorithm is restarted n_init times from different seeds in a pool of processes and the result
+    with the lowest inertia is kept. When this is used from a script, the script needs an
+    `if __name__ == '__main__':` guard on platforms that start processes with 'spawn' (Windows, macOS).
+    """
+
+    def __init__(self, k: int, file_path: str, chunk_size: int = 65536, init: str = 'k-means++', seed=None,
+                 n_init: int = 1, n_jobs: int = None, tolerance: float = 0.0, algorithm: str = 'lloyd',
+                 columns: List[str] = None, neighbor_backend: str = 'auto'):
+        """
+        Constructor
+        :param k: the variable k that contains the number of clusters
+        :param file_path: the file path that contains the data where we will run the k-means algorithm
+        :param chunk_size: number of points whose distances are computed at once. It bounds the (chunk_size, k)
+                           distance matrix that is kept in memory
+        :param init: how the centroids are initialised, 'k-means++' or 'random'
+        :param seed: seed of the random generator (int or np.random.SeedSequence), so that a run can be reproduced
+        :param n_init: number of independent restarts. The one with the lowest inertia is kept
+        :param n_jobs: number of worker processes for the restarts. None uses every core
+        :param tolerance: relative centroid shift under which the algorithm is considered converged (see KMeans)
+        :param algorithm: 'lloyd' computes every distance in every iteration, 'hamerly' skips the distances that the
+                          triangle inequality rules out
+        :param columns: names of the columns (features) to cluster on, any number of them. None uses every column
+        :param neighbor_backend: how the nearest centroids are found, 'brute', 'kd_tree', 'ball_tree' or 'auto' (see
+                                 'neighbors.py'). The trees pay off for hundreds of centroids in few dimensions
+        """
+
+        if algorithm not in ('lloyd', 'hamerly'):
+            raise ValueError(f"Unknown algorithm '{algorithm}'. Use 'lloyd' or 'hamerly'")
+
+        self.k = k
+        self.file_path = file_path
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.init = init
+        self.seed = seed
+        self.n_init = n_init
+        self.n_jobs = n_jobs
+        self.tolerance = tolerance
+        self.algorithm = algorithm
+        self.neighbor_backend = neighbor_backend
+        self.scale = 1.0
+        self.data = np.empty((0, 2))
+        self.labels = np.empty(0, dtype=np.intp)
+        self.centroid_array = np.empty((0, 2))
+        self.n_iterations = 0
+        self.inertia = None
+        self.restart_inertias = []
+        self.restart_iterations = []
+        self.distance_counts = []
+        self.upper_bounds = None
+        self.lower_bounds = None
+        self.rng = np.random.default_rng(seed)
+
+    @property
+    def centroids(self):
+        """
+        The centroids as a list of points, like the ones of KMeans
+        """
+
+        return self.centroid_array.tolist()
+
+    @centroids.setter
+    def centroids(self, centroids):
+        self.centroid_array = np.array(centroids, dtype=np.float64).reshape(len(centroids), -1)
+
+    @property
+    def clusters(self):
+        """
+        The points of every cluster, grouped with a single sort of the label array
+        """
+
+        order = np.argsort(self.labels, kind='stable')
+        counts = np.bincount(self.labels, minlength=self.k)
+        return np.split(self.data[order], np.cumsum(counts)[:-1])
+
+    def points_and_labels(self):
+        """
+        :return: tuple of ((n, d) array with the points, the cluster of every point), without grouping them
+        """
+
+        return self.data, self.labels
+
+    @instrumentation.traced('kmeans.load_data')
+    def load_data(self):
+        """
+        Loads data from csv file (or binary table) into a contiguous float64 array
+        :return: nothing
+        """
+
+        if binary_store.is_binary_table(self.file_path):
+            self.data = np.ascontiguousarray(binary_store.load_array(self.file_path, self.columns, dtype=np.float64))
+            return
+
+        indices = column_indices(self.file_path, self.columns)
+        data = np.loadtxt(self.file_path, delimiter=',', skiprows=1, usecols=indices, dtype=np.float64, ndmin=2)
+        self.data = np.ascontiguousarray(data)
+
+    def initialise_centroids(self):
+        """
+        Initialises centroids with k-means++ or by choosing random points
+        :return: nothing
+        """
+
+        if self.init == 'k-means++':
+            self.centroid_array = kmeans_plusplus(self.data, self.k, self.rng)
+        else:
+            indices = self.rng.choice(len(self.data), self.k, replace=False)
+            self.centroid_array = self.data[indices].copy()
+
+    def neighbor_index(self):
+        """
+        Builds the index of the current centroids
+        :return: the NeighborIndex
+        """
+
+        return neighbors.NeighborIndex(self.centroid_array, self.neighbor_backend, chunk_size=self.chunk_size)
+
+    def counts_every_distance(self):
+        """
+        :return: whether the searches of the index compute the distance of every point to every centroid, as the brute
+                 force does. The trees compute fewer, so for them n * k is only an upper bound
+        """
+
+        backend = self.neighbor_backend
+        if backend == 'auto':
+            backend = neighbors.choose_backend(*self.centroid_array.shape)
+        return backend == 'brute'
+
+    def assign_clusters(self):
+        """
+        Assign each point to the nearest centroid, with the index of the centroids (the brute force computes the
+        distances chunk by chunk). It also keeps the inertia (sum of squared distances of the points to their centroid)
+        :return: nothing
+        """
+
+        self.labels, distances = self.neighbor_index().nearest(self.data, squared=True)
+        self.inertia = float(distances.sum())
+
+    def nearest_two(self, points: np.ndarray):
+        """
+        Finds the closest centroid of every point, and the distances to the closest and the second closest centroid
+        :param points: (m, d) array with the points
+        :return: tuple of (labels, closest distances, second closest distances)
+        """
+
+        index = self.neighbor_index()
+        if self.k == 1:
+            labels, closest = index.nearest(points)
+            return labels, closest, np.full(len(points), np.inf)
+        distances, indices = index.kneighbors(points, 2)
+        return indices[:, 0], distances[:, 0], distances[:, 1]
+
+    def assign_clusters_hamerly(self):
+        """
+        Assign each point to the nearest centroid using Hamerly's bounds, so only the points whose centroid may have
+        changed are examined. The first call computes every distance and initialises the bounds
+        :return: nothing
+        """
+
+        n = len(self.data)
+        if self.upper_bounds is None:
+            self.labels, self.upper_bounds, self.lower_bounds = self.nearest_two(self.data)
+            self.distance_counts.append({'computed': n * self.k, 'skipped': 0, 'exact': self.counts_every_distance()})
+            return
+
+        centroid_distances = np.sqrt(squared_euclidean_distances(self.centroid_array, self.centroid_array))
+        np.fill_diagonal(centroid_distances, np.inf)
+        half_separation = 0.5 * centroid_distances.min(axis=1)
+        bounds = np.maximum(half_separation[self.labels], self.lower_bounds)
+
+        # Tighten the upper bound of the points that may have changed centroid
+        candidates = np.flatnonzero(self.upper_bounds > bounds)
+        differences = self.data[candidates] - self.centroid_array[self.labels[candidates]]
+        self.upper_bounds[candidates] = np.sqrt(np.einsum('ij,ij->i', differences, differences))
+        computed = len(candidates)
+
+        # The points that are still not ruled out are compared with every centroid
+        remaining = candidates[self.upper_bounds[candidates] > bounds[candidates]]
+        exact = True
+        if len(remaining):
+            labels, closest, second = self.nearest_two(self.data[remaining])
+            self.labels[remaining] = labels
+            self.upper_bounds[remaining] = closest
+            self.lower_bounds[remaining] = second
+            computed += len(remaining) * self.k
+            exact = self.counts_every_distance()
+
+        self.distance_counts.append({'computed': computed, 'skipped': n * self.k - computed, 'exact': exact})
+
+    def update_bounds(self, old_centroids: np.ndarray):
+        """
+        Moves the bounds by the distance that the centroids moved, so they stay valid for the new centroids
+        :param old_centroids: the centroids before the update
+        :return: nothing
+        """
+
+        shifts = np.sqrt(((self.centroid_array - old_centroids) ** 2).sum(axis=1))
+        self.upper_bounds += shifts[self.labels]
+
+        # The second closest centroid can be any centroid except the own one, so the largest other shift is used
+        order = np.argsort(shifts)[::-1]
+        largest = shifts[order[0]]
+        second_largest = shifts[order[1]] if self.k > 1 else 0.0
+        self.lower_bounds -= np.where(self.labels == order[0], second_largest, largest)
+
+    def update_centroids(self):
+        """
+        Updates centroids to the mean of their clusters with a grouped reduction over the label array.
+        Centroids of empty clusters stay where they are
+        :return: nothing
+        """
+
+        counts = np.bincount(self.labels, minlength=self.k)
+        sums = np.column_stack([np.bincount(self.labels, weights=self.data[:, j], minlength=self.k)
+                                for j in range(self.data.shape[1])])
+        non_empty = counts > 0
+        self.centroid_array[non_empty] = sums[non_empty] / counts[non_empty, np.newaxis]
+
+    def has_converged(self, old_centroids: np.ndarray):
+        """
+        Checks if the algorithm has converged. This means that the old centroids are not updated, or that none of
+        them moved more than `tolerance` relative to the spread of the data.
+        :return: boolean value indicating if the algorithm has converged or not
+        """
+
+        if self.tolerance == 0:
+            return np.array_equal(old_centroids, self.centroid_array)
+
+        shifts = np.sqrt(((self.centroid_array - old_centroids) ** 2).sum(axis=1))
+        return shifts.max() <= self.tolerance * self.scale
+
+    @instrumentation.traced('kmeans.fit')
+    def fit(self, data: np.ndarray, max_iterations: int):
+        """
+        Runs the k-means algorithm on data that are already in memory, n_init times if restarts were requested
+        :param data: (n, d) array with the points
+        :param max_iterations: maximum number of iterations of every restart
+        :return: dictionary with the inertia and the iterations of the kept result and of every restart
+        """
+
+        self.data = np.ascontiguousarray(data, dtype=np.float64)
+        instrumentation.add_rows(len(self.data))
+        self.scale = float(np.sqrt(self.data.var(axis=0).mean()))
+        if self.n_init > 1:
+            self.fit_restarts(max_iterations)
+        else:
+            self.fit_once(max_iterations)
+            self.restart_inertias = [self.inertia]
+            self.restart_iterations = [self.n_iterations]
+
+        return {
+            'inertia': self.inertia,
+            'n_iterations': self.n_iterations,
+            'total_iterations': sum(self.restart_iterations),
+            'restart_inertias': self.restart_inertias,
+            'restart_iterations': self.restart_iterations,
+            'distance_counts': self.distance_counts,
+        }
+
+    @instrumentation.traced('kmeans.fit_restarts')
+    def fit_restarts(self, max_iterations: int):
+        """
+        Runs n_init independent restarts in parallel processes and keeps the centroids with the lowest inertia.
+        Every restart gets its own child seed, so the whole run can be reproduced from `seed`
+        :param max_iterations: maximum number of iterations of every restart
+        :return: nothing
+        """
+
+        seed = self.seed if isinstance(self.seed, np.random.SeedSequence) else np.random.SeedSequence(self.seed)
+        seeds = seed.spawn(self.n_init)
+        workers = min(self.n_jobs or os.cpu_count() or 1, self.n_init)
+        parameters = {'k': self.k, 'chunk_size': self.chunk_size, 'init': self.init, 'tolerance': self.tolerance,
+                      'algorithm': self.algorithm, 'neighbor_backend': self.neighbor_backend}
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_initialise_restart_worker,
+                                 initargs=(self.data,)) as executor:
+            results = list(executor.map(_run_restart, [parameters] * self.n_init, seeds,
+                                        [max_iterations] * self.n_init))
+
+        self.restart_inertias = [inertia for _, inertia, _, _ in results]
+        self.restart_iterations = [iterations for _, _, iterations, _ in results]
+        best = int(np.argmin(self.restart_inertias))
+        self.centroid_array = results[best][0]
+        self.n_iterations = self.restart_iterations[best]
+        self.distance_counts = results[best][3]
+        self.assign_clusters()
+
+    @instrumentation.traced('kmeans.fit_once')
+    def fit_once(self, max_iterations: int):
+        """
+        Runs the k-means algorithm once on the loaded data
+        :param max_iterations: maximum number of iterations
+        :return: nothing
+        """
+
+        self.initialise_centroids()
+
+        self.n_iterations = 0
+        self.distance_counts = []
+        self.upper_bounds = None
+        self.lower_bounds = None
+        n_distances = len(self.data) * self.k
+        exact = self.counts_every_distance()
+
+        for i in range(max_iterations):
+            old_centroids = self.centroid_array.copy()
+            if self.algorithm == 'hamerly':
+                self.assign_clusters_hamerly()
+                self.update_centroids()
+                self.update_bounds(old_centroids)
+            else:
+                self.assign_clusters()
+                self.distance_counts.append({'computed': n_distances, 'skipped': 0, 'exact': exact})
+                self.update_centroids()
+            self.n_iterations = i + 1
+
+            if instrumentation.enabled():
+                # Inertia of the assignment of this iteration. It is only computed while recording
+                differences = self.data - old_centroids[self.labels]
+                instrumentation.event('kmeans.iteration', k=self.k, iteration=self.n_iterations,
+                                      inertia=float(np.einsum('ij,ij->i', differences, differences).sum()))
+
+            if self.has_converged(old_centroids):
+                break
+
+        self.assign_clusters()      # Labels and inertia of the final centroids
+
+    @instrumentation.traced('kmeans.run')
+    def run(self, max_iterations: int):
+        """
+        Runs the k-means algorithm
+        :return: dictionary with the inertia and the iterations of the kept result and of every restart
+        """
+
+        self.load_data()
+        return self.fit(self.data, max_iterations)
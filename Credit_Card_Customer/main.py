@@ -177,7 +177,7 @@ del hierarchical
 """
 
 # Initialize the class
-a = kMeans.KMeans(optimal_clusters, file_path="output_with_outliers.csv")
+a = kMeans.VectorizedKMeans(optimal_clusters, file_path="output_with_outliers.csv")
 
 # Run the k-means algorithm
 a.run(100)      # Μέγιστο πλήθος επαναλήψεων να είναι το 100. Ο αλγόριθμος ίσως να μη συγκλίνει ακριβώς
@@ -198,11 +198,12 @@ a.plot_results()
 Αυτό γίνεται με τη βοήθεια της κλάσης OutlierDetector που βρίσκεται στο αρχείο 'find_outliers.py'
 """
 
-# Initialise the class
-b = find_outliers.OutlierDetector(optimal_clusters, outlier_percentile=99, file_path="output_with_outliers.csv")
+# Initialise the class. The data that the k-means loaded are reused, so the file is not read again
+b = find_outliers.OutlierDetector(optimal_clusters, outlier_percentile=99, file_path="output_with_outliers.csv",
+                                  data=a.data)
 
-# Find the outliers using the centroids found by the k-means algorithm
-b.run(a.centroids)
+# Find the outliers using the centroids and the labels found by the k-means algorithm
+b.run(a.centroids, labels=a.labels)
 
 del a
 del b
\ No newline at end of file
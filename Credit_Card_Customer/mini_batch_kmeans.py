@@ -0,0 +1,257 @@
+"""
+This class implements a mini-batch (streaming) version of the k-means algorithm.
+
+Instead of loading the whole file before running, like 'kMeans.py' does, it reads the data in fixed-size chunks and
+updates the centroids incrementally using a per-centroid count of the points it has seen so far. This way files bigger
+than the memory can be clustered, and new batches of customers can refine existing centroids with `partial_fit`
+without reading the history again.
+
+The files are often sorted (by segment, by date), so the first batch is not a good picture of the data: `run` seeds
+the centroids with a few runs of k-means on a uniform sample of the whole file instead. A centroid that still wins almost no points over a
+whole pass is moved onto a point of the sample that is far from the other centroids.
+"""
+
+from typing import List
+
+import numpy as np
+
+import binary_store
+from kMeans import VectorizedKMeans, kmeans_plusplus
+from neighbors import squared_euclidean_distances
+
+
+class MiniBatchKMeans(VectorizedKMeans):
+    def __init__(self, k: int, file_path: str, batch_size: int = 4096, tolerance: float = 1e-4,
+                 init: str = 'k-means++', seed=None, columns: List[str] = None, neighbor_backend: str = 'auto',
+                 init_size: int = None, n_init: int = 3, reassignment_ratio: float = 0.01):
+        """
+        Constructor
+        :param k: the variable k that contains the number of clusters
+        :param file_path: the CSV file (or binary table, or '.npy' file) that contains the data. It is read in chunks
+        :param batch_size: number of points in every chunk
+        :param tolerance: the largest centroid shift over a whole pass of the file for which we consider
+                          that the algorithm has converged
+        :param init: how the centroids are initialised from the sample, 'k-means++' or 'random'
+        :param seed: seed of the random generator, so that a run can be reproduced
+        :param columns: names of the columns to cluster on. None uses every column. For '.npy' files every
+                        column is used
+        :param neighbor_backend: how the nearest centroids are found (see 'neighbors.py')
+        :param init_size: number of points of the sample of the whole file that seeds the centroids. None uses
+                          3 * batch_size
+        :param n_init: number of runs of k-means on the sample. The centroids of the one with the lowest inertia are
+                       the initial centroids
+        :param reassignment_ratio: a centroid that wins fewer points in a pass than this fraction of the points of the
+                                   largest centroid is reassigned
+        """
+
+        super().__init__(k, file_path, init=init, seed=seed, n_init=n_init, columns=columns,
+                         neighbor_backend=neighbor_backend)
+        self.batch_size = batch_size
+        self.tolerance = tolerance
+        self.init_size = init_size
+        self.reassignment_ratio = reassignment_ratio
+        self.sample = None
+        self.reassignments = 0
+        self.counts = np.zeros(k, dtype=np.int64)
+        self.centroid_shifts = []
+        self.converged = False
+
+    def iter_batches(self):
+        """
+        Reads the data file chunk by chunk. CSV files are parsed with pandas, binary tables and '.npy' files are
+        memory-mapped so only the current chunk is read from the disk
+        :return: generator of (batch_size, d) float64 arrays
+        """
+
+        if self.file_path.endswith('.npy'):
+            data = np.load(self.file_path, mmap_mode='r')
+            for start in range(0, len(data), self.batch_size):
+                yield np.ascontiguousarray(data[start:start + self.batch_size], dtype=np.float64)
+        else:
+            # The columns come in the order of `columns` for both formats, like in `load_data`
+            yield from binary_store.iter_chunks(self.file_path, self.columns, self.batch_size)
+
+    def sample_file(self, size: int):
+        """
+        Takes a uniform sample of the points of the whole file, without replacement. Binary tables and '.npy' files
+        are memory-mapped, so only the sampled rows are read. CSV files are streamed once, and every point gets a
+        random key: the points with the `size` smallest keys are a uniform sample (a reservoir sample)
+        :param size: the number of points
+        :return: (size, d) array, or all the points if the file has fewer
+        """
+
+        if self.file_path.endswith('.npy') or binary_store.is_binary_table(self.file_path):
+            if self.file_path.endswith('.npy'):
+                data = np.load(self.file_path, mmap_mode='r')
+            else:
+                data = binary_store.load_array(self.file_path, self.columns)
+            rows = np.sort(self.rng.choice(len(data), min(size, len(data)), replace=False))
+            return np.ascontiguousarray(data[rows], dtype=np.float64)
+
+        sample, keys = None, np.empty(0)
+        for batch in self.iter_batches():
+            batch_keys = self.rng.random(len(batch))
+            sample = batch if sample is None else np.concatenate([sample, batch])
+            keys = np.concatenate([keys, batch_keys])
+            if len(keys) > size:
+                kept = np.argpartition(keys, size)[:size]
+                sample, keys = sample[kept], keys[kept]
+        return sample
+
+    def initialise_centroids_from(self, batch: np.ndarray):
+        """
+        Initialises the centroids from the points of a batch (or a sample) with k-means++ or by choosing random points
+        :param batch: array with at least k points
+        :return: nothing
+        """
+
+        if batch is None or len(batch) < self.k:
+            raise ValueError(f"The data has {0 if batch is None else len(batch)} points, at least k={self.k} "
+                             f"are needed")
+
+        batch = np.ascontiguousarray(batch, dtype=np.float64)
+        if self.init == 'k-means++':
+            self.centroid_array = kmeans_plusplus(batch, self.k, self.rng)
+        else:
+            self.centroid_array = batch[self.rng.choice(len(batch), self.k, replace=False)].copy()
+        self.counts = np.zeros(self.k, dtype=np.int64)
+
+    def initialise_centroids_from_sample(self, sample: np.ndarray, max_iterations: int = 100):
+        """
+        Initialises the centroids with n_init runs of k-means on a sample of the whole file and keeps the centroids of
+        the run with the lowest inertia. The sample is small, so the runs are in memory and one after the other
+        :param sample: array with at least k points
+        :param max_iterations: maximum number of iterations of every run
+        :return: nothing
+        """
+
+        self.initialise_centroids_from(sample)
+        best = None
+        for _ in range(self.n_init):
+            model = VectorizedKMeans(self.k, None, init=self.init, seed=int(self.rng.integers(2 ** 31)),
+                                     neighbor_backend=self.neighbor_backend)
+            model.fit(sample, max_iterations)
+            if best is None or model.inertia < best.inertia:
+                best = model
+        self.centroid_array = best.centroid_array.copy()
+
+    def partial_fit(self, batch: np.ndarray):
+        """
+        Updates the centroids with a new batch of points.
+
+        Every centroid moves towards the mean of its new points with a learning rate of 1 / (number of points it has
+        been assigned so far), so it is always the running mean of all the points that were assigned to it.
+        Without centroids yet, they are initialised from this batch (`run` initialises them from a sample of the
+        whole file first).
+
+        :param batch: (m, d) array with the new points
+        :return: the largest distance that a centroid moved
+        """
+
+        batch = np.ascontiguousarray(batch, dtype=np.float64)
+        if len(self.centroid_array) != self.k:
+            self.initialise_centroids_from(batch)
+
+        labels, _ = self.neighbor_index().nearest(batch)
+        batch_counts = np.bincount(labels, minlength=self.k)
+        batch_sums = np.column_stack([np.bincount(labels, weights=batch[:, j], minlength=self.k)
+                                      for j in range(batch.shape[1])])
+
+        old_centroids = self.centroid_array.copy()
+        self.counts += batch_counts
+        updated = batch_counts > 0
+        self.centroid_array[updated] += ((batch_sums[updated] - batch_counts[updated, np.newaxis]
+                                          * self.centroid_array[updated]) / self.counts[updated, np.newaxis])
+
+        return self.centroid_shift(old_centroids)
+
+    def centroid_shift(self, old_centroids: np.ndarray):
+        """
+        Calculates how much the centroids moved
+        :param old_centroids: the centroids before the update
+        :return: the largest Euclidean distance between an old and a new centroid
+        """
+
+        return float(np.sqrt(squared_euclidean_distances(old_centroids, self.centroid_array).diagonal().max()))
+
+    def has_converged(self, old_centroids: np.ndarray):
+        """
+        Checks if the algorithm has converged. This means that no centroid moved more than `tolerance`
+        :return: boolean value indicating if the algorithm has converged or not
+        """
+
+        return self.centroid_shift(old_centroids) <= self.tolerance
+
+    def reassign_sparse_centroids(self, pass_counts: np.ndarray):
+        """
+        Moves the centroids that won almost no points in the last pass onto points of the sample, chosen like in
+        k-means++ with probability proportional to their squared distance from the closest centroid. The counts of
+        all the centroids are reset
+        :param pass_counts: the number of points that every centroid won in the pass
+        :return: the number of reassigned centroids
+        """
+
+        sparse = np.flatnonzero(pass_counts < self.reassignment_ratio * pass_counts.max())
+        if not len(sparse):
+            return 0
+        if self.sample is None:
+            self.sample = self.sample_file(self.init_size or 3 * self.batch_size)
+
+        kept = np.setdiff1d(np.arange(self.k), sparse)
+        closest = squared_euclidean_distances(self.sample, self.centroid_array[kept]).min(axis=1)
+        for j in sparse:
+            if closest.sum() > 0:
+                index = self.rng.choice(len(self.sample), p=closest / closest.sum())
+            else:
+                index = self.rng.integers(len(self.sample))     # Every point lies on a centroid
+            self.centroid_array[j] = self.sample[index]
+            np.minimum(closest, squared_euclidean_distances(self.sample, self.sample[index:index + 1])[:, 0],
+                       out=closest)
+        # The other centroids won the points of the reassigned ones in the last pass, so every centroid starts again as
+        # the running mean of the points it wins from now on
+        self.counts[:] = 0
+        self.reassignments += len(sparse)
+        return len(sparse)
+
+    def predict(self, batch: np.ndarray):
+        """
+        Finds the nearest centroid of every point
+        :param batch: (m, d) array with the points
+        :return: integer array with the cluster of every point
+        """
+
+        batch = np.ascontiguousarray(batch, dtype=np.float64)
+        labels, _ = self.neighbor_index().nearest(batch)
+        return labels
+
+    def run(self, max_iterations: int):
+        """
+        Runs the mini-batch k-means algorithm, streaming the whole file once per iteration
+        :param max_iterations: maximum number of passes over the file
+        :return: nothing
+        """
+
+        self.n_iterations = 0
+        self.centroid_shifts = []
+        self.converged = False
+        self.reassignments = 0
+
+        if len(self.centroid_array) != self.k:
+            self.sample = self.sample_file(self.init_size or 3 * self.batch_size)
+            self.initialise_centroids_from_sample(self.sample)
+
+        for i in range(max_iterations):
+            old_centroids = self.centroid_array.copy()
+            start_counts = self.counts.copy()
+            for batch in self.iter_batches():
+                self.partial_fit(batch)
+            self.n_iterations = i + 1
+            self.reassign_sparse_centroids(self.counts - start_counts)
+
+            if len(old_centroids) == self.k:
+                self.centroid_shifts.append(self.centroid_shift(old_centroids))
+                if self.has_converged(old_centroids):
+                    self.converged = True
+                    break
+
+        print(f"Mini-batch k-means {'converged' if self.converged else 'stopped'} after {self.n_iterations} passes")
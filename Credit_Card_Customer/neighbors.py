@@ -0,0 +1,216 @@
+"""
+This class finds the nearest neighbors of points among a set of items (the centroids of the k-means, or the points
+themselves for density-based outlier scores), with one of three backends:
+    'brute': the distances to every item, computed chunk by chunk with `squared_euclidean_distances`. The fastest for
+             few items (the usual k of the k-means), whatever the dimension
+    'kd_tree': a KD-tree of SciPy (cKDTree). The fastest for many items in few dimensions (hundreds of micro-segments
+               of the PCA components), and for the neighbors of the points among themselves, where the brute force
+               is quadratic
+    'ball_tree': a ball tree of scikit-learn, for data whose structure suits it better than axis-aligned splits
+'auto' picks the backend from the number of items and the dimension (see `choose_backend`). The thresholds come from
+measurements with clustered data: the KD-tree beat the brute force from about 128 centroids in up to 8 dimensions,
+and beat the ball tree for the k nearest neighbors of 50000 points in every dimension up to 40, so 'auto' never picks
+the ball tree.
+
+Every query is timed, and the total time and number of queried points of every backend are kept in `TIMINGS` (the
+indexes of the k-means are rebuilt in every iteration, so the timings are not kept per index). `report_timings`
+prints them; 'cli.py' does so at the end of a run with `--trace`, and 'benchmarks.py' for every measurement.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+BACKENDS = ('brute', 'kd_tree', 'ball_tree')
+
+MIN_TREE_ITEMS = 128
+MAX_KD_TREE_DIMENSION = 8
+MIN_LARGE_ITEMS = 10000
+MAX_LARGE_KD_TREE_DIMENSION = 32
+
+TIMINGS = {}
+_timings_lock = threading.Lock()      # The indexes can be queried from several threads
+
+
+def squared_euclidean_distances(points: np.ndarray, centroids: np.ndarray):
+    """
+    Calculates the squared Euclidean distance between every point and every centroid in batched matrix form,
+    using ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2 so that the heavy part is a single matrix product
+    :param points: (n, d) float64 array with the points
+    :param centroids: (k, d) float64 array with the centroids
+    :return: (n, k) array with the squared distances
+    """
+
+    distances = points @ centroids.T
+    distances *= -2
+    distances += np.einsum('ij,ij->i', points, points)[:, np.newaxis]
+    distances += np.einsum('ij,ij->i', centroids, centroids)[np.newaxis, :]
+    np.maximum(distances, 0, out=distances)     # Rounding can make the result slightly negative
+    return distances
+
+
+def choose_backend(n_items: int, dimension: int):
+    """
+    Picks the fastest backend for a number of items and a dimension
+    :param n_items: the number of items of the index
+    :param dimension: the number of features
+    :return: 'brute', 'kd_tree' or 'ball_tree'
+    """
+
+    if n_items >= MIN_TREE_ITEMS and dimension <= MAX_KD_TREE_DIMENSION:
+        return 'kd_tree'
+    if n_items >= MIN_LARGE_ITEMS and dimension <= MAX_LARGE_KD_TREE_DIMENSION:
+        return 'kd_tree'
+    return 'brute'
+
+
+def record_timing(backend: str, operation: str, seconds: float, n_points: int):
+    """
+    Adds a build or a query of an index to the timings of its backend
+    :param backend: 'brute', 'kd_tree' or 'ball_tree'
+    :param operation: 'build' or 'query'
+    :param seconds: how long it took
+    :param n_points: the number of queried points (not used for a build)
+    :return: nothing
+    """
+
+    with _timings_lock:
+        timing = TIMINGS.setdefault(backend, {'builds': 0, 'build_time': 0.0, 'queries': 0, 'query_time': 0.0,
+                                              'points': 0})
+        if operation == 'build':
+            timing['builds'] += 1
+            timing['build_time'] += seconds
+        else:
+            timing['queries'] += 1
+            timing['query_time'] += seconds
+            timing['points'] += n_points
+
+
+def reset_timings():
+    """
+    Forgets the timings of every backend
+    :return: nothing
+    """
+
+    TIMINGS.clear()
+
+
+def report_timings(timings: dict = None, indent: str = ''):
+    """
+    Prints the build and query times of every backend that was used
+    :param timings: the timings to print, in the format of `TIMINGS`. None prints `TIMINGS`
+    :param indent: the start of every line
+    :return: nothing
+    """
+
+    for backend, timing in (TIMINGS if timings is None else timings).items():
+        rate = timing['points'] / timing['query_time'] if timing['query_time'] > 0 else float('inf')
+        print(f"{indent}{backend}: {timing['builds']} builds in {timing['build_time']:.3f} s, {timing['queries']} queries of "
+              f"{timing['points']} points in {timing['query_time']:.3f} s ({rate:,.0f} points/s)")
+
+
+class NeighborIndex:
+    def __init__(self, items: np.ndarray, backend: str = 'auto', chunk_size: int = 65536, leaf_size: int = 40):
+        """
+        Constructor. Builds the index
+        :param items: (n, d) array with the items (e.g. the centroids)
+        :param backend: 'auto', 'brute', 'kd_tree' or 'ball_tree'
+        :param chunk_size: number of points whose distances are computed at once by the brute force
+        :param leaf_size: number of items in a leaf of the trees
+        """
+
+        self.items = np.ascontiguousarray(items, dtype=np.float64)
+        if backend == 'auto':
+            backend = choose_backend(*self.items.shape)
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend '{backend}'. Use 'auto', 'brute', 'kd_tree' or 'ball_tree'")
+
+        self.backend = backend
+        self.chunk_size = chunk_size
+
+        start = time.perf_counter()
+        if backend == 'kd_tree':
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree(self.items, leafsize=leaf_size)
+        elif backend == 'ball_tree':
+            from sklearn.neighbors import BallTree
+            self.tree = BallTree(self.items, leaf_size=leaf_size)
+        else:
+            self.tree = None
+        record_timing(backend, 'build', time.perf_counter() - start, 0)
+
+    def nearest(self, points: np.ndarray, squared: bool = False):
+        """
+        Finds the nearest item of every point
+        :param points: (m, d) array with the points
+        :param squared: if True, the squared distances are returned
+        :return: tuple of (indices, distances)
+        """
+
+        start = time.perf_counter()
+        points = np.asarray(points, dtype=np.float64)
+        if self.backend == 'brute':
+            indices = np.empty(len(points), dtype=np.intp)
+            distances = np.empty(len(points))
+            for begin in range(0, len(points), self.chunk_size):
+                chunk_distances = squared_euclidean_distances(points[begin:begin + self.chunk_size], self.items)
+                chunk_indices = np.argmin(chunk_distances, axis=1)
+                indices[begin:begin + self.chunk_size] = chunk_indices
+                distances[begin:begin + self.chunk_size] = chunk_distances[np.arange(len(chunk_indices)),
+                                                                           chunk_indices]
+            if not squared:
+                distances = np.sqrt(np.maximum(distances, 0.0))
+        else:
+            distances, indices = self.query_tree(points, 1)
+            distances, indices = distances[:, 0], indices[:, 0]
+            if squared:
+                distances = distances ** 2
+        record_timing(self.backend, 'query', time.perf_counter() - start, len(points))
+        return indices, distances
+
+    def kneighbors(self, points: np.ndarray, n_neighbors: int):
+        """
+        Finds the n_neighbors nearest items of every point, from the nearest to the farthest
+        :param points: (m, d) array with the points
+        :param n_neighbors: the number of neighbors
+        :return: tuple of ((m, n_neighbors) distances, (m, n_neighbors) indices)
+        """
+
+        if n_neighbors > len(self.items):
+            raise ValueError(f"{n_neighbors} neighbors were asked, but the index has {len(self.items)} items")
+
+        start = time.perf_counter()
+        points = np.asarray(points, dtype=np.float64)
+        if self.backend == 'brute':
+            distances = np.empty((len(points), n_neighbors))
+            indices = np.empty((len(points), n_neighbors), dtype=np.intp)
+            # A chunk holds (chunk rows, items) distances, so it gets smaller when there are many items
+            rows = max(1, self.chunk_size * 16 // max(len(self.items), 1))
+            for begin in range(0, len(points), rows):
+                chunk_distances = squared_euclidean_distances(points[begin:begin + rows], self.items)
+                nearest = np.argpartition(chunk_distances, n_neighbors - 1, axis=1)[:, :n_neighbors]
+                nearest_distances = np.take_along_axis(chunk_distances, nearest, axis=1)
+                order = np.argsort(nearest_distances, axis=1, kind='stable')
+                chunk_indices = np.take_along_axis(nearest, order, axis=1)
+                indices[begin:begin + rows] = chunk_indices
+
+                # The expansion of the squared distance loses precision for close points, and the neighbors are close
+                # by definition, so their distances are computed again directly
+                differences = points[begin:begin + rows, np.newaxis, :] - self.items[chunk_indices]
+                distances[begin:begin + rows] = np.sqrt(np.einsum('ijk,ijk->ij', differences, differences))
+        else:
+            distances, indices = self.query_tree(points, n_neighbors)
+        record_timing(self.backend, 'query', time.perf_counter() - start, len(points))
+        return distances, indices
+
+    def query_tree(self, points: np.ndarray, n_neighbors: int):
+        """
+        Queries the tree of the index
+        :return: tuple of ((m, n_neighbors) distances, (m, n_neighbors) indices)
+        """
+
+        if self.backend == 'kd_tree':
+            distances, indices = self.tree.query(points, k=n_neighbors)
+            return distances.reshape(len(points), n_neighbors), indices.reshape(len(points), n_neighbors)
+        return self.tree.query(points, k=n_neighbors)
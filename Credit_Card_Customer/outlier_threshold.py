@@ -0,0 +1,113 @@
+"""
+This file computes the thresholds of the outlier detectors ('find_outliers.py', 'density_outliers.py') in two modes:
+    Exact: the percentile is found by partial selection (`np.partition`, linear time) on the array of the scores, and
+    the top outliers by `np.argpartition`, so only the outliers themselves are sorted
+    Streaming: a StreamingThreshold is updated with the scores of every chunk of a file, so the detection runs over a
+    file larger than the memory in one pass. A quantile sketch ('quantile_sketch.py') estimates the threshold, and the
+    points that may end up over it are kept as candidates. This is approximate: the threshold is within the rank
+    error of the sketch, and a point is dropped from the candidates when its score falls under a lower estimate of the
+    threshold, which for data in random order does not happen to the true outliers
+"""
+
+import numpy as np
+
+import quantile_sketch
+
+
+def exact_threshold(scores: np.ndarray, percentile: float):
+    """
+    Computes a percentile of the scores by partial selection. The result is the same as `np.percentile` (linear
+    interpolation between the two closest ranks)
+    :param scores: 1-D array with the scores
+    :param percentile: the percentile, between 0 and 100
+    :return: the threshold
+    """
+
+    scores = np.asarray(scores, dtype=np.float64)
+    rank = percentile / 100 * (len(scores) - 1)
+    low, high = int(np.floor(rank)), int(np.ceil(rank))
+    selected = np.partition(scores, [low, high])
+    return float(selected[low] + (selected[high] - selected[low]) * (rank - low))
+
+
+def top_outliers(scores: np.ndarray, count: int):
+    """
+    Finds the points with the highest scores
+    :param scores: 1-D array with the scores
+    :param count: how many points
+    :return: array with the indices of the points, from the highest score to the lowest
+    """
+
+    scores = np.asarray(scores)
+    count = min(count, len(scores))
+    if count == 0:
+        return np.empty(0, dtype=np.intp)
+    top = np.argpartition(scores, len(scores) - count)[len(scores) - count:]
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+class StreamingThreshold:
+    def __init__(self, percentile: float, capacity: int = 4096, margin: float = 0.002):
+        """
+        Constructor
+        :param percentile: the percentile of the threshold, between 0 and 100
+        :param capacity: capacity of the quantile sketch
+        :param margin: how far under the percentile (as a fraction of the points, on top of the error of the sketch)
+                       the candidates are kept
+        """
+
+        self.percentile = percentile
+        self.margin = margin
+        self.sketch = quantile_sketch.QuantileSketch(capacity)
+        self.count = 0
+        self.candidate_indices = np.empty(0, dtype=np.intp)
+        self.candidate_scores = np.empty(0)
+
+    def update(self, scores: np.ndarray):
+        """
+        Adds the scores of the next chunk of points
+        :param scores: 1-D array with the scores of the chunk
+        :return: nothing
+        """
+
+        scores = np.asarray(scores, dtype=np.float64)
+        self.sketch.update(scores)
+        indices = np.arange(self.count, self.count + len(scores))
+        self.count += len(scores)
+
+        floor = self.lower_threshold()
+        keep = scores >= floor
+        self.candidate_indices = np.concatenate([self.candidate_indices, indices[keep]])
+        self.candidate_scores = np.concatenate([self.candidate_scores, scores[keep]])
+
+        # The estimate of the threshold only grows more accurate, so the candidates are pruned as it moves
+        if len(self.candidate_scores) > 2 * (1 - self.percentile / 100 + self.margin) * self.count + 1024:
+            kept = self.candidate_scores >= floor
+            self.candidate_indices = self.candidate_indices[kept]
+            self.candidate_scores = self.candidate_scores[kept]
+
+    def lower_threshold(self):
+        """
+        :return: a lower estimate of the threshold. The points under it can not be outliers
+        """
+
+        quantile = self.percentile / 100 - self.margin - 2 * self.sketch.relative_error()
+        return self.sketch.quantile(max(quantile, 0.0)) if quantile > 0 else -np.inf
+
+    def threshold(self):
+        """
+        :return: the estimate of the threshold
+        """
+
+        return self.sketch.quantile(self.percentile / 100)
+
+    def outliers(self):
+        """
+        Finds the outliers among the candidates
+        :return: tuple of (indices of the outliers from the highest score to the lowest, their scores)
+        """
+
+        above = self.candidate_scores > self.threshold()
+        indices, scores = self.candidate_indices[above], self.candidate_scores[above]
+        order = np.argsort(-scores, kind='stable')
+        return indices[order], scores[order]
@@ -4,48 +4,365 @@ The first two columns, that are IDs, are removed from the start (check the 'prep
 It saves the dimensional reduced data to a new file 'pca_reduced_data.csv'
 
 It is also the calculates the percentage of the information that it is conserved after the dimensionality reduction. It prints this value
+
+There are three modes:
+    'full': the exact PCA of sklearn on the whole data
+    'randomized': randomized SVD, which is much faster than the exact one for wide data and few components
+    'incremental': the mean and the covariance matrix are accumulated chunk by chunk (with Chan's formula) and the
+                   components are the eigenvectors of the covariance, so the file is never in the memory at once.
+                   It gives the same components as 'full' (the memory is d x d, fine for the few features of the
+                   customers), and `fit_transform_file` also writes the projection chunk by chunk
+The fitted model (components, means and explained variance) can be saved and loaded, so new customers are projected
+with `transform` on the same basis, without fitting again, and whole files are projected in parallel by worker
+processes with `transform_file`.
 """
 
+import io
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import numpy as np
 import pandas as pd
-from sklearn.decomposition import PCA
+
+import binary_store
+import instrumentation
+
+
+def csv_byte_ranges(file_path: str, chunk_bytes: int):
+    """
+    Splits a CSV file (after its header) into byte ranges of about `chunk_bytes` that start and end at line breaks
+    :param file_path: path of the file
+    :param chunk_bytes: approximate size of every range
+    :return: list of (start, end) offsets
+    """
+
+    size = os.path.getsize(file_path)
+    ranges = []
+    with open(file_path, 'rb') as file:
+        file.readline()
+        start = file.tell()
+        while start < size:
+            file.seek(min(start + chunk_bytes, size))
+            if file.tell() < size:
+                file.readline()     # Move to the start of the next line
+            end = file.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+_projection_model = None
+
+
+def _initialise_projection_worker(columns: List[str], mean: np.ndarray, components: np.ndarray):
+    """
+    Stores the PCA model in a worker process once, so it is not sent again with every part of the file
+    :return: nothing
+    """
+
+    global _projection_model
+    _projection_model = (columns, mean, components)
+
+
+def _project_part(part: tuple):
+    """
+    Reads and projects one part of the input file in a worker process
+    :param part: tuple of (format, path, start, end, as_text). The start and the end are byte offsets for a CSV file
+                 and rows for a binary table. With as_text, the projection is also formatted as CSV lines in the worker,
+                 because formatting costs more than the projection itself
+    :return: (m, n_components) array, or the CSV text
+    """
+
+    columns, mean, components = _projection_model
+    kind, file_path, start, end, as_text = part
+    if kind == 'binary':
+        block = np.asarray(binary_store.load_array(file_path, columns)[start:end], dtype=np.float64)
+    else:
+        with open(file_path, 'rb') as file:
+            file.seek(start)
+            raw = file.read(end - start)
+        header = binary_store.table_columns(file_path)
+        block = pd.read_csv(io.BytesIO(raw), header=None, names=header, usecols=columns)[columns].to_numpy(
+            dtype=np.float64)
+    projected = (block - mean) @ components.T
+    return pd.DataFrame(projected).to_csv(header=False, index=False) if as_text else projected
+
+
+def _ordered_results(executor, function, items, window: int):
+    """
+    Runs a function over items in a pool and yields the results in the order of the items, with at most `window`
+    tasks submitted at a time
+    """
+
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 
 class PCAProcessor:
-    def __init__(self, n_components: int):
+    def __init__(self, n_components: int, mode: str = 'full', chunk_size: int = 100000, random_state: int = None):
         """
         Constructor
         :param n_components: integer that contains the number of principal components to retain.
+        :param mode: 'full', 'randomized' or 'incremental'
+        :param chunk_size: number of rows of every chunk in the incremental mode
+        :param random_state: seed of the randomized SVD
         """
 
+        if mode not in ('full', 'randomized', 'incremental'):
+            raise ValueError(f"Unknown PCA mode '{mode}'. Use 'full', 'randomized' or 'incremental'")
+
         self.n_components = n_components
-        self.pca = PCA(n_components=self.n_components)
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.random_state = random_state
+        self.pca = None     # The PCA of sklearn, created by fit_transform so sklearn is only imported to fit
+
+        # The fitted model, set by the fit methods or by load_model
+        self.columns = None
+        self.components = None
+        self.mean = None
+        self.explained_variance = None
+        self.explained_variance_ratio = None
+
+    def output_columns(self):
+        return [f'PCA{i + 1}' for i in range(self.n_components)]
+
+    def store_model(self, columns: List[str]):
+        """
+        Keeps the fitted model of sklearn as arrays
+        :param columns: the names of the input columns
+        :return: nothing
+        """
+
+        self.columns = list(columns)
+        self.components = self.pca.components_
+        self.mean = self.pca.mean_
+        self.explained_variance = self.pca.explained_variance_
+        self.explained_variance_ratio = self.pca.explained_variance_ratio_
 
-    def fit_transform(self, file_path: str, output_path: str):
+    @instrumentation.traced('pca.fit_transform')
+    def fit_transform(self, file_path: str = None, output_path: str = None, data: pd.DataFrame = None):
         """
         Performs PCA on the dataset and reduce dimensions.
-        :param file_path: string that contains the path to the input CSV file.
-        :param output_path: string that contains the path to save the reduced dataset as a CSV file.
+        :param file_path: string that contains the path to the input CSV file (or binary table).
+        :param output_path: string that contains the path to save the reduced dataset as a CSV file (or binary table,
+                            if it ends with '.cbin').
+        :param data: a DataFrame that is already in memory. It is used instead of the input file
         :return: the DataFrame containing reduced dimensions.
         """
 
         # Load the dataset
-        data = pd.read_csv(file_path)
+        if data is None:
+            data = binary_store.read_table(file_path)
+        instrumentation.add_rows(len(data))
 
         # Apply PCA to reduce dimensions
-        reduced_features = self.pca.fit_transform(data)
+        if self.mode == 'incremental':
+            block = data.to_numpy(dtype=np.float64)
+            self.fit_chunks(np.array_split(block, max(1, -(-len(block) // self.chunk_size))), data.columns)
+            reduced_features = self.transform(block)
+        else:
+            from sklearn.decomposition import PCA
+
+            if self.mode == 'randomized':
+                self.pca = PCA(n_components=self.n_components, svd_solver='randomized', random_state=self.random_state)
+            else:
+                self.pca = PCA(n_components=self.n_components)
+            reduced_features = self.pca.fit_transform(data)
+            self.store_model(data.columns)
 
         # Create a DataFrame for the PCA results
-        reduced_df = pd.DataFrame(reduced_features, columns=[f'PCA{i + 1}' for i in range(self.n_components)])
+        reduced_df = pd.DataFrame(reduced_features, columns=self.output_columns())
 
         # Save the reduced data to a CSV file if output_path is provided
         if output_path is not None:
-            reduced_df.to_csv(output_path, index=False)
+            binary_store.save_table(reduced_df, output_path)
 
         return reduced_df
-    
+
+    @instrumentation.traced('pca.fit_chunks')
+    def fit_chunks(self, chunks, columns: List[str]):
+        """
+        Fits the PCA chunk by chunk: accumulates the mean and the scatter matrix of the data and takes the
+        eigenvectors of the covariance matrix
+        :param chunks: iterable of (m, d) arrays
+        :param columns: the names of the input columns
+        :return: nothing
+        """
+
+        count = 0
+        mean = np.zeros(len(columns))
+        scatter = np.zeros((len(columns), len(columns)))
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+            chunk_mean = chunk.mean(axis=0)
+            centered = chunk - chunk_mean
+            delta = chunk_mean - mean
+            total = count + len(chunk)
+            mean += delta * len(chunk) / total
+            scatter += centered.T @ centered + np.outer(delta, delta) * count * len(chunk) / total
+            count = total
+        instrumentation.add_rows(count)
+
+        covariance = scatter / (count - 1)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:self.n_components]
+        components = eigenvectors[:, order].T
+
+        # Same signs as sklearn: the largest entry (in absolute value) of every component is positive
+        signs = np.sign(components[np.arange(len(components)), np.abs(components).argmax(axis=1)])
+        self.columns = list(columns)
+        self.components = components * signs[:, None]
+        self.mean = mean
+        self.explained_variance = np.maximum(eigenvalues[order], 0.0)
+        self.explained_variance_ratio = self.explained_variance / max(np.trace(covariance), np.finfo(float).tiny)
+
+    @instrumentation.traced('pca.fit_transform_file')
+    def fit_transform_file(self, file_path: str, output_path: str):
+        """
+        Fits the PCA on a file and writes the projection to another file. In the incremental mode the input is read
+        twice, chunk by chunk (a pass to fit and a pass to project), and the output is written chunk by chunk
+        :param file_path: the path of the input CSV file (or binary table)
+        :param output_path: the path of the output CSV file (or binary table, if it ends with '.cbin')
+        :return: the number of rows written
+        """
+
+        if self.mode != 'incremental':
+            return len(self.fit_transform(file_path, output_path))
+
+        columns = binary_store.table_columns(file_path)
+        self.fit_chunks(binary_store.iter_chunks(file_path, chunk_size=self.chunk_size), columns)
+        chunks = binary_store.iter_chunks(file_path, chunk_size=self.chunk_size)
+        return self.write_projection((self.transform(chunk) for chunk in chunks), output_path)
+
+    @instrumentation.traced('pca.write_projection')
+    def write_projection(self, projected_chunks, output_path: str):
+        """
+        Appends projected chunks to a CSV file or a binary table, in order
+        :param projected_chunks: iterable of (m, n_components) arrays. For a CSV file they can also be CSV text
+        :param output_path: the path of the output file
+        :return: the number of rows written
+        """
+
+        rows = 0
+        if binary_store.is_binary_path(output_path):
+            with binary_store.TableWriter(output_path, self.output_columns()) as writer:
+                for projected in projected_chunks:
+                    writer.append(projected)
+                    rows += len(projected)
+            instrumentation.add_rows(rows)
+            return rows
+
+        with open(output_path, 'w', newline='') as file:
+            file.write(','.join(self.output_columns()) + '\n')
+            for projected in projected_chunks:
+                if isinstance(projected, str):
+                    file.write(projected)
+                    rows += projected.count('\n')
+                else:
+                    pd.DataFrame(projected).to_csv(file, header=False, index=False)
+                    rows += len(projected)
+        instrumentation.add_rows(rows)
+        return rows
+
+    @instrumentation.traced('pca.transform_file')
+    def transform_file(self, input_path: str, output_path: str, n_jobs: int = None, chunk_bytes: int = 64 * 1024 ** 2):
+        """
+        Projects a whole file on the fitted (or loaded) principal components, in parallel. The input is split in
+        parts: line-aligned byte ranges of a CSV file, or ranges of rows of a binary table. Every worker process reads
+        and parses only its own part (a binary table is memory-mapped) and projects it, and the projected parts are
+        written in their order. At most two parts per worker are in flight, so the memory does not grow with the file
+        :param input_path: the path of the input CSV file (or binary table) with the input columns
+        :param output_path: the path of the output CSV file (or binary table, if it ends with '.cbin')
+        :param n_jobs: number of worker processes. None uses every core, 1 projects in this process
+        :param chunk_bytes: approximate size of every part of the input, in bytes
+        :return: the number of rows written
+        """
+
+        if self.components is None:
+            raise ValueError("PCA is not fitted. Use fit_transform() or load_model() first")
+
+        as_text = not binary_store.is_binary_path(output_path)
+        if binary_store.is_binary_table(input_path):
+            n_rows = binary_store.read_schema(input_path)['n_rows']
+            rows_per_part = max(1, chunk_bytes // (8 * len(self.columns)))
+            parts = [('binary', input_path, start, min(start + rows_per_part, n_rows), as_text)
+                     for start in range(0, n_rows, rows_per_part)]
+        else:
+            header = binary_store.table_columns(input_path)
+            missing = [column for column in self.columns if column not in header]
+            if missing:
+                raise ValueError(f"Columns {missing} not found in {input_path}")
+            parts = [('csv', input_path, start, end, as_text)
+                     for start, end in csv_byte_ranges(input_path, chunk_bytes)]
+
+        model = (self.columns, self.mean, self.components)
+        workers = n_jobs or os.cpu_count() or 1
+        if workers == 1 or len(parts) <= 1:
+            _initialise_projection_worker(*model)
+            return self.write_projection((_project_part(part) for part in parts), output_path)
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_initialise_projection_worker,
+                                 initargs=model) as executor:
+            return self.write_projection(_ordered_results(executor, _project_part, parts, 2 * workers),
+                                         output_path)
+
+    def transform(self, data):
+        """
+        Projects data on the fitted (or loaded) principal components
+        :param data: (n, d) array, or DataFrame with the input columns
+        :return: (n, n_components) array
+        """
+
+        if self.components is None:
+            raise ValueError("PCA is not fitted. Use fit_transform() or load_model() first")
+
+        if isinstance(data, pd.DataFrame):
+            data = data[self.columns]
+        block = np.asarray(data, dtype=np.float64)
+        return (block - self.mean) @ self.components.T
+
+    def save_model(self, output_path: str):
+        """
+        Saves the fitted components, means and explained variance to a '.npz' file
+        :param output_path: the path of the file
+        :return: nothing
+        """
+
+        if self.components is None:
+            print("PCA is not fitted. Use fit_transform() first.")
+            return
+
+        np.savez(output_path, columns=np.array(self.columns), components=self.components, mean=self.mean,
+                 explained_variance=self.explained_variance,
+                 explained_variance_ratio=self.explained_variance_ratio)
+
+    def load_model(self, input_path: str):
+        """
+        Loads a model that was saved with save_model, so transform() can be used without fitting
+        :param input_path: the path of the file
+        :return: nothing
+        """
+
+        with np.load(input_path) as model:
+            self.columns = model['columns'].tolist()
+            self.components = model['components']
+            self.mean = model['mean']
+            self.explained_variance = model['explained_variance']
+            self.explained_variance_ratio = model['explained_variance_ratio']
+        self.n_components = len(self.components)
+
     def get_information_conserved(self):
         """
         Calculates the proportion of variance explained by the selected principal components in PCA.
         :return: that number
         """
-        return sum(self.pca.explained_variance_ratio_)
+        return float(np.sum(self.explained_variance_ratio))
@@ -0,0 +1,302 @@
+"""
+This class runs the same stages as 'main.py', but passes the data from one stage to the next in memory, instead of
+writing a CSV file at the end of every stage and reading it again at the start of the next one:
+
+    DataProcessor -> CreditCardDataPreProcessor -> PCAProcessor -> OutlierHandler -> HierarchicalClustering
+                  -> KMeans -> OutlierDetector
+
+The k-means and the outlier detection share the same array, with the labels of the k-means.
+Writing the intermediate files (with the same names that 'main.py' uses) and plotting are optional. The plots can be
+shown on the screen, or saved as images without a window for unattended runs ('headless_plot.py').
+The fitted scaler, PCA basis, centroids and outlier threshold are kept in a ModelBundle ('scoring.py'), so new
+customers can be scored without running the pipeline again.
+
+With a StageCache ('stage_cache.py') the output of every stage is stored, keyed by the input data and the parameters
+of the stage and of the stages before it, so a rerun only computes the stages whose key changed. A stage whose output
+comes from the cache does not write its intermediate file or show its plot again.
+"""
+
+import os
+from typing import List
+
+import numpy as np
+
+import binary_store
+import instrumentation
+import stage_cache
+import read_data
+import preprocess
+import pca_method
+import plot
+import add_outliers
+import hierarchical_clustering
+import kMeans
+import find_outliers
+import scoring
+
+
+
+
+class CreditCardPipeline:
+    def __init__(self, input_file: str = 'DataInTxt', normalize_columns: List[str] = None, n_components: int = 2,
+                 num_outliers: int = 5, multiplier: int = 4, linkage_criterion: str = 'ward', max_clusters: int = 10,
+                 max_iterations: int = 100, outlier_percentile: float = 99, seed: int = None,
+                 save_intermediate: bool = False, output_dir: str = '.', intermediate_format: str = 'csv',
+                 show_plots: bool = False, cache: stage_cache.StageCache = None, max_memory_mb: float = None,
+                 silhouette_sample_size: int = None, plot_dir: str = None):
+        """
+        Constructor
+        :param input_file: the txt file with the raw data
+        :param normalize_columns: the columns that are normalised with z-score. None uses preprocess.NORMALIZE_COLUMNS
+        :param n_components: number of principal components to retain
+        :param num_outliers: number of synthetic outliers to add
+        :param multiplier: multiplier to determine the range of the outliers
+        :param linkage_criterion: linkage criterion of the hierarchical clustering
+        :param max_clusters: maximum number of clusters that the hierarchical clustering considers
+        :param max_iterations: maximum number of iterations of the k-means
+        :param outlier_percentile: percentile threshold to identify outliers
+        :param seed: seed for the outliers and the k-means, so that a run can be reproduced
+        :param save_intermediate: if True, the output of every stage is also written to a CSV file in output_dir
+        :param output_dir: the directory of the intermediate files
+        :param intermediate_format: 'csv', or 'binary' for the columnar binary tables of 'binary_store.py'
+        :param show_plots: if True, the plots of 'main.py' are shown
+        :param cache: optional StageCache, so the stages that did not change are not computed again
+        :param max_memory_mb: memory ceiling of the hierarchical clustering (see HierarchicalClustering)
+        :param silhouette_sample_size: if given, the silhouette is computed on a stratified sample of this size
+        :param plot_dir: if given, the plots of 'main.py' are saved as PNG files in this directory without a window
+                         ('headless_plot.py'), instead of being shown
+        """
+
+        self.input_file = input_file
+        self.normalize_columns = normalize_columns or preprocess.NORMALIZE_COLUMNS
+        self.n_components = n_components
+        self.num_outliers = num_outliers
+        self.multiplier = multiplier
+        self.linkage_criterion = linkage_criterion
+        self.max_clusters = max_clusters
+        self.max_iterations = max_iterations
+        self.outlier_percentile = outlier_percentile
+        self.seed = seed
+        self.save_intermediate = save_intermediate
+        self.output_dir = output_dir
+        self.intermediate_format = intermediate_format
+        self.show_plots = show_plots
+        self.cache = cache
+        self.max_memory_mb = max_memory_mb
+        self.silhouette_sample_size = silhouette_sample_size
+        self.plot_dir = plot_dir
+        self.results = {}
+
+    def output_path(self, file_name: str):
+        """
+        Gives the path of an intermediate file, or None when the intermediate files are not written
+        :param file_name: name of the file
+        :return: the path or None
+        """
+
+        if not self.save_intermediate:
+            return None
+        if self.intermediate_format == 'binary':
+            file_name = os.path.splitext(file_name)[0] + binary_store.BINARY_EXTENSION
+        return os.path.join(self.output_dir, file_name)
+
+    @property
+    def plots(self):
+        """
+        Whether the plots are drawn, on the screen or into files
+        """
+
+        return self.show_plots or self.plot_dir is not None
+
+    def plot_path(self, file_name: str):
+        """
+        Gives the path of a plot image, or None when the plots are shown on the screen
+        :param file_name: name of the file
+        :return: the path or None
+        """
+
+        if self.plot_dir is None:
+            return None
+        os.makedirs(self.plot_dir, exist_ok=True)
+        return os.path.join(self.plot_dir, file_name)
+
+    def convert(self):
+        """
+        Reads the raw txt data
+        :return: DataFrame with the raw data
+        """
+
+        reader = read_data.DataProcessor(self.input_file, self.output_path('data.csv'))
+        if self.save_intermediate:
+            # The stage continues with the file that was written, so the two are the same
+            reader.process()
+            return binary_store.read_table(reader.output_file)
+        return reader.to_dataframe()
+
+    def preprocess(self, raw_data):
+        """
+        Normalises the data, fills the missing values and drops the IDs
+        :param raw_data: DataFrame with the raw data
+        :return: tuple of (DataFrame with the preprocessed data, the fitted scaler)
+        """
+
+        preprocessor = preprocess.CreditCardDataPreProcessor(self.input_file)
+        preprocessor.load_data(data=raw_data, drop_ids=True)
+        preprocessor.preprocess(self.normalize_columns)
+        if self.save_intermediate:
+            preprocessor.save_data(self.output_path('preprocessed_data.csv'))
+        return preprocessor.data, preprocessor.scaler
+
+    def reduce(self, preprocessed_data):
+        """
+        Applies PCA to the preprocessed data
+        :param preprocessed_data: DataFrame with the preprocessed data
+        :return: tuple of (DataFrame with the principal components, proportion of the information conserved,
+                 dictionary with the columns, the means and the components of the PCA)
+        """
+
+        pca = pca_method.PCAProcessor(n_components=self.n_components)
+        reduced_data = pca.fit_transform(output_path=self.output_path('pca_reduced_data.csv'), data=preprocessed_data)
+
+        if self.plots:
+            csv_plot = plot.CSV2DPlot(None, 'PCA1', 'PCA2')
+            csv_plot.data = reduced_data
+            csv_plot.plot_data(self.plot_path('pca.png'))
+
+        pca_model = {'columns': pca.columns, 'mean': pca.mean, 'components': pca.components}
+        return reduced_data, pca.get_information_conserved(), pca_model
+
+    def inject_outliers(self, reduced_data):
+        """
+        Adds synthetic outliers to the reduced data
+        :param reduced_data: DataFrame with the principal components
+        :return: DataFrame with the outliers appended
+        """
+
+        outlier_handler = add_outliers.OutlierHandler(None, 'PCA1', 'PCA2', seed=self.seed)
+        outlier_handler.load_data(data=reduced_data)
+        outlier_handler.add_outliers(num_outliers=self.num_outliers, multiplier=self.multiplier)
+        if self.plots:
+            outlier_handler.plot_data(self.plot_path('outliers_added.png'))
+        if self.save_intermediate:
+            outlier_handler.save_data(self.output_path('output_with_outliers.csv'))
+        return outlier_handler.data
+
+    def hierarchical(self, data_with_outliers):
+        """
+        Finds the optimal number of clusters with the hierarchical clustering
+        :param data_with_outliers: DataFrame with the data and the outliers
+        :return: the optimal number of clusters
+        """
+
+        clustering = hierarchical_clustering.HierarchicalClustering(linkage_criterion=self.linkage_criterion,
+                                                                    max_memory_mb=self.max_memory_mb, seed=self.seed)
+        clustering.load_data(data=data_with_outliers)
+        clustering.run_hierarchical_clustering()
+        optimal_clusters = clustering.find_optimal_clusters(max_clusters=self.max_clusters,
+                                                            sample_size=self.silhouette_sample_size)
+
+        if self.save_intermediate:
+            clustering.save_data(self.output_path('output_with_clusters.csv'))
+        if self.plots:
+            clustering.plot_data("PCA1", "PCA2", self.plot_path('hierarchical_clusters.png'))
+        return optimal_clusters
+
+    def kmeans(self, points, k: int):
+        """
+        Runs the k-means on the array of the data
+        :param points: (n, d) array with the data and the outliers
+        :param k: number of clusters
+        :return: tuple of (centroids array, labels array)
+        """
+
+        model = kMeans.VectorizedKMeans(k, None, seed=self.seed)
+        model.fit(points, self.max_iterations)
+        if self.plots:
+            model.plot_results(self.plot_path('kmeans.png'))
+        return model.centroid_array, model.labels
+
+    def detect_outliers(self, points, centroids, labels):
+        """
+        Finds the outliers with the centroids and the labels of the k-means, on the same array
+        :param points: (n, d) array with the data and the outliers
+        :param centroids: (k, d) array with the centroids of the k-means
+        :param labels: the cluster of every point
+        :return: tuple of (inliers, outliers) indices and the distance threshold of the outliers
+        """
+
+        detector = find_outliers.OutlierDetector(len(centroids), outlier_percentile=self.outlier_percentile,
+                                                 data=points)
+        inliers, outliers, centroids = detector.split_the_data(centroids, labels=labels)
+        if self.plots:
+            detector.plot(inliers, outliers, centroids, self.plot_path('outliers_detected.png'))
+        return inliers, outliers, detector.threshold
+
+    def stage(self, name: str, parent_keys, parameters: dict, compute):
+        """
+        Runs a stage, or takes its output from the cache
+        :param name: the name of the stage
+        :param parent_keys: the keys of the stages that this stage reads
+        :param parameters: the parameters of the stage
+        :param compute: function without arguments that runs the stage
+        :return: tuple of (key, output). The key is None without a cache
+        """
+
+        with instrumentation.span(f'pipeline.{name}'):
+            if self.cache is None:
+                return None, compute()
+            return self.cache.cached(name, parent_keys, parameters, compute)
+
+    @instrumentation.traced('pipeline.run')
+    def run(self):
+        """
+        Runs every stage
+        :return: dictionary with the results of the stages
+        """
+
+        input_key = stage_cache.hash_file(self.input_file) if self.cache is not None else None
+
+        raw_key, raw_data = self.stage('convert', [input_key], {}, self.convert)
+        preprocess_key, (preprocessed_data, scaler) = self.stage(
+            'preprocess', [raw_key], {'normalize_columns': self.normalize_columns},
+            lambda: self.preprocess(raw_data))
+        pca_key, (reduced_data, information_conserved, pca_model) = self.stage(
+            'pca', [preprocess_key], {'n_components': self.n_components},
+            lambda: self.reduce(preprocessed_data))
+        print("Information conserved by PCA: {:.2f}%".format(information_conserved * 100))
+
+        outliers_key, data_with_outliers = self.stage(
+            'inject_outliers', [pca_key], {'num_outliers': self.num_outliers, 'multiplier': self.multiplier,
+                                           'seed': self.seed},
+            lambda: self.inject_outliers(reduced_data))
+        points = data_with_outliers.to_numpy(dtype=np.float64)
+
+        hierarchical_key, optimal_clusters = self.stage(
+            'hierarchical', [outliers_key], {'linkage_criterion': self.linkage_criterion,
+                                             'max_clusters': self.max_clusters, 'max_memory_mb': self.max_memory_mb,
+                                             'silhouette_sample_size': self.silhouette_sample_size},
+            lambda: self.hierarchical(data_with_outliers))
+        print(f"Optimal number of clusters: {optimal_clusters}")
+
+        kmeans_key, (centroids, labels) = self.stage(
+            'kmeans', [outliers_key, hierarchical_key], {'k': optimal_clusters, 'max_iterations': self.max_iterations,
+                                                         'seed': self.seed},
+            lambda: self.kmeans(points, optimal_clusters))
+        _, (inliers, outliers, threshold) = self.stage(
+            'detect_outliers', [outliers_key, kmeans_key], {'outlier_percentile': self.outlier_percentile},
+            lambda: self.detect_outliers(points, centroids, labels))
+
+        if self.cache is not None:
+            self.cache.report()
+
+        self.results.update({
+            'information_conserved': information_conserved,
+            'data': data_with_outliers,
+            'optimal_clusters': optimal_clusters,
+            'centroids': centroids.tolist(),
+            'labels': labels,
+            'inliers': inliers,
+            'outliers': outliers,
+            'model_bundle': scoring.ModelBundle(scaler, pca_model, centroids, threshold),
+        })
+        return self.results
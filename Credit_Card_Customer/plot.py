@@ -3,8 +3,7 @@ This class plots the data after tha dimensionality reduction.
 It loads the data from the 'pca_reduced_data' and plots them
 """
 
-import pandas as pd
-import matplotlib.pyplot as plt
+import binary_store
 
 
 class CSV2DPlot:
@@ -27,16 +26,18 @@ class CSV2DPlot:
         :return: nothing
         """
         try:
-            self.data = pd.read_csv(self.file_path)
+            self.data = binary_store.read_table(self.file_path)
             if self.x_column not in self.data.columns or self.y_column not in self.data.columns:
                 raise ValueError("Specified columns not found in the CSV file.")
         except Exception as e:
             print(f"Error loading file: {e}")
             self.data = None
 
-    def plot_data(self):
+    def plot_data(self, output_path: str = None):
         """
         Plot the data as a 2D scatter plot.
+        :param output_path: if given, the plot is saved to this image file without a window ('headless_plot.py'),
+                            and large data are drawn as a density raster
         :return: nothing
         """
         if self.data is None:
@@ -46,6 +47,15 @@ class CSV2DPlot:
         x = self.data[self.x_column]
         y = self.data[self.y_column]
 
+        if output_path is not None:
+            import headless_plot
+
+            headless_plot.save_scatter(output_path, x, y, title='2D Scatter Plot of CSV Data', x_label=self.x_column,
+                                       y_label=self.y_column)
+            return
+
+        import matplotlib.pyplot as plt
+
         plt.figure(figsize=(8, 6))
         plt.scatter(x, y, color='blue', alpha=0.7)
         plt.title('2D Scatter Plot of CSV Data')
@@ -5,28 +5,63 @@ This class preprocesses the Credit Card Customer data that are already in the cs
     Fills missing values if any exists
     Drops the columns that do not contain useful information but IDs
     Saves the data to a new file 'preprocessed_data.csv'
+
+The `preprocess` method does all of the above at once: the IDs are not even read, the features are kept in one
+(optionally float32) NumPy block, and the statistics of every column are computed with vectorized operations over the
+block, which is then normalised and filled in place. The fitted statistics (the scaler) can be saved and loaded, so new
+batches of customers are transformed exactly like the training data, without fitting again.
 """
 
+import json
+
+import numpy as np
 import pandas as pd
 from typing import List
 
+import binary_store
+import instrumentation
+
+ID_COLUMNS = ["Sl_No", "Customer Key"]
+# The columns that the pipeline normalises with z-score by default
+NORMALIZE_COLUMNS = ["Avg_Credit_Limit", "Total_Credit_Cards", "Total_visits_bank", "Total_visits_online",
+                     "Total_calls_made"]
+
 class CreditCardDataPreProcessor:
-    def __init__(self, file_path:str):
+    def __init__(self, file_path:str, id_columns: List[str] = None, float32: bool = False):
         """
         Constructor
         :param file_path: strinf that contains the input csv file that we will preprocess
+        :param id_columns: the columns that contain IDs and are dropped
+        :param float32: if True, the features are loaded as float32 instead of float64, which halves the memory
         """
 
         self.file_path = file_path
+        self.id_columns = ID_COLUMNS if id_columns is None else id_columns
+        self.float32 = float32
+        self.scaler = None
         self.data = None
 
-    def load_data(self):
+    @instrumentation.traced('preprocess.load_data')
+    def load_data(self, data: pd.DataFrame = None, drop_ids: bool = False):
         """
         Loads the CSV file into a pandas DataFrame.
+        :param data: a DataFrame that is already in memory (e.g. from 'pipeline.py'). It is used instead of the file
+        :param drop_ids: if True, the ID columns are not read at all and the features get the float dtype of the class
         :return: nothing
         """
 
-        self.data = pd.read_csv(self.file_path)
+        if data is not None:
+            self.data = data.drop(columns=self.id_columns, errors='ignore') if drop_ids else data.copy()
+        elif drop_ids:
+            features = [column for column in binary_store.table_columns(self.file_path)
+                        if column not in self.id_columns]
+            dtype = np.float32 if self.float32 else np.float64
+            self.data = binary_store.read_table(self.file_path, columns=features,
+                                                dtype={column: dtype for column in features})
+            self.data = self.data.astype(dtype, copy=False)     # Binary tables keep their stored dtype
+        else:
+            self.data = binary_store.read_table(self.file_path)
+        instrumentation.add_rows(len(self.data))
         print("Data loaded successfully.")
 
     def summarize_data(self):
@@ -40,6 +75,7 @@ class CreditCardDataPreProcessor:
         else:
             print("Data is not loaded. Use load_data() first.")
 
+    @instrumentation.traced('preprocess.normalize_columns')
     def normalize_columns(self, columns: List[str]):
         """
         Normalizes the specified columns using z-score scaling.
@@ -59,6 +95,7 @@ class CreditCardDataPreProcessor:
         else:
             print("Data is not loaded. Use load_data() first.")
 
+    @instrumentation.traced('preprocess.fill_missing_values')
     def fill_missing_values(self):
         """
         Fills missing values in the dataset with the median of each column.
@@ -71,26 +108,125 @@ class CreditCardDataPreProcessor:
         else:
             print("Data is not loaded. Use load_data() first.")
 
+    @instrumentation.traced('preprocess.drop_id_columns')
     def drop_id_columns(self):
         """
         Drops the specified columns by name or index
         :return: nothing
         """
 
-        columns_to_drop = ["Sl_No", "Customer Key"] #we want to drop the IDs columns that we don't need
+        columns_to_drop = self.id_columns #we want to drop the IDs columns that we don't need
         self.data = self.data.drop(columns=columns_to_drop)
         print("IDs columns are dropped")
 
+    @instrumentation.traced('preprocess.fit')
+    def fit(self, columns: List[str]):
+        """
+        Computes the statistics of the features with vectorized operations over one NumPy block: the mean and the
+        standard deviation of the columns that are normalised, and the median of every column for the missing values.
+        The missing values are ignored, like pandas does.
+        :param columns: the columns that are normalised with z-score
+        :return: nothing
+        """
+
+        if self.data is None:
+            print("Data is not loaded. Use load_data() first.")
+            return
+
+        features = self.data.drop(columns=self.id_columns, errors='ignore')
+        block = features.to_numpy(dtype=np.float32 if self.float32 else np.float64)
+        instrumentation.add_rows(len(block))
+        normalized = np.isin(features.columns, columns)
+
+        mean = np.zeros(block.shape[1])
+        std = np.ones(block.shape[1])
+        mean[normalized] = np.nanmean(block[:, normalized], axis=0)
+        std[normalized] = np.nanstd(block[:, normalized], axis=0, ddof=1)     # Sample std, like pandas
+
+        self.scaler = {
+            'columns': features.columns.tolist(),
+            'normalized': features.columns[normalized].tolist(),
+            'mean': mean.tolist(),
+            'std': std.tolist(),
+            'median': np.nanmedian(block, axis=0).tolist(),
+        }
+
+    @instrumentation.traced('preprocess.transform')
+    def transform(self):
+        """
+        Applies the fitted (or loaded) scaler to the data in place: the missing values get the median of their column
+        and the normalised columns are z-scored. Filling with the raw median before normalising gives the same values
+        as normalising first and filling with the median of the normalised column.
+        :return: nothing
+        """
+
+        if self.data is None or self.scaler is None:
+            print("Data or scaler is not available. Use load_data() and fit() or load_scaler() first.")
+            return
+
+        dtype = np.float32 if self.float32 else np.float64
+        # A copy, because the block is changed in place and pandas may return a read-only view of the DataFrame
+        block = self.data[self.scaler['columns']].to_numpy(dtype=dtype, copy=True)
+        instrumentation.add_rows(len(block))
+
+        median = np.asarray(self.scaler['median'], dtype=dtype)
+        missing = np.isnan(block)
+        if missing.any():
+            rows, cols = np.nonzero(missing)
+            block[rows, cols] = median[cols]
+
+        block -= np.asarray(self.scaler['mean'], dtype=dtype)
+        block /= np.asarray(self.scaler['std'], dtype=dtype)
+
+        self.data = pd.DataFrame(block, columns=self.scaler['columns'], copy=False)
+
+    def preprocess(self, columns: List[str]):
+        """
+        Fused preprocessing: drops the IDs, fits the statistics and transforms the data in one go.
+        It gives the same result as normalize_columns, fill_missing_values and drop_id_columns.
+        :param columns: the columns that are normalised with z-score
+        :return: nothing
+        """
+
+        self.fit(columns)
+        self.transform()
+        print(f"Columns {columns} normalized using z-score, missing values filled and IDs dropped.")
+
+    def save_scaler(self, output_path: str):
+        """
+        Saves the fitted statistics to a JSON file
+        :param output_path: the path of the file
+        :return: nothing
+        """
+
+        if self.scaler is None:
+            print("Scaler is not fitted. Use fit() or preprocess() first.")
+            return
+
+        with open(output_path, 'w') as file:
+            json.dump(self.scaler, file, indent=2)
+
+    def load_scaler(self, input_path: str):
+        """
+        Loads statistics that were saved with save_scaler, so transform() can be used without fitting
+        :param input_path: the path of the file
+        :return: nothing
+        """
+
+        with open(input_path, 'r') as file:
+            self.scaler = json.load(file)
+
 
+    @instrumentation.traced('preprocess.save_data')
     def save_data(self, output_path:str):
         """
-        Saves the processed dataset to a new CSV file.
+        Saves the processed dataset to a new CSV file (or binary table, if the path ends with '.cbin').
         :param output_path: string that contains the path to the file that we will store the preprocessed data
         :return: nothing
         """
 
         if self.data is not None:
-            self.data.to_csv(output_path, index=False)
+            binary_store.save_table(self.data, output_path)
             #print(f"Data saved to {output_path}.")
         else:
             print("Data is not loaded. Use load_data() first.")
@@ -0,0 +1,104 @@
+"""
+This class implements a streaming quantile sketch, so medians and percentiles can be estimated in one pass over data
+that do not fit in the memory.
+
+It is a deterministic compactor sketch (Munro-Paterson, the idea behind KLL): the values are kept in levels, and every
+value of level h stands for 2^h values of the input. When a level holds more than `capacity` values, it is sorted and
+every second value is promoted to the next level (starting alternately from the first and the second value). The
+memory is O(capacity * log(n / capacity)).
+
+Error bound: one compaction of level h changes the rank of any value by at most 2^h, and the sketch adds up these
+amounts in `rank_error`, so the rank of the value that `quantile(q)` returns is within `rank_error` of q * n. While
+nothing has been compacted the quantile is exact (interpolated like `np.quantile`). Level h gets at most n / 2^h values and a compaction removes at least
+`capacity` of them, so it is compacted at most n / (capacity * 2^h) times, and in the worst case
+
+    rank_error <= n * (log2(n / capacity) + 1) / capacity
+
+For example, with the default capacity of 4096 and 100 million values, the returned median has a rank within 0.4% of
+the true median (0.2% for 1 million values).
+"""
+
+import numpy as np
+
+
+class QuantileSketch:
+    def __init__(self, capacity: int = 4096):
+        """
+        Constructor
+        :param capacity: the number of values that a level holds before it is compacted
+        """
+
+        self.capacity = capacity
+        self.levels = [np.empty(0)]
+        self.offsets = [0]
+        self.count = 0
+        self.rank_error = 0
+
+    def update(self, values):
+        """
+        Adds values to the sketch. The missing values (NaN) are ignored
+        :param values: array with the values
+        :return: nothing
+        """
+
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+
+    def compress(self):
+        """
+        Compacts every level that holds more than `capacity` values
+        :return: nothing
+        """
+
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if len(level) > self.capacity:
+                level = np.sort(level)
+                keep = len(level) % 2        # An odd value stays at this level, with its full weight
+                pairs = level[keep:]
+
+                promoted = pairs[self.offsets[h]::2]
+                self.offsets[h] ^= 1
+                self.rank_error += 2 ** h
+
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                    self.offsets.append(0)
+                self.levels[h] = level[:keep]
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+            h += 1
+
+    def quantile(self, q: float):
+        """
+        Estimates a quantile
+        :param q: the quantile, between 0 and 1
+        :return: the estimate, or NaN if the sketch is empty
+        """
+
+        if self.count == 0:
+            return np.nan
+
+        values = np.concatenate(self.levels)
+        if self.rank_error == 0:
+            return float(np.quantile(values, q))    # Nothing compacted yet, so the same value as NumPy / pandas
+
+        weights = np.concatenate([np.full(len(level), 2 ** h) for h, level in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        cumulative = np.cumsum(weights[order])
+        index = int(np.searchsorted(cumulative, q * cumulative[-1], side='left'))
+        return float(values[order][min(index, len(values) - 1)])
+
+    def relative_error(self):
+        """
+        The guaranteed bound of the rank error, as a fraction of the number of values
+        :return: the bound
+        """
+
+        return self.rank_error / self.count if self.count else 0.0
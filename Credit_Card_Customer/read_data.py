@@ -1,65 +1,193 @@
 """
 This class reads the data from the txt file ('DataInTxt.txt') and saves them in a csv file ('data.csv') where we can
 extract the information much more easily
+
+The file is streamed: the lines are read lazily, checked on the fly and written in chunks of a fixed number of rows,
+so the memory stays constant whatever the size of the file. Lines with a wrong number of columns or with non-numeric
+values are skipped and reported at the end, instead of stopping the conversion.
 """
 
 import csv
-from typing import List
+from itertools import islice
+from typing import Iterable, Iterator, List
+
+import binary_store
+import instrumentation
 
 class DataProcessor:
-    def __init__(self, input_file:str, output_file:str):
+    def __init__(self, input_file:str, output_file:str, chunk_size:int = 10000, max_reported_lines:int = 20):
         """
         Constructor
         :param input_file: string that contains the txt file where we will read the data from
         :param output_file: string that contains the final csv file
+        :param chunk_size: number of rows that are buffered before they are written to the csv file
+        :param max_reported_lines: number of bad lines that are kept and printed. All of them are counted
         """
         self.input_file = input_file
         self.output_file = output_file
+        self.chunk_size = chunk_size
+        self.max_reported_lines = max_reported_lines
+        self.bad_lines = []
+        self.bad_line_count = 0
+
+    def check_line(self, fields: List[str], n_columns: int):
+        """
+        Checks that a line has the right number of columns and that every value is a number (or empty, for a
+        missing value)
+        :param fields: the values of the line
+        :param n_columns: the number of columns of the header
+        :return: the reason that the line is bad, or None if it is fine
+        """
+        if len(fields) != n_columns:
+            return f"expected {n_columns} columns, found {len(fields)}"
+
+        for field in fields:
+            if field:
+                try:
+                    float(field)
+                except ValueError:
+                    return f"non-numeric value '{field}'"
+        return None
+
+    def report_bad_line(self, line_number: int, reason: str):
+        """
+        Keeps a bad line so that it is reported at the end
+        :param line_number: the number of the line in the txt file
+        :param reason: why the line is bad
+        :return: nothing
+        """
+        self.bad_line_count += 1
+        if len(self.bad_lines) < self.max_reported_lines:
+            self.bad_lines.append((line_number, reason))
 
     def read_data(self):
         """
         Reads data from a specified text file.
 
-        This method opens a text file, reads its content, and splits it into the header and data sections.
+        This method opens a text file, reads its header, and returns a generator over the data section.
         The first line of the file is treated as the header, while the subsequent lines are considered the actual data.
-        Both the header and data are returned separately.
+        The data lines are read one by one while the generator is consumed, and the bad ones are skipped and
+        reported in `bad_lines`.
 
         :return header (string): The first line of the file, typically containing column names or field names.
-        :return: data (List[string]): A list of the remaining lines from the file, which represent the data entries.
+        :return: data (Iterator[List[string]]): The values of the remaining lines, which represent the data entries.
         """
 
         with open(self.input_file, 'r') as file:
-            # Read all lines in the text file
-            lines = file.readlines()
+            # The first line is the header, which we will keep
+            header = file.readline().strip()
 
-        # The first line is the header, which we will keep
-        header = lines[0].strip()
+        return header, self.iter_rows(len(header.split(',')))
 
-        # The rest of the lines are the actual data
-        data = [line.strip() for line in lines[1:]]
+    def iter_rows(self, n_columns: int) -> Iterator[List[str]]:
+        """
+        Streams the data lines of the text file, split into their values
+        :param n_columns: the number of columns of the header
+        :return: generator of the values of every good line
+        """
+        self.bad_lines = []
+        self.bad_line_count = 0
 
-        return header, data
+        with open(self.input_file, 'r') as file:
+            next(file)
+            for line_number, line in enumerate(file, start=2):
+                line = line.strip()
+                if not line:
+                    continue
+
+                fields = line.split(',')
+                reason = self.check_line(fields, n_columns)
+                if reason is None:
+                    yield fields
+                else:
+                    self.report_bad_line(line_number, reason)
 
-    def save_to_csv(self, header: str, data: List[str]):
+    def save_to_csv(self, header: str, data: Iterable[List[str]]):
         """
-        Writes the data to a CSV file
+        Writes the data to a CSV file, chunk_size rows at a time
         :param header: string that contains the column names or field names.
-        :param data: A list that contains the data entries.
-        :return: nothing
+        :param data: An iterable with the values of the data entries.
+        :return: the number of rows that were written
         """
-        with open(self.output_file, mode='w', newline='') as file:
+        rows = iter(data)
+        written = 0
+        with open(self.output_file, mode='w', newline='', buffering=1024 * 1024) as file:
             writer = csv.writer(file)
             # Writing the header
             writer.writerow(header.split(','))
             # Writing the data
-            for line in data:
-                writer.writerow(line.split(','))
+            while True:
+                chunk = list(islice(rows, self.chunk_size))
+                if not chunk:
+                    break
+                writer.writerows(chunk)
+                written += len(chunk)
+        return written
+
+    def save_to_binary(self, header: str, data: Iterable[List[str]]):
+        """
+        Writes the data to a binary table (see 'binary_store.py'), chunk_size rows at a time.
+        Every column is stored as float64 and the missing values as NaN
+        :param header: string that contains the column names or field names.
+        :param data: An iterable with the values of the data entries.
+        :return: the number of rows that were written
+        """
+        import numpy as np
+
+        rows = iter(data)
+        with binary_store.TableWriter(self.output_file, header.split(','), dtype=np.float64) as writer:
+            while True:
+                chunk = list(islice(rows, self.chunk_size))
+                if not chunk:
+                    break
+                writer.append(np.array([[float(field) if field else np.nan for field in row] for row in chunk]))
+            return writer.n_rows
+
+    def to_dataframe(self):
+        """
+        Reads the text file into a pandas DataFrame, without writing the csv file. The lines are checked like in
+        `process`, so the DataFrame has the same rows as the csv file would have
+        :return: the DataFrame with the data
+        """
+        import pandas as pd
+
+        header, data = self.read_data()
+        columns = header.split(',')
+        rows = iter(data)
+        chunks = []
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                break
+            # The empty values are the missing ones, the rest are numbers (checked by `check_line`)
+            frame = pd.DataFrame(chunk, columns=columns).replace('', None)
+            chunks.append(frame.apply(pd.to_numeric))
+
+        data_frame = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=columns)
+        self.print_bad_lines()
+        return data_frame
+
+    def print_bad_lines(self):
+        """
+        Prints the bad lines that were skipped, if there are any
+        :return: nothing
+        """
+        if self.bad_line_count:
+            print(f"{self.bad_line_count} bad lines were skipped:")
+            for line_number, reason in self.bad_lines:
+                print(f"    line {line_number}: {reason}")
 
+    @instrumentation.traced('read_data.process')
     def process(self):
         """
         Runs the above methods so we can store the data to a csv file
         :return: nothing
         """
         header, data = self.read_data()
-        self.save_to_csv(header, data)
-        print(f"Data has been successfully saved to {self.output_file}")
\ No newline at end of file
+        if binary_store.is_binary_path(self.output_file):
+            written = self.save_to_binary(header, data)
+        else:
+            written = self.save_to_csv(header, data)
+        instrumentation.add_rows(written)
+        print(f"Data has been successfully saved to {self.output_file} ({written} rows)")
+        self.print_bad_lines()
@@ -0,0 +1,249 @@
+"""
+This class scores new customers with the models of a pipeline run, without running the pipeline again.
+
+A ModelBundle keeps everything that is needed: the scaler of `CreditCardDataPreProcessor` (medians, means and standard
+deviations), the basis of `PCAProcessor`, the centroids of the k-means and the distance threshold of
+`OutlierDetector`. It is saved to (and loaded from) one '.npz' file.
+
+Scoring a customer means: fill the missing values with the medians, normalise, project on the principal components,
+and find the nearest centroid. The normalisation and the projection are both linear, so the Scorer folds them into one
+matrix and one vector when it is built, and a batch of customers is scored with one matrix product and one distance
+computation. A customer is an outlier when the distance to the nearest centroid is over the threshold.
+
+For many concurrent callers (e.g. the threads of the HTTP server), a BatchingScorer collects the requests that arrive
+at the same time in a queue and scores them together, as one vectorized batch, in a background thread.
+The HTTP server ('python scoring.py model.npz [port]') accepts POST /score with a JSON customer (an object with the
+feature names, or a list of values in the order of the features), or a list of them.
+"""
+
+import json
+import queue
+import sys
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from neighbors import squared_euclidean_distances
+
+
+class ModelBundle:
+    def __init__(self, scaler: dict, pca_model: dict, centroids, threshold: float):
+        """
+        Constructor
+        :param scaler: the scaler of CreditCardDataPreProcessor (columns, mean, std and median)
+        :param pca_model: dictionary with the 'columns', the 'mean' and the 'components' of PCAProcessor
+        :param centroids: (k, n_components) centroids of the k-means
+        :param threshold: the distance threshold of OutlierDetector
+        """
+
+        self.scaler = scaler
+        self.pca_model = {'columns': list(pca_model['columns']),
+                          'mean': np.asarray(pca_model['mean'], dtype=np.float64),
+                          'components': np.asarray(pca_model['components'], dtype=np.float64)}
+        self.centroids = np.asarray(centroids, dtype=np.float64)
+        self.threshold = float(threshold)
+
+    def save(self, output_path: str):
+        """
+        Saves the bundle to a '.npz' file
+        :param output_path: the path of the file
+        :return: nothing
+        """
+
+        np.savez(output_path, scaler=np.array(json.dumps(self.scaler)),
+                 pca_columns=np.array(self.pca_model['columns']), pca_mean=self.pca_model['mean'],
+                 pca_components=self.pca_model['components'], centroids=self.centroids,
+                 threshold=np.array(self.threshold))
+
+    @staticmethod
+    def load(input_path: str):
+        """
+        Loads a bundle that was saved with save
+        :param input_path: the path of the file
+        :return: the ModelBundle
+        """
+
+        with np.load(input_path) as bundle:
+            pca_model = {'columns': bundle['pca_columns'].tolist(), 'mean': bundle['pca_mean'],
+                         'components': bundle['pca_components']}
+            return ModelBundle(json.loads(str(bundle['scaler'])), pca_model, bundle['centroids'],
+                               float(bundle['threshold']))
+
+
+class Scorer:
+    def __init__(self, bundle: ModelBundle):
+        """
+        Constructor. Folds the normalisation and the projection into one affine map:
+            ((x - mean) / std - pca_mean) @ components.T  =  x @ weights + bias
+        :param bundle: the ModelBundle
+        """
+
+        self.bundle = bundle
+        self.columns = bundle.scaler['columns']
+        self.median = np.asarray(bundle.scaler['median'], dtype=np.float64)
+
+        # The PCA may use the features in another order than the scaler
+        order = [bundle.pca_model['columns'].index(column) for column in self.columns]
+        components = bundle.pca_model['components'][:, order]
+        mean = np.asarray(bundle.scaler['mean'], dtype=np.float64)
+        std = np.asarray(bundle.scaler['std'], dtype=np.float64)
+        pca_mean = bundle.pca_model['mean'][order]
+
+        self.weights = (components / std).T
+        self.bias = -(mean / std + pca_mean) @ components.T
+        self.centroids = bundle.centroids
+        self.threshold = bundle.threshold
+
+    def to_array(self, customers):
+        """
+        Turns customers into an (n, d) array in the order of the features
+        :param customers: a customer or a list of customers. A customer is a dictionary with the feature names (a
+                          missing feature is a missing value) or a list of values in the order of the features
+        :return: the array
+        """
+
+        if isinstance(customers, dict) or (len(customers) and not isinstance(customers[0], (dict, list, tuple,
+                                                                                            np.ndarray))):
+            customers = [customers]
+        rows = [[customer.get(column, np.nan) for column in self.columns] if isinstance(customer, dict) else customer
+                for customer in customers]
+        return np.array(rows, dtype=np.float64).reshape(-1, len(self.columns))
+
+    def score_array(self, features: np.ndarray):
+        """
+        Scores a batch of customers
+        :param features: (n, d) array with the raw features, NaN for the missing values
+        :return: tuple of (clusters, distances, outlier mask)
+        """
+
+        missing = np.isnan(features)
+        if missing.any():
+            features = np.where(missing, self.median, features)
+
+        projected = features @ self.weights + self.bias
+        distances = squared_euclidean_distances(projected, self.centroids)
+        clusters = distances.argmin(axis=1)
+        nearest = np.sqrt(np.maximum(distances[np.arange(len(clusters)), clusters], 0.0))
+        return clusters, nearest, nearest > self.threshold
+
+    def score(self, customers):
+        """
+        Scores customers
+        :param customers: a customer or a list of customers (see to_array)
+        :return: list with a dictionary (cluster, distance, outlier) for every customer
+        """
+
+        return self.results(*self.score_array(self.to_array(customers)))
+
+    @staticmethod
+    def results(clusters, distances, outliers):
+        return [{'cluster': int(c), 'distance': float(d), 'outlier': bool(o)}
+                for c, d, o in zip(clusters, distances, outliers)]
+
+
+class BatchingScorer:
+    def __init__(self, scorer: Scorer, max_batch: int = 1024):
+        """
+        Constructor. Starts the background thread that scores the batches
+        :param scorer: the Scorer
+        :param max_batch: the maximum number of customers that are scored together
+        """
+
+        self.scorer = scorer
+        self.max_batch = max_batch
+        self.requests = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.serve_batches, daemon=True)
+        self.thread.start()
+
+    def score(self, customers):
+        """
+        Scores customers together with the requests of the other threads. It blocks until they are scored
+        :param customers: a customer or a list of customers (see Scorer.to_array)
+        :return: list with a dictionary (cluster, distance, outlier) for every customer
+        """
+
+        future = Future()
+        self.requests.put((self.scorer.to_array(customers), future))
+        return future.result()
+
+    def serve_batches(self):
+        """
+        Takes every request that is waiting (up to max_batch customers), scores them as one batch and returns to
+        every caller its own rows. It does not wait for more requests: under load, the requests that arrive while a
+        batch is scored form the next batch
+        :return: nothing
+        """
+
+        while True:
+            batch = [self.requests.get()]
+            size = len(batch[0][0])
+            while size < self.max_batch:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size += len(request[0])
+
+            try:
+                clusters, distances, outliers = self.scorer.score_array(np.vstack([rows for rows, _ in batch]))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            start = 0
+            for rows, future in batch:
+                end = start + len(rows)
+                future.set_result(Scorer.results(clusters[start:end], distances[start:end], outliers[start:end]))
+                start = end
+
+
+def make_server(scorer: BatchingScorer, host: str = '127.0.0.1', port: int = 8000):
+    """
+    Builds the HTTP server. Every connection is handled in its own thread and scored through the BatchingScorer
+    :param scorer: the BatchingScorer
+    :param host: the address to listen to
+    :param port: the port to listen to
+    :return: the ThreadingHTTPServer. Call serve_forever() to start it
+    """
+
+    class ScoreHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'      # Keep-alive, so a client does not open a connection for every request
+        disable_nagle_algorithm = True      # Otherwise small replies wait for the delayed ACK of the client (40 ms)
+
+        def do_POST(self):
+            if self.path != '/score':
+                self.reply(404, {'error': 'Unknown path. Use POST /score'})
+                return
+            try:
+                customers = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                self.reply(200, scorer.score(customers))
+            except (ValueError, KeyError, TypeError) as e:
+                self.reply(400, {'error': str(e)})
+
+        def reply(self, status: int, body):
+            encoded = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(encoded)))
+            self.end_headers()
+            self.wfile.write(encoded)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), ScoreHandler)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python scoring.py model.npz [port]")
+        sys.exit(1)
+
+    server = make_server(BatchingScorer(Scorer(ModelBundle.load(sys.argv[1]))),
+                         port=int(sys.argv[2]) if len(sys.argv) > 2 else 8000)
+    print(f"Scoring customers on http://{server.server_address[0]}:{server.server_address[1]}/score")
+    server.serve_forever()
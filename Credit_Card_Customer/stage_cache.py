@@ -0,0 +1,184 @@
+"""
+This class implements a content-addressed cache for the outputs of the stages of the pipeline ('pipeline.py').
+
+The key of a stage is a hash of the keys of the stages it reads from and of its own parameters, and the key of the
+first stage is the hash of the contents of the input file. So a key identifies the input data and every parameter that
+led to an output, and a rerun reuses every stage whose key did not change: when only `outlier_percentile` changes,
+only the outlier detection runs again.
+
+The outputs are pickled in a directory. The total size of the directory is capped, and the least recently used
+outputs are evicted first. The hits and the misses of every stage are counted and can be printed with `report`.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import time
+import uuid
+
+INDEX_FILE = 'index.json'
+# Part of every key. It changes when the outputs of the stages change shape, so older outputs are not reused
+FORMAT_VERSION = 2
+
+
+def hash_file(file_path: str, block_size: int = 1024 * 1024):
+    """
+    Hashes the contents of a file, reading it in blocks
+    :param file_path: path of the file
+    :param block_size: number of bytes that are read at once
+    :return: the hex digest
+    """
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class StageCache:
+    def __init__(self, cache_dir: str = '.stage_cache', max_bytes: int = 1024 ** 3):
+        """
+        Constructor
+        :param cache_dir: the directory where the outputs are stored
+        :param max_bytes: the maximum total size of the stored outputs. The least recently used are evicted
+        """
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.stats = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self.load_index()
+
+    def load_index(self):
+        """
+        Loads the index of the stored outputs (stage, size and last use of every key)
+        :return: the index
+        """
+
+        path = os.path.join(self.cache_dir, INDEX_FILE)
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as file:
+            index = json.load(file)
+
+        # Forget the entries whose file was deleted by hand
+        return {key: entry for key, entry in index.items() if os.path.exists(self.entry_path(key))}
+
+    def save_index(self):
+        """
+        Saves the index
+        :return: nothing
+        """
+
+        with open(os.path.join(self.cache_dir, INDEX_FILE), 'w') as file:
+            json.dump(self.index, file)
+
+    def entry_path(self, key: str):
+        """
+        Gives the file of a stored output
+        :param key: the key of the output
+        :return: the path
+        """
+
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def key(self, stage: str, parent_keys, parameters: dict):
+        """
+        Builds the key of a stage. If the stage is random (it has a `seed` parameter that is None), its output can not
+        be reused, so it gets a unique key and the stages after it get new keys too
+        :param stage: the name of the stage
+        :param parent_keys: the keys of the stages (or the hashes of the files) that the stage reads
+        :param parameters: the parameters of the stage
+        :return: the key
+        """
+
+        if 'seed' in parameters and parameters['seed'] is None:
+            return f"unseeded-{uuid.uuid4().hex}"
+
+        description = json.dumps({'stage': stage, 'inputs': list(parent_keys), 'parameters': parameters,
+                                  'format': FORMAT_VERSION}, sort_keys=True, default=str)
+        return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+    def record(self, stage: str, hit: bool):
+        counts = self.stats.setdefault(stage, {'hits': 0, 'misses': 0})
+        counts['hits' if hit else 'misses'] += 1
+
+    def get(self, key: str):
+        """
+        Finds a stored output
+        :param key: the key of the output
+        :return: tuple of (found, output)
+        """
+
+        if key not in self.index:
+            return False, None
+
+        with open(self.entry_path(key), 'rb') as file:
+            value = pickle.load(file)
+        self.index[key]['last_used'] = time.time()
+        self.save_index()
+        return True, value
+
+    def put(self, stage: str, key: str, value):
+        """
+        Stores an output and evicts the least recently used outputs while the cache is over its size
+        :param stage: the name of the stage
+        :param key: the key of the output
+        :param value: the output
+        :return: nothing
+        """
+
+        if key.startswith('unseeded-'):
+            return
+
+        path = self.entry_path(key)
+        with open(path, 'wb') as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.index[key] = {'stage': stage, 'size': os.path.getsize(path), 'last_used': time.time()}
+        self.evict()
+        self.save_index()
+
+    def evict(self):
+        """
+        Removes the least recently used outputs until the total size is under the cap
+        :return: nothing
+        """
+
+        total = sum(entry['size'] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            total -= self.index[key]['size']
+            os.remove(self.entry_path(key))
+            del self.index[key]
+
+    def cached(self, stage: str, parent_keys, parameters: dict, compute):
+        """
+        Returns the stored output of a stage, or computes and stores it
+        :param stage: the name of the stage
+        :param parent_keys: the keys of the stages (or the hashes of the files) that the stage reads
+        :param parameters: the parameters of the stage
+        :param compute: function without arguments that computes the output
+        :return: tuple of (key, output)
+        """
+
+        key = self.key(stage, parent_keys, parameters)
+        found, value = self.get(key)
+        self.record(stage, found)
+        if not found:
+            value = compute()
+            self.put(stage, key, value)
+        return key, value
+
+    def report(self):
+        """
+        Prints the hits and the misses of every stage
+        :return: nothing
+        """
+
+        size = sum(entry['size'] for entry in self.index.values())
+        print(f"Stage cache ({len(self.index)} outputs, {size / 1024 ** 2:.1f} MB of {self.max_bytes / 1024 ** 2:.0f} MB):")
+        for stage, counts in self.stats.items():
+            print(f"    {stage}: {counts['hits']} hits, {counts['misses']} misses")
@@ -0,0 +1,172 @@
+"""
+This class preprocesses a 'data.csv' (or binary table) that does not fit in the memory. It does the same as
+`CreditCardDataPreProcessor.preprocess` (drops the IDs, normalises with z-score and fills the missing values with the
+median), but reads the file in chunks, twice:
+    The first pass accumulates the statistics of every column: the count, the mean and the sum of squared deviations
+    with Welford's method (Chan's formula, to combine whole chunks), and a quantile sketch ('quantile_sketch.py')
+    for the median
+    The second pass normalises and fills every chunk with these statistics and appends it to the output file
+
+The memory depends on the chunk size and not on the number of rows. The means and the standard deviations are exact,
+the medians are approximate: the rank of every median is within `median_rank_error` (a fraction of the number of
+values, saved with the scaler) of the middle, see 'quantile_sketch.py' for the bound.
+
+The scaler has the same format as the one of `CreditCardDataPreProcessor`, so it can be saved, loaded and used by
+either class.
+"""
+
+import csv
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+import binary_store
+import preprocess
+import quantile_sketch
+
+
+class StreamingPreProcessor(preprocess.CreditCardDataPreProcessor):
+    def __init__(self, file_path: str, chunk_size: int = 100000, id_columns: List[str] = None, float32: bool = False,
+                 sketch_capacity: int = 4096):
+        """
+        Constructor
+        :param file_path: the input csv file (or binary table) that we will preprocess
+        :param chunk_size: number of rows that are read at once
+        :param id_columns: the columns that contain IDs and are dropped
+        :param float32: if True, the output is written as float32
+        :param sketch_capacity: capacity of the quantile sketches. A larger capacity gives more accurate medians
+        """
+
+        super().__init__(file_path, id_columns=id_columns, float32=float32)
+        self.chunk_size = chunk_size
+        self.sketch_capacity = sketch_capacity
+        self.features = [column for column in binary_store.table_columns(file_path) if column not in self.id_columns]
+
+    def iter_chunks(self):
+        """
+        Reads the features in chunks. The ID columns are not read at all
+        :return: generator of (m, d) float64 arrays
+        """
+
+        if binary_store.is_binary_table(self.file_path):
+            data = binary_store.load_array(self.file_path, self.features)
+            for start in range(0, len(data), self.chunk_size):
+                yield np.asarray(data[start:start + self.chunk_size], dtype=np.float64)
+            return
+
+        reader = pd.read_csv(self.file_path, usecols=self.features, chunksize=self.chunk_size,
+                             dtype={column: np.float64 for column in self.features})
+        for chunk in reader:
+            yield chunk[self.features].to_numpy()
+
+    def fit(self, columns: List[str]):
+        """
+        First pass: accumulates the statistics of every column, chunk by chunk. The missing values are ignored
+        :param columns: the columns that are normalised with z-score
+        :return: nothing
+        """
+
+        d = len(self.features)
+        count = np.zeros(d)
+        mean = np.zeros(d)
+        m2 = np.zeros(d)
+        sketches = [quantile_sketch.QuantileSketch(self.sketch_capacity) for _ in range(d)]
+
+        for chunk in self.iter_chunks():
+            chunk_count = np.count_nonzero(~np.isnan(chunk), axis=0)
+            # A column with no values in this chunk has no mean and leaves the running statistics as they are
+            seen = chunk_count > 0
+            chunk_mean = np.zeros(d)
+            chunk_mean[seen] = np.nansum(chunk[:, seen], axis=0) / chunk_count[seen]
+            chunk_m2 = np.nansum((chunk - chunk_mean) ** 2, axis=0)
+
+            # Chan's formula to add a whole chunk to the running statistics
+            total = count + chunk_count
+            delta = chunk_mean - mean
+            mean[seen] += delta[seen] * chunk_count[seen] / total[seen]
+            m2[seen] += chunk_m2[seen] + delta[seen] ** 2 * count[seen] * chunk_count[seen] / total[seen]
+            count = total
+
+            for j, sketch in enumerate(sketches):
+                sketch.update(chunk[:, j])
+
+        normalized = np.isin(self.features, columns)
+        std = np.ones(d)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std[normalized] = np.sqrt(m2[normalized] / (count[normalized] - 1))     # Sample std, like pandas
+        mean[~normalized] = 0.0
+
+        self.scaler = {
+            'columns': list(self.features),
+            'normalized': [column for column in self.features if column in columns],
+            'mean': mean.tolist(),
+            'std': std.tolist(),
+            'median': [sketch.quantile(0.5) for sketch in sketches],
+            'median_rank_error': [sketch.relative_error() for sketch in sketches],
+            'n_rows': int(count.max()) if d else 0,
+        }
+
+    def transform_file(self, output_path: str):
+        """
+        Second pass: fills, normalises and writes the data chunk by chunk, with the fitted (or loaded) scaler.
+        The output is a CSV file, or a binary table if the path ends with '.cbin'
+        :param output_path: the path of the output file
+        :return: the number of rows written
+        """
+
+        if self.scaler is None:
+            print("Scaler is not fitted. Use fit() or load_scaler() first.")
+            return 0
+
+        dtype = np.float32 if self.float32 else np.float64
+        columns = self.scaler['columns']
+        median = np.asarray(self.scaler['median'], dtype=np.float64)
+        mean = np.asarray(self.scaler['mean'], dtype=np.float64)
+        std = np.asarray(self.scaler['std'], dtype=np.float64)
+        order = [self.features.index(column) for column in columns]
+
+        rows = 0
+        if binary_store.is_binary_path(output_path):
+            with binary_store.TableWriter(output_path, columns, dtype=dtype) as writer:
+                for chunk in self.iter_chunks():
+                    writer.append(self.transform_chunk(chunk[:, order], median, mean, std))
+                    rows += len(chunk)
+            return rows
+
+        with open(output_path, 'w', newline='') as file:
+            csv.writer(file).writerow(columns)
+            for chunk in self.iter_chunks():
+                block = self.transform_chunk(chunk[:, order], median, mean, std).astype(dtype, copy=False)
+                pd.DataFrame(block, columns=columns, copy=False).to_csv(file, header=False, index=False)
+                rows += len(chunk)
+        return rows
+
+    @staticmethod
+    def transform_chunk(chunk, median, mean, std):
+        """
+        Fills the missing values of a chunk with the medians and normalises it, in place
+        :return: the chunk
+        """
+
+        missing = np.isnan(chunk)
+        if missing.any():
+            rows, cols = np.nonzero(missing)
+            chunk[rows, cols] = median[cols]
+        chunk -= mean
+        chunk /= std
+        return chunk
+
+    def run(self, columns: List[str], output_path: str):
+        """
+        Runs the two passes
+        :param columns: the columns that are normalised with z-score
+        :param output_path: the path of the output file
+        :return: nothing
+        """
+
+        self.fit(columns)
+        rows = self.transform_file(output_path)
+        error = max(self.scaler['median_rank_error'], default=0.0)
+        print(f"{rows} rows preprocessed in chunks of {self.chunk_size}. "
+              f"Medians within {error:.4%} of the middle rank.")
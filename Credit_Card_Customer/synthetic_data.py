@@ -0,0 +1,186 @@
+"""
+This class generates synthetic customers that look like the ones of 'data.csv', in any number, for load tests and for
+measuring the outlier recall at scale.
+
+It learns the data with a mixture of Gaussian copulas. The customers form a few segments (the clusters that the
+pipeline finds), which one copula can not reproduce, so the data are first split in `n_segments` segments with the
+k-means (on the z-scored features) and every segment gets its own copula:
+    The marginal of every feature is its empirical distribution in the segment (the sorted values), so the synthetic
+    values are values that real customers have (e.g. whole numbers of credit cards)
+    The dependence between the features is the correlation matrix of their normal scores (the ranks mapped through
+    the inverse normal CDF)
+A synthetic customer picks a segment with the share of the real customers in it, and is a correlated standard normal
+vector, mapped to uniforms with the normal CDF and then to values with the empirical quantiles of the segment.
+
+The rows are generated and written in chunks (CSV, or a binary table if the path ends with '.cbin'), so the memory
+does not depend on the number of rows. The ID columns get a row number and a random customer key. Outliers are injected
+at `outlier_rate`, drawn like the ones of `OutlierHandler.add_outliers` (uniformly in mean +- multiplier * std of every
+feature), and their row numbers (0-based) are returned and saved next to the output, in '<output>.outliers.npy'.
+"""
+
+import csv
+from typing import List
+
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr, ndtri
+
+import binary_store
+import kMeans
+from add_outliers import draw_outliers
+from preprocess import ID_COLUMNS
+
+
+class SyntheticCustomerGenerator:
+    def __init__(self, file_path: str = 'data.csv', id_columns: List[str] = None, n_segments: int = 3,
+                 outlier_rate: float = 0.0, multiplier: float = 4, seed: int = None, chunk_size: int = 100000):
+        """
+        Constructor
+        :param file_path: the CSV file (or binary table) with the real customers
+        :param id_columns: the columns that contain IDs and are not learnt
+        :param n_segments: number of segments with their own copula. 1 learns one copula for all the customers
+        :param outlier_rate: the share of the rows that are outliers
+        :param multiplier: multiplier to determine the range of the outliers
+        :param seed: seed of the random generator, so that a run can be reproduced
+        :param chunk_size: number of rows that are generated and written at once
+        """
+
+        self.file_path = file_path
+        self.id_columns = ID_COLUMNS if id_columns is None else id_columns
+        self.n_segments = n_segments
+        self.outlier_rate = outlier_rate
+        self.multiplier = multiplier
+        self.rng = np.random.default_rng(seed)
+        self.chunk_size = chunk_size
+        self.columns = None
+        self.features = None
+        self.weights = None
+        self.sorted_values = []
+        self.cholesky = []
+        self.mean = None
+        self.std = None
+
+    def fit(self):
+        """
+        Learns the segments, and the marginals and the correlations of the features in every segment
+        :return: nothing
+        """
+
+        data = binary_store.read_table(self.file_path)
+        self.columns = list(data.columns)
+        self.features = [column for column in self.columns if column not in self.id_columns]
+        block = data[self.features].dropna().to_numpy(dtype=np.float64)
+        self.mean = block.mean(axis=0)
+        self.std = block.std(axis=0, ddof=1)
+
+        if self.n_segments > 1:
+            model = kMeans.VectorizedKMeans(self.n_segments, None, seed=self.rng.integers(2 ** 32))
+            model.fit((block - self.mean) / np.where(self.std > 0, self.std, 1.0), 100)
+            labels = model.labels
+        else:
+            labels = np.zeros(len(block), dtype=np.intp)
+
+        counts = np.bincount(labels, minlength=self.n_segments)
+        self.weights = counts / counts.sum()
+        self.sorted_values = []
+        self.cholesky = []
+        for segment in range(self.n_segments):
+            values = block[labels == segment]
+            self.sorted_values.append(np.sort(values, axis=0))
+            self.cholesky.append(np.linalg.cholesky(self.normal_score_correlation(values)))
+
+    @staticmethod
+    def normal_score_correlation(values: np.ndarray):
+        """
+        Computes the correlation matrix of the normal scores of the average ranks (tied values get the same score).
+        A constant feature is not correlated with the others
+        :param values: (n, d) array
+        :return: (d, d) correlation matrix, made positive definite
+        """
+
+        d = values.shape[1]
+        if len(values) < 2:
+            return np.eye(d)
+
+        scores = np.column_stack([ndtri((pd.Series(values[:, j]).rank().to_numpy() - 0.5) / len(values))
+                                  for j in range(d)])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            correlation = np.corrcoef(scores, rowvar=False).reshape(d, d)
+        correlation = np.nan_to_num(correlation)
+        np.fill_diagonal(correlation, 1.0)
+        return correlation + 1e-9 * np.eye(d)
+
+    def sample(self, n_rows: int):
+        """
+        Generates customers, without IDs and outliers
+        :param n_rows: the number of customers
+        :return: (n_rows, d) array with the features
+        """
+
+        if self.weights is None:
+            self.fit()
+
+        segments = self.rng.choice(self.n_segments, size=n_rows, p=self.weights)
+        features = np.empty((n_rows, len(self.features)))
+        for segment in range(self.n_segments):
+            rows = np.flatnonzero(segments == segment)
+            if len(rows) == 0:
+                continue
+            sorted_values = self.sorted_values[segment]
+            normal = self.rng.standard_normal((len(rows), len(self.features))) @ self.cholesky[segment].T
+            positions = np.minimum((ndtr(normal) * len(sorted_values)).astype(np.intp), len(sorted_values) - 1)
+            features[rows] = np.take_along_axis(sorted_values, positions, axis=0)
+        return features
+
+    def generate_chunk(self, start: int, n_rows: int):
+        """
+        Generates the rows start .. start + n_rows, with the IDs and the outliers
+        :return: tuple of ((n_rows, number of columns) array in the order of the columns, outlier row numbers)
+        """
+
+        features = self.sample(n_rows)
+
+        outliers = np.flatnonzero(self.rng.random(n_rows) < self.outlier_rate)
+        if len(outliers):
+            features[outliers] = draw_outliers(self.rng, self.mean, self.std, self.multiplier, len(outliers))
+
+        chunk = np.empty((n_rows, len(self.columns)))
+        for j, column in enumerate(self.columns):
+            if column in self.features:
+                chunk[:, j] = features[:, self.features.index(column)]
+            elif j == 0:
+                chunk[:, j] = np.arange(start + 1, start + n_rows + 1)      # Row number, like Sl_No
+            else:
+                chunk[:, j] = self.rng.integers(10000, 100000, n_rows)    # Random key, like Customer Key
+        return chunk, outliers + start
+
+    def generate(self, n_rows: int, output_path: str):
+        """
+        Generates customers and writes them chunk by chunk
+        :param n_rows: the number of customers
+        :param output_path: the CSV file (or binary table, if it ends with '.cbin')
+        :return: array with the row numbers of the outliers
+        """
+
+        if self.weights is None:
+            self.fit()
+
+        outliers = []
+        if binary_store.is_binary_path(output_path):
+            with binary_store.TableWriter(output_path, self.columns) as writer:
+                for start in range(0, n_rows, self.chunk_size):
+                    chunk, chunk_outliers = self.generate_chunk(start, min(self.chunk_size, n_rows - start))
+                    writer.append(chunk)
+                    outliers.append(chunk_outliers)
+        else:
+            with open(output_path, 'w', newline='') as file:
+                csv.writer(file).writerow(self.columns)
+                for start in range(0, n_rows, self.chunk_size):
+                    chunk, chunk_outliers = self.generate_chunk(start, min(self.chunk_size, n_rows - start))
+                    pd.DataFrame(chunk).to_csv(file, header=False, index=False, float_format='%.17g')
+                    outliers.append(chunk_outliers)
+
+        outliers = np.concatenate(outliers) if outliers else np.empty(0, dtype=np.intp)
+        np.save(output_path + '.outliers.npy', outliers)
+        print(f"{n_rows} synthetic customers written to {output_path}, {len(outliers)} of them outliers.")
+        return outliers
@@ -0,0 +1,76 @@
+"""
+This file tests the mini-batch k-means ('mini_batch_kmeans.py') on files that are sorted by segment, where the first
+batch holds only one of the clusters. Run it with `python -m pytest` from this directory.
+"""
+
+import contextlib
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import binary_store
+from mini_batch_kmeans import MiniBatchKMeans
+
+CENTRES = [0.0, 6.0, 12.0]
+
+
+def sorted_blobs(points_per_blob: int = 20000):
+    """
+    :return: DataFrame with three blobs on the x axis, one after the other
+    """
+
+    rng = np.random.default_rng(0)
+    x = np.concatenate([rng.normal(centre, 0.5, points_per_blob) for centre in CENTRES])
+    return pd.DataFrame({'x': x, 'y': rng.normal(0.0, 0.5, len(x))})
+
+
+def write(data: pd.DataFrame, directory, extension: str):
+    path = str(directory / f"sorted.{extension}")
+    if extension == 'npy':
+        np.save(path, data.to_numpy())
+    else:
+        binary_store.save_table(data, path)
+    return path
+
+
+def fit(model: MiniBatchKMeans, max_iterations: int = 50):
+    with contextlib.redirect_stdout(io.StringIO()):
+        model.run(max_iterations)
+    return np.sort(model.centroid_array[:, 0])
+
+
+@pytest.mark.parametrize('extension', ['csv', 'cbin', 'npy'])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_sorted_file_converges_to_every_segment(tmp_path, extension, seed):
+    path = write(sorted_blobs(), tmp_path, extension)
+    model = MiniBatchKMeans(3, path, batch_size=1000, seed=seed)
+
+    centres = fit(model)
+
+    assert model.converged
+    np.testing.assert_allclose(centres, CENTRES, atol=0.1)
+
+
+def test_centroid_without_points_is_reassigned(tmp_path):
+    path = write(sorted_blobs(), tmp_path, 'csv')
+    model = MiniBatchKMeans(3, path, batch_size=1000, seed=0)
+    model.centroid_array = np.array([[3.0, 0.0], [12.0, 0.0], [100.0, 100.0]])     # The last one wins no point
+
+    centres = fit(model)
+
+    assert model.reassignments >= 1
+    np.testing.assert_allclose(centres, CENTRES, atol=0.1)
+
+
+def test_csv_and_binary_table_use_the_order_of_the_columns(tmp_path):
+    data = sorted_blobs(1000)
+    csv_path = write(data, tmp_path, 'csv')
+    table_path = write(data, tmp_path, 'cbin')
+
+    batches = [next(MiniBatchKMeans(3, path, batch_size=10, columns=['y', 'x']).iter_batches())
+               for path in (csv_path, table_path)]
+
+    np.testing.assert_allclose(batches[0], data[['y', 'x']].to_numpy()[:10])
+    np.testing.assert_allclose(batches[1], batches[0])